@@ -9,8 +9,10 @@ to support the new Backend Archie type
 """
 import os
 from argparse import ArgumentParser
-from wsgiref.simple_server import make_server
 from archiveinterface.archive_interface import ArchiveInterfaceGenerator
+from archiveinterface.archive_server import make_archive_server, reload_on_hangup, PreforkServer, \
+    DEFAULT_WORKERS, DEFAULT_THREADS
+from archiveinterface.async_server import make_async_server
 from archiveinterface.archive_utils import set_config_name
 from archiveinterface.archivebackends.archive_backend_factory import \
     ArchiveBackendFactory
@@ -27,12 +29,26 @@ def main():
                         default='localhost', dest='address',
                         help='address to listen on')
     parser.add_argument('-t', '--type', dest='type', default='posix',
-                        choices=['hpss', 'posix', 'hmssideband'],
+                        choices=['hpss', 'hpss_simulator', 'posix', 'hmssideband'],
                         help='use the typed backend')
     parser.add_argument('--prefix', metavar='PREFIX', dest='prefix',
                         default='{}tmp'.format(os.path.sep), help='prefix to save data at')
     parser.add_argument('--config', metavar='CONFIG', dest='config',
                         default=None, help='config file location')
+    parser.add_argument('-s', '--server', dest='server', default='simple',
+                        choices=['simple', 'async', 'prefork'],
+                        help='serve one request at a time, from an event loop or from worker processes')
+    parser.add_argument('--threads', metavar='THREADS', type=int,
+                        default=DEFAULT_THREADS, dest='threads',
+                        help='threads running requests in the async server or each prefork worker')
+    parser.add_argument('--workers', metavar='WORKERS', type=int,
+                        default=DEFAULT_WORKERS, dest='workers',
+                        help='prefork worker processes')
+    parser.add_argument('--max-requests', metavar='MAX_REQUESTS', type=int,
+                        default=0, dest='max_requests',
+                        help='requests a prefork worker serves before it is replaced, 0 for no limit')
+    parser.add_argument('--reuse-port', action='store_true', dest='reuse_port',
+                        help='give each prefork worker its own SO_REUSEPORT listener')
 
     args = parser.parse_args()
 
@@ -51,7 +67,15 @@ def main():
     )
     # Create the archive interface
     generator = ArchiveInterfaceGenerator(backend)
-    srv = make_server(args.address, args.port,
-                      generator.pacifica_archiveinterface)
+    if args.server == 'prefork':
+        srv = PreforkServer(args.address, args.port, generator.pacifica_archiveinterface,
+                            args.workers, args.threads, args.max_requests, args.reuse_port)
+    elif args.server == 'async':
+        srv = make_async_server(args.address, args.port,
+                                generator.pacifica_archiveinterface, args.threads)
+    else:
+        srv = make_archive_server(args.address, args.port,
+                                  generator.pacifica_archiveinterface)
 
+    reload_on_hangup()
     srv.serve_forever()
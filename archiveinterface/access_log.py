@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Access Log Module.
+
+Module with the writer of the JSON access log. Requests hand their log
+line to a queue and a background thread writes it, so a slow disk or
+pipe never holds up a request. Lines are dropped, and counted, if the
+writer falls too far behind.
+"""
+import os
+import sys
+import json
+import threading
+from Queue import Queue, Full
+
+# off, uwsgi already logs each request
+DEFAULT_ACCESS_LOG = ''
+DEFAULT_ACCESS_LOG_QUEUE = 10000
+
+
+class AccessLog(object):
+    """Write JSON access log lines from a background thread."""
+
+    def __init__(self, filename=DEFAULT_ACCESS_LOG, queue_size=DEFAULT_ACCESS_LOG_QUEUE):
+        """Log to the file with the name, stderr for '-' and nowhere if empty."""
+        self._filename = filename
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self.dropped = 0
+
+    def log(self, entry):
+        """Queue the entry to be written as a line of JSON."""
+        if not self._filename:
+            return
+        self._start_writer()
+        try:
+            self._queue.put_nowait(json.dumps(entry, sort_keys=True) + '\n')
+        except Full:
+            self.dropped += 1
+
+    def _start_writer(self):
+        """Start the writer thread, again in a process forked since."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._filename == '-':
+                log_file = sys.stderr
+            else:
+                log_file = open(self._filename, 'a', 1)
+            writer = threading.Thread(target=self._write, args=(log_file,), name='access-log')
+            writer.daemon = True
+            writer.start()
+            self._pid = os.getpid()
+
+    def _write(self, log_file):
+        """Write queued lines forever."""
+        while True:
+            line = self._queue.get()
+            try:
+                log_file.write(line)
+                if self._queue.empty():
+                    log_file.flush()
+            except (IOError, ValueError):
+                self.dropped += 1
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait for the queued lines to be written."""
+        self._queue.join()
@@ -4,117 +4,466 @@
 
 Allows API to file interactions for passed in archive backends.
 """
+import hashlib
+import tarfile
 from json import dumps
+from urlparse import parse_qs
 from sys import stderr
-from archiveinterface.archive_utils import get_http_modified_time
+from uuid import uuid4
+from archiveinterface.archive_utils import get_http_modified_time, get_http_byte_ranges, \
+    get_http_date, get_http_etag, if_range_matches, is_not_modified, get_http_digests, \
+    get_http_digest_header, get_http_json_body, get_config, read_config_value, read_config_int, \
+    read_config_float, DIGEST_HTTP_NAMES, ROUTE_PREFIX
 from archiveinterface.archive_interface_error import ArchiveInterfaceError
+from archiveinterface.bundle import BundleMember, BoundedReader, make_bundle, member_filepath, \
+    BUNDLE_FORMATS
+from archiveinterface.stage_executor import StageExecutor, DEFAULT_STAGE_WORKERS, DEFAULT_STAGE_JOB_HISTORY
+from archiveinterface.metrics import METRICS, RequestMetrics, InstrumentedArchive
+from archiveinterface.access_log import AccessLog, DEFAULT_ACCESS_LOG
+from archiveinterface.status_cache import StatusCache, DEFAULT_STATUS_CACHE_SIZE, DEFAULT_STATUS_CACHE_DISK_TTL, \
+    DEFAULT_STATUS_CACHE_TAPE_TTL
+from archiveinterface.archivebackends.directory_cache import DIRECTORY_CACHE, DEFAULT_DIRECTORY_CACHE_SIZE
 import archiveinterface.archive_interface_responses as interface_responses
 
 BLOCK_SIZE = 1 << 20
+# archived files never change once written so caches can keep them
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# digests computed while a file is written unless the config says otherwise
+DEFAULT_DIGESTS = 'sha1'
+# environ key of the RequestMetrics timing the request's phases
+REQUEST_METRICS = 'archivei.request_metrics'
+# the endpoints other than files, under a prefix no file id can have
+METRICS_PATH = ROUTE_PREFIX + 'metrics'
+STATUS_PATH = ROUTE_PREFIX + 'status'
+BUNDLE_PATH = ROUTE_PREFIX + 'bundle'
+STAGE_PATH = ROUTE_PREFIX + 'stage'
+JOBS_PATH = ROUTE_PREFIX + 'jobs/'
 
 
 class ArchiveInterfaceGenerator(object):
     """Archive Interface Generator.
 
     Defines the methods that can be used on files for request types.
+    Requests keep all their state local and open their own handle from
+    the backend so one generator can serve many threads at once.
     """
 
     def __init__(self, archive):
         """Create an archive interface generator."""
-        self._archive = archive
-        self._response = None
+        self._archive = InstrumentedArchive(archive)
+        self._config = None
+        self._digest_algorithms = []
+        self._status_cache = StatusCache()
+        self._load_config()
+        METRICS.set_directory(read_config_value('archiveinterface', 'metrics_dir', '') or None)
+        self._access_log = AccessLog(read_config_value('archiveinterface', 'access_log', DEFAULT_ACCESS_LOG))
+        self._stager = StageExecutor(
+            self._archive,
+            read_config_int('archiveinterface', 'stage_workers', DEFAULT_STAGE_WORKERS),
+            read_config_int('archiveinterface', 'stage_job_history', DEFAULT_STAGE_JOB_HISTORY),
+            self._status_cache,
+            read_config_value('archiveinterface', 'stage_job_dir', '') or None
+        )
         print 'Pacifica Archive Interface Up and Running'
 
+    def _load_config(self):
+        """Apply the settings of the current config snapshot.
+
+        The digests, status cache and directory cache fields are applied
+        again whenever the config is reloaded.
+        """
+        self._config = get_config()
+        digest_algorithms = [
+            algorithm.strip().lower() for algorithm in
+            read_config_value('archiveinterface', 'digests', DEFAULT_DIGESTS).split(',')
+            if algorithm.strip()
+        ]
+        for algorithm in digest_algorithms:
+            if algorithm not in DIGEST_HTTP_NAMES:
+                raise ArchiveInterfaceError('Unsupported digest algorithm: ' + algorithm)
+        self._status_cache.configure(
+            read_config_int('archiveinterface', 'status_cache_size', DEFAULT_STATUS_CACHE_SIZE),
+            read_config_float('archiveinterface', 'status_cache_disk_ttl', DEFAULT_STATUS_CACHE_DISK_TTL),
+            read_config_float('archiveinterface', 'status_cache_tape_ttl', DEFAULT_STATUS_CACHE_TAPE_TTL)
+        )
+        DIRECTORY_CACHE.configure(
+            read_config_int('archiveinterface', 'directory_cache_size', DEFAULT_DIRECTORY_CACHE_SIZE))
+        self._digest_algorithms = digest_algorithms
+
+    def _reload_config(self):
+        """Apply a reloaded config snapshot, keeping the old settings if it is bad."""
+        try:
+            self._load_config()
+        except ArchiveInterfaceError as ex:
+            stderr.write("Can't apply reloaded config with error: {}\n".format(str(ex)))
+
     def get(self, env, start_response):
         """Get a file from WSGI request.
 
         Gets a file specified in the request and writes back the data.
         """
-        archivefile = None
         path_info = env['PATH_INFO']
         # if asking for / then return a message that the archive is working
         if path_info == '/':
             resp = interface_responses.Responses()
-            self._response = resp.archive_working_response(start_response)
-            return self.return_response()
-        stderr.flush()
-        archivefile = self._archive.open(path_info, 'r')
+            response = resp.archive_working_response(start_response, self._status_cache.stats())
+            return self.return_response(response)
+        with env[REQUEST_METRICS].phase('status'):
+            # the length sent and the conditional checks need the current status
+            status = self._status_cache.refresh(self._archive, path_info)
+        headers = [('Content-Type', 'application/octet-stream'),
+                   ('Accept-Ranges', 'bytes')]
+        if not status:
+            archivefile = self._archive.open(path_info, 'r', env[REQUEST_METRICS])
+            start_response('200 OK', headers)
+            return self._file_response(env, archivefile)
+        etag = get_http_etag(path_info, status)
+        headers.extend([
+            ('ETag', etag),
+            ('Last-Modified', get_http_date(status.mtime)),
+            ('Cache-Control', CACHE_CONTROL)
+        ])
+        if status.digests:
+            headers.append(('Digest', get_http_digest_header(status.digests)))
+        if is_not_modified(env, etag, status.mtime):
+            resp = interface_responses.Responses()
+            return resp.not_modified(start_response, headers[2:])
+        archivefile = self._archive.open(path_info, 'r', env[REQUEST_METRICS])
+        if if_range_matches(env, status.mtime, etag):
+            ranges = get_http_byte_ranges(env, status.filesize)
+            if ranges is not None:
+                return self._get_ranges(
+                    archivefile, start_response, headers, ranges, status.filesize)
+        headers.append(('Content-Length', str(status.filesize)))
+        start_response('200 OK', headers)
+        return self._file_response(env, archivefile)
 
-        start_response('200 OK', [('Content-Type',
-                                   'application/octet-stream')])
+    def _file_response(self, env, archivefile):
+        """Send back the whole file."""
         if 'wsgi.file_wrapper' in env:
-            return env['wsgi.file_wrapper'](archivefile, BLOCK_SIZE)
-        return iter(lambda: archivefile.read(BLOCK_SIZE), '')
+            return env[REQUEST_METRICS].file_response(env['wsgi.file_wrapper'](archivefile, BLOCK_SIZE))
+        return self._read_file(archivefile)
+
+    @staticmethod
+    def _read_file(archivefile):
+        """Yield the file a block at a time, closing it at the end."""
+        try:
+            buf = archivefile.read(BLOCK_SIZE)
+            while buf:
+                yield buf
+                buf = archivefile.read(BLOCK_SIZE)
+        finally:
+            archivefile.close()
+
+    def _get_ranges(self, archivefile, start_response, headers, ranges, filesize):
+        """Send back the parts of the file asked for by the Range header."""
+        if not ranges:
+            archivefile.close()
+            resp = interface_responses.Responses()
+            response = resp.range_not_satisfiable(start_response, filesize)
+            return self.return_response(response)
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(first, last, filesize)))
+            headers.append(('Content-Length', str(last - first + 1)))
+            start_response('206 Partial Content', headers)
+            return self._read_ranges(archivefile, [('', first, last)], '')
+        boundary = uuid4().hex
+        content_type = headers.pop(0)[1]
+        parts = []
+        for first, last in ranges:
+            part_head = '\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                boundary, content_type, first, last, filesize)
+            parts.append((part_head, first, last))
+        tail = '\r\n--{}--\r\n'.format(boundary)
+        content_length = len(tail)
+        for part_head, first, last in parts:
+            content_length += len(part_head) + last - first + 1
+        headers.insert(0, ('Content-Type', 'multipart/byteranges; boundary=' + boundary))
+        headers.append(('Content-Length', str(content_length)))
+        start_response('206 Partial Content', headers)
+        return self._read_ranges(archivefile, parts, tail)
+
+    @staticmethod
+    def _read_ranges(archivefile, parts, tail):
+        """Yield each part header followed by its bytes of the file."""
+        try:
+            for part_head, first, last in parts:
+                if part_head:
+                    yield part_head
+                archivefile.seek(first)
+                remaining = last - first + 1
+                while remaining > 0:
+                    buf = archivefile.read(min(remaining, BLOCK_SIZE))
+                    if not buf:
+                        raise ArchiveInterfaceError(
+                            'File ended before the end of the requested range')
+                    remaining -= len(buf)
+                    yield buf
+            if tail:
+                yield tail
+        finally:
+            archivefile.close()
 
     def put(self, env, start_response):
         """Write a file from WSGI requests.
 
         Writes a file passed in the request to the archive.
         """
-        archivefile = None
         resp = interface_responses.Responses()
         path_info = env['PATH_INFO']
         mod_time = get_http_modified_time(env)
-        stderr.flush()
-        archivefile = self._archive.open(path_info, 'w')
+        expected_digests = get_http_digests(env)
         try:
             content_length = int(env['CONTENT_LENGTH'])
         except Exception as ex:
             raise ArchiveInterfaceError(
                 "Can't get file content length with error: {}".format(str(ex))
             )
-        while content_length > 0:
-            if content_length > BLOCK_SIZE:
-                buf = env['wsgi.input'].read(BLOCK_SIZE)
-            else:
-                buf = env['wsgi.input'].read(content_length)
-            archivefile.write(buf)
-            content_length -= len(buf)
+        digests, mismatched = self._archive_file(
+            path_info, env['wsgi.input'].read, content_length, mod_time, expected_digests, env[REQUEST_METRICS])
+        if mismatched:
+            response = resp.digest_mismatch(start_response, expected_digests, digests)
+            return self.return_response(response)
+        response = resp.successful_put_response(start_response,
+                                                env['CONTENT_LENGTH'], digests)
+        return self.return_response(response)
+
+    def put_bundle(self, env, start_response):
+        """Write the files in an uploaded tar from a WSGI request.
+
+        The member names of the tar are the files to write. Each member
+        is written to the archive as the stream arrives, keeping its
+        mtime, and the result for every member is sent back.
+        """
+        resp = interface_responses.Responses()
+        try:
+            content_length = int(env['CONTENT_LENGTH'])
+        except Exception as ex:
+            raise ArchiveInterfaceError(
+                "Can't get bundle content length with error: {}".format(str(ex))
+            )
+        results = []
+        error = None
+        try:
+            bundle = tarfile.open(fileobj=BoundedReader(env['wsgi.input'], content_length), mode='r|')
+            for member in bundle:
+                results.append(self._unbundle_member(bundle, member, env[REQUEST_METRICS]))
+        except tarfile.TarError as ex:
+            error = "Can't read tar bundle with error: " + str(ex)
+        response = resp.bundle_manifest(start_response, results, error)
+        return self.return_response(response)
+
+    def _unbundle_member(self, bundle, member, request):
+        """Write one member of an uploaded tar and return its result."""
+        try:
+            filepath = member_filepath(member.name)
+        except ArchiveInterfaceError as ex:
+            return {'file': member.name, 'message': 'Error: ' + str(ex)}
+        if member.issym() or member.islnk() or member.isdev():
+            return {'file': filepath, 'message': 'Error: links and devices are not accepted'}
+        if not member.isfile():
+            return {'file': filepath, 'message': 'Skipped, not a regular file'}
+        try:
+            digests, _ = self._archive_file(
+                filepath, bundle.extractfile(member).read, member.size, member.mtime, {}, request)
+        except (ArchiveInterfaceError, tarfile.TarError) as ex:
+            return {'file': filepath, 'message': 'Error: ' + str(ex)}
+        return {
+            'file': filepath,
+            'message': 'File added to archive',
+            'total_bytes': member.size,
+            'digests': digests
+        }
+
+    def _archive_file(self, path_info, read, content_length, mod_time, expected_digests, request):
+        """Write content_length bytes from read(size) to the archive.
 
-        self._response = resp.successful_put_response(start_response,
-                                                      env['CONTENT_LENGTH'])
+        Returns the hex digests of the contents by algorithm and the
+        expected digests that didn't match. A file that doesn't match
+        or fails to be written is discarded. The time spent is added to
+        the phases of the request.
+        """
+        try:
+            return self._write_file(path_info, read, content_length, mod_time, expected_digests, request)
+        finally:
+            # after the write, so a status looked up while it was going isn't kept
+            self._status_cache.invalidate(path_info)
+
+    def _write_file(self, path_info, read, content_length, mod_time, expected_digests, request):
+        """Write the file for _archive_file."""
+        hashes = dict(
+            (algorithm, hashlib.new(algorithm))
+            for algorithm in set(self._digest_algorithms) | set(expected_digests)
+        )
+        archivefile = self._archive.open(path_info, 'w', request)
+        try:
+            while content_length > 0:
+                with request.phase('upload'):
+                    buf = read(min(content_length, BLOCK_SIZE))
+                if not buf:
+                    raise ArchiveInterfaceError(
+                        'Request body ended {} bytes short of the content length'.format(content_length))
+                archivefile.write(buf)
+                with request.phase('digest'):
+                    for digest in hashes.values():
+                        digest.update(buf)
+                content_length -= len(buf)
+        except Exception:
+            # don't leave a partial file behind to block the retry
+            archivefile.discard()
+            raise
+        digests = dict((algorithm, digest.hexdigest()) for algorithm, digest in hashes.items())
+        mismatched = [algorithm for algorithm, value in expected_digests.items()
+                      if digests[algorithm] != value.lower()]
+        if mismatched:
+            archivefile.discard()
+            return digests, mismatched
         archivefile.close()
         archivefile.set_mod_time(mod_time)
+        archivefile.set_digests(digests)
         archivefile.set_file_permissions()
-        return self.return_response()
+        return digests, mismatched
 
     def status(self, env, start_response):
         """Get the file status from WSGI request.
 
         Gets the status of a file specified in the request.
         """
-        archivefile = None
         path_info = env['PATH_INFO']
         resp = interface_responses.Responses()
-        stderr.flush()
-        archivefile = self._archive.open(path_info, 'r')
-        status = archivefile.status()
-        self._response = resp.file_status(start_response, status)
-        archivefile.close()
-        return self.return_response()
+        with env[REQUEST_METRICS].phase('status'):
+            status = self._status_cache.stat(self._archive, path_info)
+        etag = None
+        if status:
+            etag = get_http_etag(path_info, status)
+            if is_not_modified(env, etag, status.mtime):
+                return resp.not_modified(start_response, [
+                    ('ETag', etag),
+                    ('Last-Modified', get_http_date(status.mtime))
+                ])
+        response = resp.file_status(start_response, status, etag)
+        return self.return_response(response)
+
+    def status_many(self, env, start_response):
+        """Get the status of many files from a WSGI request.
+
+        The request body is a JSON list of the files and their
+        statuses are streamed back as a JSON list.
+        """
+        files = get_http_json_body(env)
+        if not isinstance(files, list):
+            raise ArchiveInterfaceError('Status request body must be a JSON list of files')
+        resp = interface_responses.Responses()
+        statuses = self._status_cache.status_many(self._archive, [str(fileid) for fileid in files])
+        return resp.file_status_list(start_response, statuses)
 
     def stage(self, env, start_response):
         """Stage a file from WSGI request.
 
         Stage the file specified in the request to disk.
         """
-        archivefile = None
         path_info = env['PATH_INFO']
         resp = interface_responses.Responses()
-        stderr.flush()
-        archivefile = self._archive.open(path_info, 'r')
-        archivefile.stage()
-        self._response = resp.file_stage(start_response, path_info)
-        archivefile.close()
-        return self.return_response()
+        if 'respond-async' in env.get('HTTP_PREFER', ''):
+            job = self._stager.submit([path_info])
+            response = resp.stage_job_accepted(start_response, job.report(), JOBS_PATH + job.job_id)
+            return self.return_response(response)
+        archivefile = self._archive.open(path_info, 'r', env[REQUEST_METRICS])
+        try:
+            archivefile.stage()
+        finally:
+            archivefile.close()
+            self._status_cache.invalidate(path_info)
+        response = resp.file_stage(start_response, path_info)
+        return self.return_response(response)
+
+    def bundle(self, env, start_response):
+        """Send many files as one tar or zip from a WSGI request.
 
-    def return_response(self):
+        The request body is a JSON list of the files and the format
+        query parameter picks tar, the default, or zip. Files already
+        on disk are sent first so they aren't held up by tape recalls.
+        """
+        files = get_http_json_body(env)
+        if not isinstance(files, list):
+            raise ArchiveInterfaceError('Bundle request body must be a JSON list of files')
+        bundle_format = parse_qs(env.get('QUERY_STRING', '')).get('format', ['tar'])[0]
+        if bundle_format not in BUNDLE_FORMATS:
+            raise ArchiveInterfaceError('Unsupported bundle format: ' + bundle_format)
+        resp = interface_responses.Responses()
+        members = []
+        missing = []
+        with env[REQUEST_METRICS].phase('status'):
+            statuses = list(self._status_cache.status_many(self._archive, [str(fileid) for fileid in files]))
+        for filepath, status in statuses:
+            if isinstance(status, Exception):
+                raise status
+            if status is None:
+                missing.append(filepath)
+            else:
+                members.append((status.file_storage_media != 'disk', BundleMember(filepath, status)))
+        if missing:
+            response = resp.bundle_files_not_found(start_response, missing)
+            return self.return_response(response)
+        members = [member for _, member in sorted(members, key=lambda item: item[0])]
+        length, content = make_bundle(self._archive, members, bundle_format, BLOCK_SIZE)
+        return resp.bundle(start_response, BUNDLE_FORMATS[bundle_format], bundle_format, length, content)
+
+    def stage_many(self, env, start_response):
+        """Stage many files in the background from a WSGI request.
+
+        The request body is a JSON list of the files. The files are
+        queued as a job which can be polled under JOBS_PATH.
+        """
+        files = get_http_json_body(env)
+        if not isinstance(files, list):
+            raise ArchiveInterfaceError('Stage request body must be a JSON list of files')
+        resp = interface_responses.Responses()
+        job = self._stager.submit([str(fileid) for fileid in files])
+        response = resp.stage_job_accepted(start_response, job.report(), JOBS_PATH + job.job_id)
+        return self.return_response(response)
+
+    def stage_job(self, env, start_response):
+        """Report the progress of a stage job from a WSGI request."""
+        job_id = env['PATH_INFO'][len(JOBS_PATH):]
+        resp = interface_responses.Responses()
+        report = self._stager.job_report(job_id)
+        if report is None:
+            response = resp.stage_job_not_found(start_response, job_id)
+        else:
+            response = resp.stage_job_status(start_response, report)
+        return self.return_response(response)
+
+    @staticmethod
+    def metrics(start_response):
+        """Send back the metrics of every process from a WSGI request."""
+        resp = interface_responses.Responses()
+        return resp.metrics(start_response, METRICS.exposition())
+
+    @staticmethod
+    def return_response(response):
         """Print all responses in a nice fashion."""
-        return dumps(self._response, sort_keys=True, indent=4)
+        return dumps(response, sort_keys=True, indent=4)
 
     def pacifica_archiveinterface(self, env, start_response):
+        """Serve a request, recording its metrics."""
+        if get_config() is not self._config:
+            self._reload_config()
+        request = RequestMetrics(env, start_response, self._access_log)
+        env[REQUEST_METRICS] = request
+        try:
+            result = self._dispatch(env, request.start_response)
+        except Exception:
+            request.finish()
+            raise
+        return request.wrap(result)
+
+    def _dispatch(self, env, start_response):
         """Parse request method type."""
         try:
+            if env['PATH_INFO'].startswith(ROUTE_PREFIX):
+                return self._route(env, start_response)
             if env['REQUEST_METHOD'] == 'GET':
                 return self.get(env, start_response)
             elif env['REQUEST_METHOD'] == 'PUT':
@@ -124,16 +473,36 @@ class ArchiveInterfaceGenerator(object):
             elif env['REQUEST_METHOD'] == 'POST':
                 return self.stage(env, start_response)
             resp = interface_responses.Responses()
-            self._response = resp.unknown_request(start_response,
-                                                  env['REQUEST_METHOD'])
-            return self.return_response()
+            response = resp.unknown_request(start_response,
+                                            env['REQUEST_METHOD'])
+            return self.return_response(response)
         except ArchiveInterfaceError as ex:
             # catching application errors
             # set the error reponse
             resp = interface_responses.Responses()
-            self._response = resp.archive_exception(
+            response = resp.archive_exception(
                 start_response, ex, env['REQUEST_METHOD'])
-            return self.return_response()
+            return self.return_response(response)
+
+    def _route(self, env, start_response):
+        """Serve the endpoints under ROUTE_PREFIX, which are never files."""
+        method = env['REQUEST_METHOD']
+        path_info = env['PATH_INFO']
+        if method == 'GET' and path_info == METRICS_PATH:
+            return self.metrics(start_response)
+        if method == 'GET' and path_info.startswith(JOBS_PATH):
+            return self.stage_job(env, start_response)
+        if method == 'PUT' and path_info == BUNDLE_PATH:
+            return self.put_bundle(env, start_response)
+        if method == 'POST' and path_info == STATUS_PATH:
+            return self.status_many(env, start_response)
+        if method == 'POST' and path_info == BUNDLE_PATH:
+            return self.bundle(env, start_response)
+        if method == 'POST' and path_info == STAGE_PATH:
+            return self.stage_many(env, start_response)
+        resp = interface_responses.Responses()
+        response = resp.unknown_endpoint(start_response, path_info)
+        return self.return_response(response)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """Archive interface server responses module."""
+from json import dumps
+from archiveinterface.archive_utils import get_http_digest_header
 
 
 class Responses(object):
@@ -33,21 +35,55 @@ class Responses(object):
         }
         return self._response
 
-    def successful_put_response(self, start_response, total_bytes):
+    def successful_put_response(self, start_response, total_bytes, digests=None):
         """Response on a successful put."""
-        start_response('201 Created', [('Content-Type', 'application/json')])
+        headers = [('Content-Type', 'application/json')]
+        if digests:
+            headers.append(('Digest', get_http_digest_header(digests)))
+        start_response('201 Created', headers)
         self._response = {
             'message': 'File added to archive',
-            'total_bytes': total_bytes
+            'total_bytes': total_bytes,
+            'digests': digests if digests else {}
         }
         return self._response
 
-    def archive_working_response(self, start_response):
+    def digest_mismatch(self, start_response, expected, digests):
+        """Response when the file written doesn't match the digests sent."""
+        start_response('400 Bad Request', [('Content-Type', 'application/json')])
+        self._response = {
+            'message': 'File digest mismatch, file was not added to archive',
+            'expected_digests': expected,
+            'digests': digests
+        }
+        return self._response
+
+    def archive_working_response(self, start_response, status_cache=None):
         """Response when doing a get on /."""
         start_response('200 OK', [('Content-Type', 'application/json')])
         self._response = {
             'message': 'Pacifica Archive Interface Up and Running'
         }
+        if status_cache is not None:
+            self._response['status_cache'] = status_cache
+        return self._response
+
+    def metrics(self, start_response, exposition):
+        """Response with the metrics in the Prometheus text format."""
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        self._response = exposition
+        return self._response
+
+    def range_not_satisfiable(self, start_response, filesize):
+        """Response for when none of the requested ranges are in the file."""
+        start_response('416 Requested Range Not Satisfiable', [
+            ('Content-Type', 'application/json'),
+            ('Content-Range', 'bytes */{}'.format(filesize))
+        ])
+        self._response = {
+            'message': 'Requested range not satisfiable',
+            'total_bytes': filesize
+        }
         return self._response
 
     def file_stage(self, start_response, filename):
@@ -59,7 +95,80 @@ class Responses(object):
         }
         return self._response
 
-    def file_status(self, start_response, status):
+    def bundle(self, start_response, content_type, bundle_format, length, content):
+        """Response streaming a bundle of files."""
+        start_response('200 OK', [
+            ('Content-Type', content_type),
+            ('Content-Length', str(length)),
+            ('Content-Disposition', 'attachment; filename="bundle.{}"'.format(bundle_format))
+        ])
+        self._response = ''
+        return content
+
+    def bundle_manifest(self, start_response, results, error=None):
+        """Response with the result of each file in an uploaded bundle.
+
+        Created if every file was added, otherwise the results say
+        which files were not.
+        """
+        added = len([result for result in results if 'digests' in result])
+        failed = len([result for result in results if result['message'].startswith('Error')])
+        if error or failed:
+            start_response('200 OK', [('Content-Type', 'application/json')])
+        else:
+            start_response('201 Created', [('Content-Type', 'application/json')])
+        self._response = {
+            'message': error if error else 'Bundle added to archive',
+            'added': added,
+            'failed': failed,
+            'files': results
+        }
+        return self._response
+
+    def bundle_files_not_found(self, start_response, missing):
+        """Response for when files asked for in a bundle don't exist."""
+        start_response('404 Not Found', [('Content-Type', 'application/json')])
+        self._response = {
+            'message': 'Files not found',
+            'files': missing
+        }
+        return self._response
+
+    def stage_job_accepted(self, start_response, report, location):
+        """Response for when files were queued to be staged, polled at location."""
+        start_response('202 Accepted', [
+            ('Content-Type', 'application/json'),
+            ('Location', location),
+            ('Preference-Applied', 'respond-async')
+        ])
+        self._response = report
+        return self._response
+
+    def unknown_endpoint(self, start_response, path_info):
+        """Response for when a reserved path isn't one of the endpoints."""
+        start_response('404 Not Found', [('Content-Type', 'application/json')])
+        self._response = {
+            'message': 'Unknown endpoint',
+            'path': path_info
+        }
+        return self._response
+
+    def stage_job_status(self, start_response, report):
+        """Response with the progress of a stage job."""
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        self._response = report
+        return self._response
+
+    def stage_job_not_found(self, start_response, job_id):
+        """Response for when the stage job is unknown."""
+        start_response('404 Not Found', [('Content-Type', 'application/json')])
+        self._response = {
+            'message': 'Stage job not found',
+            'job': job_id
+        }
+        return self._response
+
+    def file_status(self, start_response, status, etag=None):
         """Response for when file is on the hpss system."""
         self._response = ''
         if status:
@@ -73,6 +182,10 @@ class Responses(object):
                 ('X-Pacifica-File-Storage-Media', str(status.file_storage_media)),
                 ('Content-Type', 'application/json')
             ]
+            if etag:
+                response_headers.append(('ETag', etag))
+            if status.digests:
+                response_headers.append(('Digest', get_http_digest_header(status.digests)))
             start_response('204 No Content', response_headers)
         else:
             response_headers = [
@@ -88,6 +201,26 @@ class Responses(object):
             start_response('404 Not Found', response_headers)
         return self._response
 
+    def file_status_list(self, start_response, statuses):
+        """Response with the status of many files.
+
+        The statuses are (filename, status) pairs and are streamed out
+        as a JSON list while the backend looks them up.
+        """
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        self._response = ''
+        return _status_list_body(statuses)
+
+    def not_modified(self, start_response, validators):
+        """Response for when the client already has the current file.
+
+        The validators are the ETag and other cache headers a full
+        response would have carried. There is no body.
+        """
+        start_response('304 Not Modified', validators)
+        self._response = ''
+        return []
+
     def archive_exception(self, start_response, ex, request_method=None):
         """Response when unknown exception occurs."""
         if request_method == 'HEAD':
@@ -111,3 +244,32 @@ class Responses(object):
                 'message': str(ex)
             }
         return self._response
+
+
+def _status_list_body(statuses):
+    """Yield the JSON list of statuses a piece at a time."""
+    yield '['
+    separator = ''
+    for filename, status in statuses:
+        yield separator + dumps(_status_entry(filename, status), sort_keys=True)
+        separator = ','
+    yield ']'
+
+
+def _status_entry(filename, status):
+    """Return the JSON entry for one file's status."""
+    if status is None:
+        return {'file': filename, 'message': 'File Not found'}
+    if isinstance(status, Exception):
+        return {'file': filename, 'message': 'Error: ' + str(status)}
+    return {
+        'file': filename,
+        'message': 'File was found',
+        'filepath': str(status.filepath),
+        'filesize': status.filesize,
+        'mtime': status.mtime,
+        'ctime': status.ctime,
+        'bytes_per_level': list(status.bytes_per_level),
+        'file_storage_media': status.file_storage_media,
+        'digests': status.digests or {}
+    }
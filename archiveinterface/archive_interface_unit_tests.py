@@ -4,13 +4,53 @@
 import unittest
 import time
 import os
+import json
+import errno
+import socket
+import hashlib
+import signal
+import shutil
+import tarfile
+import zipfile
+import peewee
+from base64 import b64encode
+from ctypes import c_void_p
+from threading import Thread
+from urllib2 import urlopen
+from httplib import HTTPConnection
+from wsgiref.util import FileWrapper
+from StringIO import StringIO
 from stat import ST_MODE
-from archiveinterface.archive_utils import un_abs_path, get_http_modified_time, read_config_value, set_config_name
+from archiveinterface.archive_utils import un_abs_path, get_http_modified_time, read_config_value, set_config_name, \
+    get_http_byte_ranges, get_http_date, get_http_digests, get_http_digest_header, get_config
+from archiveinterface.archive_interface import ArchiveInterfaceGenerator, REQUEST_METRICS
+from archiveinterface import archive_server
+from archiveinterface.archive_server import make_archive_server, make_pooled_server, reload_on_hangup, \
+    PreforkServer
+from archiveinterface.async_server import AsyncArchiveServer
+from archiveinterface.status_cache import StatusCache
+from archiveinterface import stage_executor
+from archiveinterface.stage_executor import StageExecutor, StageJob
+from archiveinterface.metrics import Metrics, METRICS, BYTES_WRITTEN, REQUESTS_IN_FLIGHT, InstrumentedFile
+from archiveinterface.access_log import AccessLog
 from archiveinterface.id2filename import id2filename
 from archiveinterface.archivebackends.posix.extendedfile import ExtendedFile
 from archiveinterface.archivebackends.posix.posix_status import PosixStatus
+from archiveinterface.archivebackends.posix.extended_attributes import read_digests
 from archiveinterface.archivebackends.posix.posix_backend_archive import PosixBackendArchive
+from archiveinterface.archivebackends.posix import durable
+from archiveinterface.archivebackends.posix.durable import GroupCommit, temp_path
+from archiveinterface.archivebackends.handle_pool import HandlePool
+from archiveinterface.archivebackends.directory_cache import DirectoryCache, DIRECTORY_CACHE
+from archiveinterface.archivebackends.hpss.hpss_simulator import HpssSimulator, HpssSimulatorBackendArchive
+from archiveinterface.archivebackends.hpss.hpss_extended import CoreMonitor, make_directories, \
+    check_credentials
+from archiveinterface.archivebackends.hpss.hpss_session import HpssSession, is_auth_error
+from archiveinterface.archivebackends.oracle_hms_sideband import hms_sideband_orm
+from archiveinterface.archivebackends.oracle_hms_sideband.hms_sideband_orm import SamInode
+from archiveinterface.archivebackends.oracle_hms_sideband.extended_hms_sideband import sam_qfs_status
 from archiveinterface.archive_interface_error import ArchiveInterfaceError
+from benchmarks.run_benchmarks import run_benchmarks, compare
 
 
 class TestArchiveUtils(unittest.TestCase):
@@ -167,11 +207,13 @@ class TestPosixBackendArchive(unittest.TestCase):
         self.assertTrue(isinstance(my_file, PosixBackendArchive))
         # easiest way to unit test is look at class variable
         # pylint: disable=protected-access
-        self.assertTrue(isinstance(backend._file, ExtendedFile))
+        self.assertTrue(isinstance(my_file._file, ExtendedFile))
+        self.assertEqual(backend._file, None)
         # pylint: enable=protected-access
         my_file.close()
         # opening twice in a row is okay
         my_file = backend.open(filepath, mode)
+        my_file.close()
         my_file = backend.open(filepath, mode)
 
         # force a close to throw an error
@@ -180,19 +222,21 @@ class TestPosixBackendArchive(unittest.TestCase):
             raise ArchiveInterfaceError('this is an error')
         # function of testing
         # pylint: disable=protected-access
-        orig_close = backend._file.close
-        backend._file.close = close_error
+        orig_close = my_file._file.close
+        my_file._file.close = close_error
         # pylint: enable=protected-access
         hit_exception = False
         try:
-            my_file = backend.open(filepath, mode)
+            my_file.close()
         except ArchiveInterfaceError:
             hit_exception = True
         self.assertTrue(hit_exception)
         # function of testing
         # pylint: disable=protected-access
-        backend._file.close = orig_close
+        my_file._file.close = orig_close
+        self.assertEqual(backend._pool.in_use(), 0)
         # pylint: enable=protected-access
+        my_file.close()
         hit_exception = False
         try:
             my_file = backend.open(47, mode)
@@ -202,11 +246,72 @@ class TestPosixBackendArchive(unittest.TestCase):
         self.assertTrue(hit_exception)
 
         my_file = backend.open('/a/b/d', mode)
+        my_file.close()
         set_config_name('test_configs/posix-id2filename.cfg')
         backend = PosixBackendArchive('/tmp')
         my_file = backend.open(12345, mode)
+        my_file.close()
         set_config_name('config.cfg')
 
+    def test_posix_backend_independent_handles(self):
+        """Test two open handles from one backend do not interfere."""
+        backend = PosixBackendArchive('/tmp/')
+        first = backend.open('1240', 'w')
+        second = backend.open('1241', 'w')
+        first.write('first file')
+        second.write('second file')
+        first.close()
+        second.write(' still open')
+        second.close()
+        first = backend.open('1240', 'r')
+        second = backend.open('1241', 'r')
+        self.assertEqual(second.read(-1), 'second file still open')
+        self.assertEqual(first.read(-1), 'first file')
+        first.close()
+        second.close()
+
+    def test_posix_backend_handle_pool(self):
+        """Test the backend bounds the number of open handles."""
+        backend = PosixBackendArchive('/tmp/')
+        # pylint: disable=protected-access
+        backend._pool = HandlePool(1, 0.01)
+        # pylint: enable=protected-access
+        my_file = backend.open('1234', 'w')
+        with self.assertRaises(ArchiveInterfaceError) as context:
+            backend.open('1235', 'w')
+        self.assertTrue('Timed out waiting' in str(context.exception))
+        my_file.close()
+        # closing twice only gives the context back once
+        my_file.close()
+        my_file = backend.open('1235', 'w')
+        my_file.close()
+        # failing to open gives the context back
+        with self.assertRaises(ArchiveInterfaceError):
+            backend.open(47, 'w')
+        my_file = backend.open('1235', 'w')
+        my_file.close()
+
+    def test_handle_pool_reuse(self):
+        """Test the handle pool reuses released contexts."""
+        created = []
+
+        def factory():
+            """Build a new context."""
+            created.append(object())
+            return created[-1]
+        pool = HandlePool(2, None, factory)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertTrue(pool.acquire() is first)
+        second = pool.acquire()
+        self.assertEqual(len(created), 2)
+        self.assertEqual(pool.in_use(), 2)
+        pool.release(second)
+        pool.discard()
+        self.assertEqual(pool.in_use(), 0)
+        with self.assertRaises(ArchiveInterfaceError):
+            HandlePool(0)
+
     def test_posix_backend_close(self):
         """Test closing a file from posix backend."""
         filepath = '1234'
@@ -215,9 +320,9 @@ class TestPosixBackendArchive(unittest.TestCase):
         my_file = backend.open(filepath, mode)
         # easiest way to unit test is look at class variable
         # pylint: disable=protected-access
-        self.assertTrue(isinstance(backend._file, ExtendedFile))
+        self.assertTrue(isinstance(my_file._file, ExtendedFile))
         my_file.close()
-        self.assertEqual(backend._file, None)
+        self.assertEqual(my_file._file, None)
         # pylint: enable=protected-access
 
     def test_posix_backend_write(self):
@@ -260,22 +365,144 @@ class TestPosixBackendArchive(unittest.TestCase):
         mode = 'w'
         backend = PosixBackendArchive('/tmp/')
         # test failed write
-        backend.open(filepath, mode)
+        my_file = backend.open(filepath, mode)
 
         def write_error():
             """Raise an error on write."""
             raise IOError('Unable to Write!')
         # easiest way to unit test is look at class variable
         # pylint: disable=protected-access
-        backend._file.write = write_error
+        my_file._file.write = write_error
         # pylint: enable=protected-access
         hit_exception = False
         try:
-            backend.write('write stuff')
+            my_file.write('write stuff')
         except ArchiveInterfaceError as ex:
             hit_exception = True
             self.assertTrue("Can't write posix file with error" in str(ex))
         self.assertTrue(hit_exception)
+        my_file.close()
+
+    def test_posix_backend_durable_write(self):
+        """Test durable writes only appear at the final path once committed."""
+        set_config_name('test_configs/posix-durable.cfg')
+        try:
+            backend = PosixBackendArchive('/tmp/durable/')
+            for name in os.listdir('/tmp/durable') if os.path.isdir('/tmp/durable') else []:
+                os.chmod(os.path.join('/tmp/durable', name), 0644)
+                os.unlink(os.path.join('/tmp/durable', name))
+            my_file = backend.open('1234', 'w')
+            my_file.write('durable data')
+            self.assertFalse(os.path.exists('/tmp/durable/1234'))
+            my_file.close()
+            with open('/tmp/durable/1234') as fdesc:
+                self.assertEqual(fdesc.read(), 'durable data')
+            my_file.set_file_permissions()
+            # archived files can't be replaced
+            with self.assertRaises(ArchiveInterfaceError) as context:
+                backend.open('1234', 'w')
+            self.assertTrue("Can't open" in str(context.exception))
+            # a discarded write leaves nothing behind
+            my_file = backend.open('1235', 'w')
+            my_file.write('partial')
+            my_file.discard()
+            self.assertEqual(os.listdir('/tmp/durable'), ['1234'])
+        finally:
+            set_config_name('config.cfg')
+
+    def test_group_commit(self):
+        """Test concurrent commits are flushed together."""
+        committer = GroupCommit(0.05)
+        if not os.path.isdir('/tmp/group'):
+            os.makedirs('/tmp/group')
+
+        def commit(name):
+            """Write and commit one file."""
+            filepath = os.path.join('/tmp/group', name)
+            temp_filepath = temp_path(filepath)
+            with open(temp_filepath, 'w') as fdesc:
+                fdesc.write(name)
+                fdesc.flush()
+                committer.commit(fdesc, temp_filepath, filepath)
+        threads = [Thread(target=commit, args=(str(num),)) for num in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(committer.batches < 8)
+        for num in range(8):
+            with open(os.path.join('/tmp/group', str(num))) as fdesc:
+                self.assertEqual(fdesc.read(), str(num))
+        self.assertEqual(len(os.listdir('/tmp/group')), 8)
+
+    def test_group_commit_syncs(self):
+        """Test a batch syncs each file and directory once, or each filesystem if asked."""
+        if not os.path.isdir('/tmp/group_syncs'):
+            os.makedirs('/tmp/group_syncs')
+        self.assertEqual(self.flush_batch(GroupCommit()), {'datasync': 8, 'fsync': 1, 'syncfs': 0})
+        # pylint: disable=protected-access
+        if durable._SYNCFS is None:
+            self.skipTest('no syncfs on this platform')
+        # pylint: enable=protected-access
+        self.assertEqual(self.flush_batch(GroupCommit(use_syncfs=True)), {'datasync': 0, 'fsync': 1, 'syncfs': 1})
+
+    def flush_batch(self, committer):
+        """Flush a batch of files with the committer and return the syncs made."""
+        calls = {'datasync': 0, 'fsync': 0, 'syncfs': 0}
+        orig_fsync = os.fsync
+        orig_datasync = durable.datasync
+        orig_syncfs = durable.syncfs
+
+        def counted(name, sync):
+            """Return sync counting its calls under name."""
+            def counted_sync(fdesc):
+                """Count the call and sync."""
+                calls[name] += 1
+                return sync(fdesc)
+            return counted_sync
+        os.fsync = counted('fsync', orig_fsync)
+        durable.datasync = counted('datasync', orig_datasync)
+        durable.syncfs = counted('syncfs', orig_syncfs)
+        files = []
+        try:
+            for num in range(8):
+                filepath = os.path.join('/tmp/group_syncs', 'sync{}'.format(num))
+                files.append((open(temp_path(filepath), 'w'), filepath))
+            # pylint: disable=protected-access
+            committer._flush([durable._PendingCommit(fdesc, fdesc.name, filepath) for fdesc, filepath in files])
+            # pylint: enable=protected-access
+        finally:
+            os.fsync = orig_fsync
+            durable.datasync = orig_datasync
+            durable.syncfs = orig_syncfs
+            for fdesc, _ in files:
+                fdesc.close()
+        for num in range(8):
+            filepath = os.path.join('/tmp/group_syncs', 'sync{}'.format(num))
+            self.assertTrue(os.path.isfile(filepath))
+            os.unlink(filepath)
+        return calls
+
+    def test_directory_cache(self):
+        """Test known directories aren't made again until they go missing."""
+        made = []
+        cache = DirectoryCache(2)
+        for dirname in ('/a', '/a', '/b', '/c', '/a'):
+            cache.makedirs(dirname, made.append)
+        self.assertEqual(made, ['/a', '/b', '/c', '/a'])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        cache.invalidate('/a')
+        cache.makedirs('/a', made.append)
+        self.assertEqual(made[-1], '/a')
+        # a posix directory removed behind the cache fails once then is made again
+        if os.path.isdir('/tmp/cached'):
+            shutil.rmtree('/tmp/cached')
+        backend = PosixBackendArchive('/tmp/cached')
+        backend.open('1234', 'w').close()
+        shutil.rmtree('/tmp/cached')
+        self.assertRaises(ArchiveInterfaceError, backend.open, '1234', 'w')
+        backend.open('1234', 'w').close()
+        self.assertTrue(os.path.isfile('/tmp/cached/1234'))
 
     def test_posix_backend_read(self):
         """Test reading a file from posix backend."""
@@ -307,6 +534,1165 @@ class TestPosixBackendArchive(unittest.TestCase):
             self.assertEqual('Error reading config file, no field: bad_field in section: hms_sideband',
                              context.exception)
 
+    def test_config_reload(self):
+        """Test the config is parsed once and swapped on SIGHUP."""
+        config_text = '[archiveinterface]\ndigests = {}\n[posix]\nuse_id2filename = false\n'
+        with open('/tmp/archivei-reload.cfg', 'w') as config_file:
+            config_file.write(config_text.format('sha1'))
+        set_config_name('/tmp/archivei-reload.cfg')
+        try:
+            config = get_config()
+            generator = ArchiveInterfaceGenerator(PosixBackendArchive('/tmp/'))
+            with open('/tmp/archivei-reload.cfg', 'w') as config_file:
+                config_file.write(config_text.format('md5'))
+            self.assertTrue(get_config() is config)
+            self.assertEqual(read_config_value('archiveinterface', 'digests'), 'sha1')
+            reload_on_hangup()
+            os.kill(os.getpid(), signal.SIGHUP)
+            self.assertFalse(get_config() is config)
+            self.assertEqual(read_config_value('archiveinterface', 'digests'), 'md5')
+            if os.path.exists('/tmp/5021'):
+                os.unlink('/tmp/5021')
+            env = {'REQUEST_METHOD': 'PUT', 'PATH_INFO': '/5021', 'QUERY_STRING': '',
+                   'wsgi.input': StringIO('reloaded'), 'CONTENT_LENGTH': '8'}
+            body = ''.join(generator.pacifica_archiveinterface(env, lambda status, headers: None))
+            self.assertEqual(json.loads(body)['digests'].keys(), ['md5'])
+        finally:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            set_config_name('config.cfg')
+
+
+class TestArchiveInterfaceGenerator(unittest.TestCase):
+    """Test the archive interface generator with a posix backend."""
+
+    def setUp(self):
+        """Create a generator in front of a posix backend."""
+        self.generator = ArchiveInterfaceGenerator(PosixBackendArchive('/tmp/'))
+        self.status = None
+        self.headers = None
+
+    def start_response(self, status, headers):
+        """Save the status and headers sent back."""
+        self.status = status
+        self.headers = dict(headers)
+
+    def request(self, method, path, data=None, query='', **headers):
+        """Send a request to the generator and return the body."""
+        env = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query}
+        if data is not None:
+            env['wsgi.input'] = StringIO(data)
+            env['CONTENT_LENGTH'] = str(len(data))
+        for key, value in headers.items():
+            env['HTTP_' + key.upper()] = value
+        return ''.join(self.generator.pacifica_archiveinterface(env, self.start_response))
+
+    def write_file(self, path, data):
+        """Write a file into the archive, removing any old copy."""
+        filename = os.path.join('/tmp', un_abs_path(path))
+        if os.path.exists(filename):
+            os.unlink(filename)
+        self.request('PUT', path, data)
+        self.assertEqual(self.status, '201 Created')
+
+    def test_get_file(self):
+        """Test reading a whole file back."""
+        self.write_file('/5000', 'Writing content for first file')
+        body = self.request('GET', '/5000')
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(self.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(body, 'Writing content for first file')
+
+    def test_get_file_wrapper(self):
+        """Test a GET through the server's wsgi.file_wrapper is recorded once closed."""
+        self.write_file('/5003', 'Writing content for first file')
+        for file_wrapper in (lambda filelike, blksize: filelike, FileWrapper):
+            env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/5003', 'QUERY_STRING': '',
+                   'wsgi.file_wrapper': file_wrapper}
+            result = self.generator.pacifica_archiveinterface(env, self.start_response)
+            self.assertEqual(self.status, '200 OK')
+            if file_wrapper is FileWrapper:
+                self.assertTrue(isinstance(result, FileWrapper))
+                filelike = result.filelike
+            else:
+                self.assertTrue(isinstance(result, InstrumentedFile))
+                filelike = result
+            # the server can still send the file from its descriptor
+            self.assertEqual(os.fstat(filelike.fileno()).st_size, 30)
+            self.assertEqual(''.join(result), 'Writing content for first file')
+            # pylint: disable=protected-access
+            self.assertFalse(env[REQUEST_METRICS]._finished)
+            result.close()
+            self.assertTrue(env[REQUEST_METRICS]._finished)
+            # pylint: enable=protected-access
+
+    def test_get_single_range(self):
+        """Test reading part of a file back."""
+        self.write_file('/5001', 'Writing content for first file')
+        body = self.request('GET', '/5001', range='bytes=8-14')
+        self.assertEqual(self.status, '206 Partial Content')
+        self.assertEqual(body, 'content')
+        self.assertEqual(self.headers['Content-Range'], 'bytes 8-14/30')
+        self.assertEqual(self.headers['Content-Length'], '7')
+        body = self.request('GET', '/5001', range='bytes=-4')
+        self.assertEqual(body, 'file')
+        body = self.request('GET', '/5001', range='bytes=26-')
+        self.assertEqual(body, 'file')
+
+    def test_get_multiple_ranges(self):
+        """Test reading many parts of a file back."""
+        self.write_file('/5002', 'Writing content for first file')
+        body = self.request('GET', '/5002', range='bytes=0-6,26-29')
+        self.assertEqual(self.status, '206 Partial Content')
+        content_type = self.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        boundary = content_type.split('=', 1)[1]
+        self.assertEqual(len(body), int(self.headers['Content-Length']))
+        parts = body.split('--' + boundary)
+        self.assertEqual(len(parts), 4)
+        self.assertTrue('Content-Range: bytes 0-6/30\r\n\r\nWriting\r\n' in parts[1])
+        self.assertTrue('Content-Range: bytes 26-29/30\r\n\r\nfile\r\n' in parts[2])
+        self.assertEqual(parts[3], '--\r\n')
+
+    def test_get_bad_ranges(self):
+        """Test ranges that can't or shouldn't be honored."""
+        self.write_file('/5003', 'Writing content for first file')
+        self.request('GET', '/5003', range='bytes=40-50')
+        self.assertEqual(self.status, '416 Requested Range Not Satisfiable')
+        self.assertEqual(self.headers['Content-Range'], 'bytes */30')
+        body = self.request('GET', '/5003', range='bytes=foo')
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(len(body), 30)
+        body = self.request('GET', '/5003', range='bytes=0-6',
+                            if_range='Sun, 06 Nov 1994 08:49:37 GMT')
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(len(body), 30)
+
+    def test_get_if_range(self):
+        """Test the range is honored when If-Range matches."""
+        self.write_file('/5004', 'Writing content for first file')
+        mtime = os.path.getmtime('/tmp/5004')
+        body = self.request('GET', '/5004', range='bytes=0-6',
+                            if_range=get_http_date(mtime))
+        self.assertEqual(self.status, '206 Partial Content')
+        self.assertEqual(body, 'Writing')
+
+    def test_get_cache_headers(self):
+        """Test GET sends validators and cache headers."""
+        self.write_file('/5005', 'Writing content for first file')
+        self.request('GET', '/5005')
+        self.assertEqual(self.headers['Content-Length'], '30')
+        self.assertTrue('immutable' in self.headers['Cache-Control'])
+        self.assertEqual(self.headers['Last-Modified'], get_http_date(os.path.getmtime('/tmp/5005')))
+        etag = self.headers['ETag']
+        self.request('HEAD', '/5005')
+        self.assertEqual(self.status, '204 No Content')
+        self.assertEqual(self.headers['ETag'], etag)
+        body = self.request('GET', '/5005', range='bytes=0-6', if_range=etag)
+        self.assertEqual(body, 'Writing')
+        body = self.request('GET', '/5005', range='bytes=0-6', if_range='"stale"')
+        self.assertEqual(len(body), 30)
+
+    def test_conditional_requests(self):
+        """Test conditional GET and HEAD are answered without opening the file."""
+        self.write_file('/5006', 'Writing content for first file')
+        self.request('GET', '/5006')
+        etag = self.headers['ETag']
+        last_modified = self.headers['Last-Modified']
+
+        # pylint: disable=unused-argument
+        def open_error(filepath, mode, request=None):
+            """Fail if the file is opened."""
+            raise ArchiveInterfaceError('opened {} with mode {}'.format(filepath, mode))
+        # pylint: enable=unused-argument
+        # pylint: disable=protected-access
+        self.generator._archive.open = open_error
+        # pylint: enable=protected-access
+        body = self.request('GET', '/5006', if_none_match='"other", ' + etag)
+        self.assertEqual(self.status, '304 Not Modified')
+        self.assertEqual(body, '')
+        self.assertEqual(self.headers['ETag'], etag)
+        self.request('GET', '/5006', if_none_match='*')
+        self.assertEqual(self.status, '304 Not Modified')
+        self.request('GET', '/5006', if_modified_since=last_modified)
+        self.assertEqual(self.status, '304 Not Modified')
+        self.request('HEAD', '/5006', if_none_match=etag)
+        self.assertEqual(self.status, '304 Not Modified')
+        self.request('HEAD', '/5006', if_none_match='"other"')
+        self.assertEqual(self.status, '204 No Content')
+        self.request('GET', '/5006', if_modified_since='Sun, 06 Nov 1994 08:49:37 GMT')
+        self.assertEqual(self.status, '500 Internal Server Error')
+
+    def test_put_digests(self):
+        """Test PUT computes, checks and stores the file's digests."""
+        data = 'Writing content for first file'
+        filename = '/tmp/5007'
+        if os.path.exists(filename):
+            os.unlink(filename)
+        content_md5 = b64encode(hashlib.md5(data).digest())
+        sha256 = b64encode(hashlib.sha256(data).digest())
+        body = self.request('PUT', '/5007', data, content_md5=content_md5, digest='SHA-256=' + sha256)
+        self.assertEqual(self.status, '201 Created')
+        digests = json.loads(body)['digests']
+        self.assertEqual(digests['sha1'], hashlib.sha1(data).hexdigest())
+        self.assertEqual(digests['md5'], hashlib.md5(data).hexdigest())
+        self.assertEqual(digests['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(read_digests(filename), digests)
+        self.request('HEAD', '/5007')
+        self.assertTrue('sha-256=' + sha256 in self.headers['Digest'])
+        self.assertTrue('md5=' + content_md5 in self.headers['Digest'])
+        self.request('GET', '/5007')
+        self.assertTrue('sha=' + b64encode(hashlib.sha1(data).digest()) in self.headers['Digest'])
+
+    def test_put_digest_mismatch(self):
+        """Test a PUT that doesn't match its digest is not kept."""
+        filename = '/tmp/5008'
+        if os.path.exists(filename):
+            os.unlink(filename)
+        body = self.request('PUT', '/5008', 'Writing content for first file',
+                            content_md5=b64encode(hashlib.md5('something else').digest()))
+        self.assertEqual(self.status, '400 Bad Request')
+        self.assertEqual(json.loads(body)['expected_digests'].keys(), ['md5'])
+        self.assertFalse(os.path.exists(filename))
+        self.request('PUT', '/5008', 'Writing content for first file', digest='sha=not base64')
+        self.assertEqual(self.status, '500 Internal Server Error')
+
+    def test_put_short_body(self):
+        """Test a PUT whose body ends early fails instead of hanging."""
+        env = {'REQUEST_METHOD': 'PUT', 'PATH_INFO': '/5009',
+               'wsgi.input': StringIO('short'), 'CONTENT_LENGTH': '30'}
+        body = ''.join(self.generator.pacifica_archiveinterface(env, self.start_response))
+        self.assertEqual(self.status, '500 Internal Server Error')
+        self.assertTrue('25 bytes short' in json.loads(body)['message'])
+
+    def test_status_many(self):
+        """Test the status of many files is returned in one request."""
+        self.write_file('/5008', 'first')
+        self.write_file('/5009', 'second file')
+        if os.path.exists('/tmp/5010'):
+            os.unlink('/tmp/5010')
+        body = self.request('POST', '/_/status', json.dumps(['5008', 5009, '5010']))
+        self.assertEqual(self.status, '200 OK')
+        statuses = json.loads(body)
+        self.assertEqual([status['file'] for status in statuses], ['5008', '5009', '5010'])
+        self.assertEqual(statuses[0]['filesize'], 5)
+        self.assertEqual(statuses[1]['filesize'], 11)
+        self.assertEqual(statuses[1]['file_storage_media'], 'disk')
+        self.assertEqual(statuses[1]['digests']['sha1'], hashlib.sha1('second file').hexdigest())
+        self.assertEqual(statuses[2]['message'], 'File Not found')
+        self.request('POST', '/_/status', json.dumps({'files': ['5008']}))
+        self.assertEqual(self.status, '500 Internal Server Error')
+
+    def test_stage_jobs(self):
+        """Test files are staged in the background and the job polled."""
+        self.write_file('/5011', 'stage me')
+        if os.path.exists('/tmp/5012'):
+            os.unlink('/tmp/5012')
+        body = self.request('POST', '/_/stage', json.dumps([5011, '5012']))
+        self.assertEqual(self.status, '202 Accepted')
+        job_id = json.loads(body)['job']
+        self.assertEqual(self.headers['Location'], '/_/jobs/' + job_id)
+        # pylint: disable=protected-access
+        self.generator._stager.join()
+        # pylint: enable=protected-access
+        report = json.loads(self.request('GET', '/_/jobs/' + job_id))
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(report['state'], 'error')
+        self.assertEqual(report['counts']['staged'], 1)
+        self.assertEqual([entry['state'] for entry in report['files']], ['staged', 'error'])
+        self.assertTrue("Can't open" in report['files'][1]['message'])
+        # another worker process sharing the job directory answers the poll too
+        # pylint: disable=protected-access
+        other_worker = StageExecutor(None, directory=self.generator._stager._directory)
+        # pylint: enable=protected-access
+        self.assertEqual(other_worker.job_report(job_id), report)
+        self.assertEqual(other_worker.job_report('../' + job_id), None)
+        body = self.request('POST', '/5011', prefer='respond-async')
+        self.assertEqual(self.status, '202 Accepted')
+        # pylint: disable=protected-access
+        self.generator._stager.join()
+        # pylint: enable=protected-access
+        report = json.loads(self.request('GET', '/_/jobs/' + json.loads(body)['job']))
+        self.assertEqual(report['state'], 'staged')
+        self.request('GET', '/_/jobs/unknown')
+        self.assertEqual(self.status, '404 Not Found')
+        # without the preference a single stage still waits
+        self.request('POST', '/5011')
+        self.assertEqual(self.status, '200 OK')
+
+    def test_stage_job_files(self):
+        """Test job files are written on state changes and orphaned jobs are failed."""
+        directory = '/tmp/archivei-stage-jobs'
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.mkdir(directory)
+        writes = []
+        # pylint: disable=protected-access
+        orig_write = stage_executor._write_job_file
+
+        def count_write(path, report):
+            """Count the writes of job files."""
+            writes.append(report['state'])
+            orig_write(path, report)
+        stage_executor._write_job_file = count_write
+        # pylint: enable=protected-access
+        try:
+            job = StageJob([str(num) for num in range(100)], directory)
+            job.save()
+            for num in range(100):
+                job.update(str(num), 'staging')
+                job.update(str(num), 'staged')
+        finally:
+            # pylint: disable=protected-access
+            stage_executor._write_job_file = orig_write
+            # pylint: enable=protected-access
+        self.assertEqual(writes, ['queued', 'staging', 'staged'])
+        executor = StageExecutor(None, directory=directory)
+        self.assertEqual(executor.job_report(job.job_id), job.report())
+        # a job left staging by a worker process that has exited is failed
+        pid = os.fork()
+        if not pid:
+            job = StageJob(['5016', '5017'], directory)
+            job.update('5016', 'staged')
+            job.update('5017', 'staging')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        StageExecutor(None, directory=directory)
+        reports = [executor.job_report(filename[:-len('.json')]) for filename in os.listdir(directory)]
+        orphaned = [report for report in reports if report['job'] != job.job_id][0]
+        self.assertEqual(orphaned['state'], 'error')
+        self.assertEqual(orphaned['counts'], {'queued': 0, 'staging': 0, 'staged': 1, 'error': 1})
+        self.assertEqual(orphaned['files'][1]['message'], stage_executor.WORKER_EXITED)
+        self.assertEqual(executor.job_report(job.job_id)['state'], 'staged')
+
+    def test_bundle(self):
+        """Test many files are sent back as one tar or zip."""
+        self.write_file('/5013', 'first bundled file')
+        self.write_file('/5014', 'x' * 3000)
+        body = self.request('POST', '/_/bundle', json.dumps(['5013', 5014]))
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(self.headers['Content-Type'], 'application/x-tar')
+        self.assertEqual(int(self.headers['Content-Length']), len(body))
+        bundle = tarfile.open(fileobj=StringIO(body))
+        self.assertEqual(bundle.getnames(), ['5013', '5014'])
+        self.assertEqual(bundle.extractfile('5013').read(), 'first bundled file')
+        self.assertEqual(bundle.extractfile('5014').read(), 'x' * 3000)
+        body = self.request('POST', '/_/bundle', json.dumps(['5013', '5014']), 'format=zip')
+        self.assertEqual(self.headers['Content-Type'], 'application/zip')
+        self.assertEqual(int(self.headers['Content-Length']), len(body))
+        bundle = zipfile.ZipFile(StringIO(body))
+        self.assertEqual(bundle.testzip(), None)
+        self.assertEqual(bundle.read('5013'), 'first bundled file')
+        self.assertEqual(bundle.read('5014'), 'x' * 3000)
+        if os.path.exists('/tmp/5015'):
+            os.unlink('/tmp/5015')
+        body = self.request('POST', '/_/bundle', json.dumps(['5013', '5015']))
+        self.assertEqual(self.status, '404 Not Found')
+        self.assertEqual(json.loads(body)['files'], ['5015'])
+
+    def test_put_bundle(self):
+        """Test the files in an uploaded tar are added to the archive."""
+        for name in ('5016', '5017'):
+            if os.path.exists('/tmp/' + name):
+                os.chmod('/tmp/' + name, 0644)
+                os.unlink('/tmp/' + name)
+        upload = StringIO()
+        bundle = tarfile.open(fileobj=upload, mode='w')
+        for name, data in (('./5016', 'first uploaded'), ('5017', 'second uploaded')):
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mtime = 1000000
+            bundle.addfile(member, StringIO(data))
+        member = tarfile.TarInfo('adir')
+        member.type = tarfile.DIRTYPE
+        bundle.addfile(member)
+        bundle.close()
+        body = self.request('PUT', '/_/bundle', upload.getvalue())
+        self.assertEqual(self.status, '201 Created')
+        manifest = json.loads(body)
+        self.assertEqual((manifest['added'], manifest['failed']), (2, 0))
+        self.assertEqual([result['file'] for result in manifest['files']], ['/5016', '/5017', '/adir'])
+        self.assertEqual(manifest['files'][1]['digests']['sha1'], hashlib.sha1('second uploaded').hexdigest())
+        with open('/tmp/5016') as fdesc:
+            self.assertEqual(fdesc.read(), 'first uploaded')
+        self.assertEqual(os.path.getmtime('/tmp/5017'), 1000000)
+        self.assertEqual(oct(os.stat('/tmp/5017')[ST_MODE])[-3:], '444')
+        # a truncated upload reports which member wasn't added
+        body = self.request('PUT', '/_/bundle', upload.getvalue()[:1024 + 512 + 5])
+        self.assertEqual(self.status, '200 OK')
+        manifest = json.loads(body)
+        self.assertEqual((manifest['added'], manifest['failed']), (1, 1))
+        self.assertTrue('unexpected end of data' in manifest['files'][1]['message'])
+        self.assertTrue("Can't read tar bundle" in manifest['message'])
+
+    def test_put_bundle_refused(self):
+        """Test members escaping the archive, links and devices aren't added."""
+        if os.path.exists('/tmp/5025'):
+            os.chmod('/tmp/5025', 0644)
+            os.unlink('/tmp/5025')
+        upload = StringIO()
+        bundle = tarfile.open(fileobj=upload, mode='w')
+        for name in ('a/../../etc/5025', '..', '/./a/./5025/..'):
+            member = tarfile.TarInfo(name)
+            member.size = 7
+            bundle.addfile(member, StringIO('escaped'))
+        for name, member_type in (('5026', tarfile.SYMTYPE), ('5027', tarfile.LNKTYPE), ('5028', tarfile.CHRTYPE)):
+            member = tarfile.TarInfo(name)
+            member.type = member_type
+            member.linkname = '/etc/passwd'
+            bundle.addfile(member)
+        member = tarfile.TarInfo('_/5029')
+        member.size = 8
+        bundle.addfile(member, StringIO('reserved'))
+        member = tarfile.TarInfo('/./5025')
+        member.size = 4
+        bundle.addfile(member, StringIO('kept'))
+        bundle.close()
+        manifest = json.loads(self.request('PUT', '/_/bundle', upload.getvalue()))
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual((manifest['added'], manifest['failed']), (1, 7))
+        self.assertTrue('reserved' in manifest['files'][-2]['message'])
+        self.assertTrue('.. component' in manifest['files'][0]['message'])
+        self.assertEqual(manifest['files'][-1]['file'], '/5025')
+        for name in ('5026', '5027', '5028'):
+            self.assertFalse(os.path.lexists('/tmp/' + name))
+        with open('/tmp/5025') as fdesc:
+            self.assertEqual(fdesc.read(), 'kept')
+
+    def test_route_prefix(self):
+        """Test files named like the endpoints are files, only /_/ is reserved."""
+        for path in ('/status', '/metrics'):
+            self.write_file(path, 'a file ' + path)
+            self.assertEqual(self.request('GET', path), 'a file ' + path)
+            self.assertEqual(self.status, '200 OK')
+        statuses = json.loads(self.request('POST', '/_/status', json.dumps(['status'])))
+        self.assertEqual(statuses[0]['filesize'], len('a file /status'))
+        self.request('GET', '/_/unknown')
+        self.assertEqual(self.status, '404 Not Found')
+        self.request('PUT', '/_/5029', 'reserved')
+        self.assertEqual(self.status, '404 Not Found')
+        self.assertFalse(os.path.exists('/tmp/_/5029'))
+
+    def test_status_cache(self):
+        """Test statuses are cached until the file is written again."""
+        self.write_file('/5020', 'cache me')
+        self.request('HEAD', '/5020')
+        self.request('HEAD', '/5020')
+        self.assertEqual(self.headers['Content-Length'], '8')
+        stats = json.loads(self.request('GET', '/'))['status_cache']
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+        statuses = json.loads(self.request('POST', '/_/status', json.dumps(['5020'])))
+        self.assertEqual(statuses[0]['filesize'], 8)
+        self.write_file('/5020', 'cache me again')
+        self.request('HEAD', '/5020')
+        self.assertEqual(self.headers['Content-Length'], '14')
+        stats = json.loads(self.request('GET', '/'))['status_cache']
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        # tape statuses expire sooner and the oldest are evicted first
+        cache = StatusCache(2, 60, 0)
+        tape = PosixStatus(036, 035, 15, 15)
+        tape.file_storage_media = 'tape'
+        cache.put('/tape', tape)
+        self.assertEqual(cache.get('/tape'), None)
+        for name in ('/a', '/b', '/c'):
+            cache.put(name, PosixStatus(036, 035, 15, 15))
+        self.assertEqual(cache.get('/a'), None)
+        self.assertEqual(cache.get('/c').filesize, 15)
+        # a status looked up while the file was being written isn't kept
+        generation = cache.generation()
+        cache.invalidate('/d')
+        cache.put('/d', PosixStatus(036, 035, 15, 15), generation)
+        self.assertEqual(cache.get('/d'), None)
+
+    def test_status_cache_writes(self):
+        """Test GET doesn't send a stale length and failed writes forget the status."""
+        self.write_file('/5029', 'cache me')
+        self.request('HEAD', '/5029')
+        # written by another worker, this one's cache doesn't know
+        os.chmod('/tmp/5029', 0644)
+        with open('/tmp/5029', 'w') as fdesc:
+            fdesc.write('written elsewhere')
+        body = self.request('GET', '/5029')
+        self.assertEqual((self.headers['Content-Length'], body), ('17', 'written elsewhere'))
+        self.request('HEAD', '/5029')
+        self.assertEqual(self.headers['Content-Length'], '17')
+        os.chmod('/tmp/5029', 0644)
+        env = {'REQUEST_METHOD': 'PUT', 'PATH_INFO': '/5029',
+               'wsgi.input': StringIO('short'), 'CONTENT_LENGTH': '10'}
+        ''.join(self.generator.pacifica_archiveinterface(env, self.start_response))
+        self.assertEqual(self.status, '500 Internal Server Error')
+        # pylint: disable=protected-access
+        self.assertEqual(self.generator._status_cache.get('/5029'), None)
+        # pylint: enable=protected-access
+
+    def test_metrics(self):
+        """Test request and backend metrics are reported from every process."""
+        def metric(body, line_start):
+            """Return the value of the first line starting with line_start."""
+            for line in body.splitlines():
+                if line.startswith(line_start):
+                    return float(line.split()[-1])
+            return 0.0
+        before = self.request('GET', '/_/metrics')
+        self.write_file('/5022', 'measure me')
+        self.request('GET', '/5022')
+        pid = os.fork()
+        if not pid:
+            METRICS.inc(BYTES_WRITTEN, 1000)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        body = self.request('GET', '/_/metrics')
+        self.assertEqual(self.headers['Content-Type'], 'text/plain; version=0.0.4')
+        self.assertEqual(metric(body, 'archivei_bytes_written_total') - metric(before, 'archivei_bytes_written_total'),
+                         1010)
+        self.assertTrue(metric(body, 'archivei_bytes_read_total') - metric(before, 'archivei_bytes_read_total') >= 10)
+        requests = 'archivei_http_request_duration_seconds_count{method="GET",code="200"}'
+        self.assertEqual(metric(body, requests) - metric(before, requests), 2)
+        writes = 'archivei_backend_operation_duration_seconds_bucket{operation="write",le="+Inf"}'
+        self.assertTrue(metric(body, writes) > metric(before, writes))
+        self.assertEqual(metric(body, 'archivei_http_requests_in_flight'), 1)
+        # the exited process's file was merged with those of other exited processes
+        # pylint: disable=protected-access
+        self.assertFalse(os.path.exists(os.path.join(METRICS._directory, 'metrics_{}.db'.format(pid))))
+        # pylint: enable=protected-access
+
+    def test_metrics_exited_processes(self):
+        """Test the metrics of exited processes are merged and cleared."""
+        directory = '/tmp/archivei-metrics'
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.mkdir(directory)
+        metrics = Metrics(directory)
+        pids = []
+        for _ in range(3):
+            pid = os.fork()
+            if not pid:
+                metrics.inc(BYTES_WRITTEN, 5)
+                metrics.inc(REQUESTS_IN_FLIGHT)
+                os._exit(0)
+            os.waitpid(pid, 0)
+            pids.append(pid)
+        metrics.inc(BYTES_WRITTEN, 2)
+        self.assertEqual(len([name for name in os.listdir(directory) if name.startswith('metrics_')]), 4)
+        metrics.mark_process_dead(pids[0])
+        self.assertFalse(os.path.exists(os.path.join(directory, 'metrics_{}.db'.format(pids[0]))))
+        totals = metrics.collect()
+        self.assertEqual(totals[(BYTES_WRITTEN, ())], 17)
+        self.assertEqual(totals[(REQUESTS_IN_FLIGHT, ())], 0)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         sorted(['exited.db', 'metrics.lock', 'metrics_{}.db'.format(os.getpid())]))
+        metrics.clear()
+        self.assertEqual(metrics.collect()[(BYTES_WRITTEN, ())], 2)
+
+    def test_request_timing(self):
+        """Test the phases of a request are sent back and logged."""
+        if os.path.exists('/tmp/archivei-access.log'):
+            os.unlink('/tmp/archivei-access.log')
+        # pylint: disable=protected-access
+        # the log is off unless the config names one
+        self.assertEqual(self.generator._access_log._filename, '')
+        self.generator._access_log = AccessLog('/tmp/archivei-access.log')
+        self.write_file('/5023', 'time me')
+        self.generator._access_log.join()
+        # pylint: enable=protected-access
+        phases = [timing.split(';')[0] for timing in self.headers['Server-Timing'].split(', ')]
+        for phase in ('open', 'upload', 'write', 'close', 'set_mod_time', 'set_file_permissions', 'total'):
+            self.assertTrue(phase in phases)
+        # error responses to HEAD send 'Error' as the length and are timed too
+        self.request('HEAD', '/5024')
+        self.assertEqual(self.status, '500 Internal Server Error')
+        self.assertEqual(self.headers['Content-Length'], 'Error')
+        self.assertTrue('total' in self.headers['Server-Timing'])
+        with open('/tmp/archivei-access.log') as log_file:
+            entry = json.loads(log_file.readline())
+        self.assertEqual((entry['method'], entry['path'], entry['status']), ('PUT', '/5023', 201))
+        self.assertTrue('upload' in entry['phases_ms'])
+        self.assertTrue(entry['duration_ms'] >= entry['phases_ms']['write'])
+
+    def test_http_digests(self):
+        """Test parsing and formatting the digest headers."""
+        self.assertEqual(get_http_digests({}), {})
+        digests = get_http_digests({'HTTP_DIGEST': 'unknown=abc, MD5=' + b64encode('\x01\x02')})
+        self.assertEqual(digests, {'md5': '0102'})
+        self.assertEqual(get_http_digest_header({'md5': '0102', 'sha1': '03'}), 'md5=AQI=, sha=Aw==')
+
+    def test_http_byte_ranges(self):
+        """Test parsing the Range header."""
+        self.assertEqual(get_http_byte_ranges({}, 10), None)
+        self.assertEqual(get_http_byte_ranges({'HTTP_RANGE': 'lines=1-2'}, 10), None)
+        self.assertEqual(get_http_byte_ranges({'HTTP_RANGE': 'bytes=5-2'}, 10), None)
+        self.assertEqual(get_http_byte_ranges({'HTTP_RANGE': 'bytes=0-3,2-5,8-'}, 10), [(0, 5), (8, 9)])
+        self.assertEqual(get_http_byte_ranges({'HTTP_RANGE': 'bytes=-20'}, 10), [(0, 9)])
+        self.assertEqual(get_http_byte_ranges({'HTTP_RANGE': 'bytes=-0'}, 10), [])
+
+
+class TestArchiveServer(unittest.TestCase):
+    """Test the built in archive interface server."""
+
+    def test_sendfile_get(self):
+        """Test a GET is sent from the file with sendfile."""
+        backend = PosixBackendArchive('/tmp/')
+        if os.path.exists('/tmp/5100'):
+            os.unlink('/tmp/5100')
+        my_file = backend.open('5100', 'w')
+        # pylint: disable=protected-access
+        self.assertEqual(my_file.fileno(), my_file._file.fileno())
+        # pylint: enable=protected-access
+        my_file.write('x' * 3000000)
+        my_file.close()
+        generator = ArchiveInterfaceGenerator(backend)
+        server = make_archive_server('127.0.0.1', 0, generator.pacifica_archiveinterface)
+        calls = []
+        orig_sendfile = archive_server.sendfile
+
+        def count_sendfile(*args):
+            """Count the calls to sendfile."""
+            calls.append(args)
+            return orig_sendfile(*args)
+        archive_server.sendfile = count_sendfile
+        try:
+            thread = Thread(target=server.handle_request)
+            thread.start()
+            resp = urlopen('http://127.0.0.1:{}/5100'.format(server.server_port))
+            data = resp.read()
+            thread.join()
+        finally:
+            archive_server.sendfile = orig_sendfile
+            server.server_close()
+        self.assertEqual(len(data), 3000000)
+        self.assertEqual(resp.info()['Content-Length'], '3000000')
+        self.assertEqual(len(calls), 1)
+        # pylint: disable=protected-access
+        self.assertEqual(backend._pool.in_use(), 0)
+        # pylint: enable=protected-access
+
+    def test_sendfile_offset(self):
+        """Test sendfile copies from the offset given."""
+        with open('/tmp/5101', 'w') as my_file:
+            my_file.write('Writing content for first file')
+        read_end, write_end = socket.socketpair()
+        with open('/tmp/5101') as my_file:
+            sent = archive_server.sendfile(write_end.fileno(), my_file.fileno(), 8, 100)
+        write_end.close()
+        self.assertEqual(sent, 22)
+        self.assertEqual(read_end.recv(100), 'content for first file')
+        read_end.close()
+
+
+    def test_keep_alive(self):
+        """Test the pooled server serves many requests on one connection."""
+        generator = ArchiveInterfaceGenerator(PosixBackendArchive('/tmp/'))
+        server = make_pooled_server('127.0.0.1', 0, generator.pacifica_archiveinterface, 2, 4)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = HTTPConnection('127.0.0.1', server.server_port, timeout=10)
+            conn.request('PUT', '/5102', 'kept alive')
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 201)
+            resp.read()
+            sock = conn.sock
+            conn.request('GET', '/5102')
+            resp = conn.getresponse()
+            self.assertEqual(resp.read(), 'kept alive')
+            conn.request('HEAD', '/5102')
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 204)
+            resp.read()
+            self.assertTrue(conn.sock is sock)
+            # the last request before recycling closes the connection
+            conn.request('GET', '/')
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Connection'), 'close')
+            resp.read()
+            conn.close()
+            # and stops the server once it reaches max requests
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        finally:
+            server.shutdown() if thread.is_alive() else None
+            server.server_close()
+
+    def test_prefork(self):
+        """Test prefork workers serve requests until the master stops."""
+        generator = ArchiveInterfaceGenerator(PosixBackendArchive('/tmp/'))
+        server = PreforkServer('127.0.0.1', 0, generator.pacifica_archiveinterface, 2, 2, 2)
+        pid = os.fork()
+        if not pid:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        try:
+            # more requests than the workers serve before being replaced
+            for _ in range(6):
+                conn = HTTPConnection('127.0.0.1', server.server_port, timeout=10)
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().status, 200)
+                conn.close()
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            # pylint: disable=protected-access
+            server._server.server_close()
+            # pylint: enable=protected-access
+
+    def test_prefork_failing_workers(self):
+        """Test workers failing to start are replaced more slowly until the master gives up."""
+        def fail_to_bind(*args):
+            """Fail like a worker that can't bind its socket."""
+            raise socket.error(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+        orig = (archive_server.make_pooled_server, archive_server.RESPAWN_DELAY, archive_server.MAX_WORKER_FAILURES)
+        handlers = [signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)]
+        archive_server.make_pooled_server = fail_to_bind
+        archive_server.RESPAWN_DELAY = 0.05
+        archive_server.MAX_WORKER_FAILURES = 4
+        try:
+            server = PreforkServer('127.0.0.1', 0, None, 1, reuse_port=True)
+            start = time.time()
+            with self.assertRaises(ArchiveInterfaceError):
+                server.serve_forever()
+            # waited 0.05, 0.1 and 0.2 seconds before the replacements
+            self.assertTrue(time.time() - start >= 0.35)
+        finally:
+            archive_server.make_pooled_server, archive_server.RESPAWN_DELAY, archive_server.MAX_WORKER_FAILURES = orig
+            for signum, handler in zip((signal.SIGTERM, signal.SIGINT, signal.SIGHUP), handlers):
+                signal.signal(signum, handler)
+
+
+class TestAsyncServer(unittest.TestCase):
+    """Test the event loop archive interface server."""
+
+    def setUp(self):
+        """Serve a posix backend from the event loop with tiny buffers."""
+        self.backend = PosixBackendArchive('/tmp/')
+        generator = ArchiveInterfaceGenerator(self.backend)
+        self.server = AsyncArchiveServer('127.0.0.1', 0, generator.pacifica_archiveinterface, 2, 1024)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        """Stop the server."""
+        self.server.server_close()
+
+    def request(self, method, path, data=None):
+        """Send a request to the server and return the response and body."""
+        conn = HTTPConnection('127.0.0.1', self.server.server_port, timeout=10)
+        conn.request(method, path, data)
+        resp = conn.getresponse()
+        body = resp.read()
+        conn.close()
+        return resp, body
+
+    def test_async_put_get(self):
+        """Test files larger than the buffers go through the event loop."""
+        if os.path.exists('/tmp/5200'):
+            os.unlink('/tmp/5200')
+        data = ''.join(chr(num % 251) for num in range(200000))
+        # an idle client doesn't hold up the others
+        idle = socket.create_connection(('127.0.0.1', self.server.server_port))
+        try:
+            resp, body = self.request('PUT', '/5200', data)
+            self.assertEqual(resp.status, 201)
+            self.assertEqual(json.loads(body)['total_bytes'], str(len(data)))
+            resp, body = self.request('GET', '/5200')
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(body, data)
+            resp, body = self.request('HEAD', '/5200')
+            self.assertEqual(resp.status, 204)
+            self.assertEqual(body, '')
+            resp, body = self.request('GET', '/5200/missing')
+            self.assertEqual(resp.status, 500)
+        finally:
+            idle.close()
+        # pylint: disable=protected-access
+        self.assertEqual(self.backend._pool.in_use(), 0)
+        # pylint: enable=protected-access
+
+
+class TestHpssSimulator(unittest.TestCase):
+    """Test the hpss backend against the simulated hpss."""
+
+    def setUp(self):
+        """Create a generator in front of an hpss backend on a tape only simulator."""
+        self.root = '/tmp/archivei-hpss'
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        DIRECTORY_CACHE.clear()
+        self.simulator = HpssSimulator(self.root, recall_delay=0.05, residency='1')
+        self.backend = HpssSimulatorBackendArchive('/archive', self.simulator)
+        self.generator = ArchiveInterfaceGenerator(self.backend)
+        self.status = None
+
+    def start_response(self, status, headers):
+        """Save the status sent back."""
+        self.status = status
+
+    def request(self, method, path, data=None):
+        """Send a request to the generator and return the body."""
+        env = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': ''}
+        if data is not None:
+            env['wsgi.input'] = StringIO(data)
+            env['CONTENT_LENGTH'] = str(len(data))
+        return ''.join(self.generator.pacifica_archiveinterface(env, self.start_response))
+
+    def test_hpss_put_get(self):
+        """Test files go through the hpss backend to the local directory."""
+        self.request('PUT', '/12345', 'simulated hpss file')
+        self.assertEqual(self.status, '201 Created')
+        self.assertEqual(self.simulator.logins, 1)
+        self.assertEqual(self.simulator.library.hpss_Fopen.restype, c_void_p)
+        with open(os.path.join(self.root, 'archive/39/3039')) as hpss_file:
+            self.assertEqual(hpss_file.read(), 'simulated hpss file')
+        status = self.backend.stat('/12345')
+        self.assertEqual(status.file_storage_media, 'tape')
+        self.assertEqual(status.bytes_per_level, (0, 19, 0, 0, 0))
+        self.assertEqual(status.digests, {'sha1': hashlib.sha1('simulated hpss file').hexdigest()})
+        # reading a file on tape recalls it to disk first
+        self.assertEqual(self.request('GET', '/12345'), 'simulated hpss file')
+        self.assertEqual(self.simulator.recalls, 1)
+        self.assertEqual(self.backend.stat('/12345').file_storage_media, 'disk')
+        self.request('GET', '/12346')
+        self.assertEqual(self.status, '500 Internal Server Error')
+
+    def test_hpss_stage(self):
+        """Test staging waits for the recall and a slow core server is refused."""
+        self.request('PUT', '/12345', 'staged')
+        start = time.time()
+        self.request('POST', '/12345')
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(self.simulator.levels('/archive/39/3039'), frozenset([0, 1]))
+        self.simulator.core_latency = 0.02
+        # pylint: disable=protected-access
+        self.backend._latency = 0.01
+        # pylint: enable=protected-access
+        self.request('GET', '/12345')
+        self.assertEqual(self.status, '500 Internal Server Error')
+
+    def test_hpss_head(self):
+        """Test the status of a file is one call to the core server."""
+        self.request('PUT', '/12345', 'one lookup')
+        # pylint: disable=protected-access
+        self.generator._status_cache.configure(0, 0, 0)
+        # pylint: enable=protected-access
+        core_calls = self.simulator.core_calls
+        self.request('HEAD', '/12345')
+        self.assertEqual(self.status, '204 No Content')
+        self.assertEqual(self.simulator.core_calls - core_calls, 1)
+        self.request('HEAD', '/12346')
+        self.assertEqual(self.status, '500 Internal Server Error')
+
+    def test_hpss_directory_cache(self):
+        """Test a second file in a directory doesn't make the directory again."""
+        self.request('PUT', '/12345', 'first')
+        core_calls = self.simulator.core_calls
+        self.request('PUT', '/12345', 'second')
+        self.assertEqual(self.status, '201 Created')
+        second_calls = self.simulator.core_calls - core_calls
+        DIRECTORY_CACHE.clear()
+        core_calls = self.simulator.core_calls
+        self.request('PUT', '/12345', 'third')
+        self.assertTrue(self.simulator.core_calls - core_calls > second_calls)
+        # a directory removed behind the cache fails once then is made again
+        shutil.rmtree(os.path.join(self.root, 'archive/39'))
+        self.request('PUT', '/12345', 'fourth')
+        self.assertEqual(self.status, '500 Internal Server Error')
+        self.request('PUT', '/12345', 'fifth')
+        self.assertEqual(self.status, '201 Created')
+
+    def test_hpss_makedirs_race(self):
+        """Test threads making the same new directories at once all succeed."""
+        # pylint: disable=protected-access
+        self.backend._session.login()
+        # pylint: enable=protected-access
+        # each stat and mkdir waits on the core server, so the threads interleave
+        self.simulator.core_latency = 0.01
+        errors = []
+
+        def makedirs():
+            """Make the directories, keeping any error."""
+            try:
+                make_directories('/archive/race/a/b')
+            except ArchiveInterfaceError as ex:
+                errors.append(ex)
+        threads = [Thread(target=makedirs) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'archive/race/a/b')))
+        with open(os.path.join(self.root, 'archive/race/file'), 'w'):
+            pass
+        with self.assertRaises(ArchiveInterfaceError) as context:
+            make_directories('/archive/race/file/c')
+        self.assertTrue('not a directory' in str(context.exception))
+
+    def test_hpss_session(self):
+        """Test logging in lazily, again before expiring and when refused."""
+        logins = []
+        session = HpssSession(lambda: logins.append(os.getpid()), 60, 10)
+        session.login()
+        session.login()
+        self.assertEqual(len(logins), 1)
+        # pylint: disable=protected-access
+        session._pid = None
+        session.login()
+        session._expires = time.time()
+        session.login()
+        # pylint: enable=protected-access
+        self.assertEqual(len(logins), 3)
+        calls = []
+
+        def refused_once():
+            """Fail the first call like hpss refusing stale credentials."""
+            calls.append(None)
+            if len(calls) == 1:
+                raise ArchiveInterfaceError('Error using c extension for hpss exception: Permission denied')
+            return 'done'
+        self.assertEqual(session.run(refused_once), 'done')
+        self.assertEqual(len(logins), 4)
+        # other errors aren't retried
+        self.assertRaises(ArchiveInterfaceError, session.run, un_abs_path, 47)
+        self.assertEqual(len(logins), 4)
+        # the error codes are matched exactly, EEXIST isn't EPERM
+        self.assertFalse(is_auth_error(ArchiveInterfaceError('Unable to mkdir /a: File exists (code: -17)')))
+        self.assertFalse(is_auth_error(ArchiveInterfaceError('Failed During HPSS Fread,return value is: -17')))
+        self.assertTrue(is_auth_error(ArchiveInterfaceError('Unable to mkdir /a: Permission denied (code: -13)')))
+        self.assertTrue(is_auth_error(ArchiveInterfaceError('Failed During HPSS Fread,return value is: -1')))
+        # a permission error on a file while the credentials are good isn't retried
+        session = HpssSession(lambda: logins.append(os.getpid()), 60, 10, lambda: None)
+        del calls[:]
+        self.assertRaises(ArchiveInterfaceError, session.run, refused_once)
+        self.assertEqual((len(logins), len(calls)), (5, 1))
+        # the backend logs in again when the simulator stops accepting its login
+        self.request('PUT', '/12345', 'relogin')
+        self.assertEqual(self.simulator.logins, 1)
+        self.simulator.expire_login()
+        # pylint: disable=protected-access
+        self.generator._status_cache.configure(0, 0, 0)
+        # pylint: enable=protected-access
+        self.request('HEAD', '/12345')
+        self.assertEqual(self.status, '204 No Content')
+        self.assertEqual(self.simulator.logins, 2)
+        # and so does a batch status
+        self.simulator.expire_login()
+        statuses = list(self.backend.status_many(['/12345']))
+        self.assertEqual(statuses[0][1].filesize, 7)
+        self.assertEqual(self.simulator.logins, 3)
+        # the check of the credentials reports the code hpss refused them with
+        self.simulator.expire_login()
+        with self.assertRaises(ArchiveInterfaceError) as context:
+            check_credentials()
+        self.assertTrue('(code: -{})'.format(errno.EACCES) in str(context.exception))
+        self.assertTrue(is_auth_error(context.exception))
+        # an open refused for the credentials logs in again and is retried once
+        self.request('PUT', '/12345', 'relogin')
+        logins = self.simulator.logins
+        self.simulator.expire_login()
+        handle = self.backend.open('/12345', 'r')
+        self.assertEqual(handle.read(7), 'relogin')
+        handle.close()
+        self.assertEqual(self.simulator.logins, logins + 1)
+        # other failures to open carry the return code too
+        with self.assertRaises(ArchiveInterfaceError) as context:
+            self.backend.open('/54321', 'r')
+        self.assertTrue('return value is: -{}'.format(errno.ENOENT) in str(context.exception))
+        self.assertEqual(self.simulator.logins, logins + 1)
+
+    def test_hpss_read_buffer(self):
+        """Test handles read into the buffers of the pool, growing them if needed."""
+        data = ''.join(chr(num % 251) for num in range(3 << 20))
+        self.request('PUT', '/12345', data)
+        handle = self.backend.open('/12345', 'r')
+        # pylint: disable=protected-access
+        buf = handle._context
+        self.assertEqual(handle.read(10), data[:10])
+        self.assertEqual(handle.read(3 << 20), data[10:])
+        self.assertEqual(handle.read(10), '')
+        handle.close()
+        handle = self.backend.open('/12345', 'r')
+        self.assertTrue(handle._context is buf)
+        # pylint: enable=protected-access
+        handle.seek(5)
+        self.assertEqual(handle.read(5), data[5:10])
+        # a failed read is an error, not a count of bytes
+        # pylint: disable=protected-access
+        self.simulator._files[handle._file][0].close()
+        # pylint: enable=protected-access
+        with self.assertRaises(ArchiveInterfaceError) as context:
+            handle.read(5)
+        self.assertTrue('return value is: -{}'.format(errno.EBADF) in str(context.exception))
+        handle.close()
+
+    def test_hpss_core_monitor(self):
+        """Test blocks are transferred without pinging the core server for each."""
+        data = ''.join(chr(num % 251) for num in range(8 << 20))
+        self.request('PUT', '/12345', data)
+        pings = self.simulator.pings
+        self.assertEqual(self.request('GET', '/12345'), data)
+        # the status, open and close and perhaps the monitor, not the 8 blocks
+        self.assertTrue(self.simulator.pings - pings <= 4)
+        monitor = CoreMonitor(60, 0.01)
+        monitor.ping()
+        monitor.check()
+        self.assertTrue(monitor.latency() < 0.01)
+        self.simulator.core_latency = 0.02
+        monitor.ping()
+        self.assertRaises(ArchiveInterfaceError, monitor.check)
+        self.simulator.core_latency = 0
+        monitor.ping()
+        monitor.check()
+        # a late ping, as when the pinging thread can't run, is made by the check
+        pings = self.simulator.pings
+        # pylint: disable=protected-access
+        monitor._last_ping -= 300
+        # pylint: enable=protected-access
+        monitor.check()
+        self.assertEqual(self.simulator.pings - pings, 1)
+        monitor.check()
+        self.assertEqual(self.simulator.pings - pings, 1)
+        self.simulator.core_latency = 0.02
+        # pylint: disable=protected-access
+        monitor._last_ping -= 300
+        # pylint: enable=protected-access
+        self.assertRaises(ArchiveInterfaceError, monitor.check)
+
+
+class FakeSidebandConnection(object):
+    """Driver connection to a sideband database that fails every query."""
+
+    def __init__(self):
+        """Open the connection."""
+        self.closed = False
+
+    def cursor(self):
+        """Return this, queries run on the connection."""
+        return self
+
+    @staticmethod
+    def execute(sql, params):
+        """Fail the query."""
+        raise ValueError('query failed: ' + sql)
+
+    def ping(self, reconnect):
+        """Succeed unless closed."""
+        if self.closed:
+            raise ValueError('connection closed')
+
+    def close(self):
+        """Close the connection."""
+        self.closed = True
+
+    def commit(self):
+        """Commit nothing."""
+
+    def rollback(self):
+        """Roll back nothing."""
+
+
+class TestHmsSideband(unittest.TestCase):
+    """Test the pool of sideband database connections."""
+
+    config_text = '[hms_sideband]\nschema = samqfs1db\nhost = host\nuser = user\npassword = pass\nport = 3306\n'
+
+    def setUp(self):
+        """Count connections made through a fake mysql driver."""
+        self.connections = []
+        self.driver = peewee.mysql
+        peewee.mysql = self
+        # pylint: disable=protected-access
+        hms_sideband_orm._DB_PID['pid'] = None
+        # pylint: enable=protected-access
+
+    def tearDown(self):
+        """Put the driver, config and server threads back."""
+        peewee.mysql = self.driver
+        # pylint: disable=protected-access
+        hms_sideband_orm._DB_PID['pid'] = None
+        # pylint: enable=protected-access
+        archive_server.set_request_threads(archive_server.DEFAULT_THREADS)
+        set_config_name('config.cfg')
+
+    def connect(self, **kwargs):
+        """Open a fake connection."""
+        self.assertEqual(kwargs['db'], 'samqfs1db')
+        connection = FakeSidebandConnection()
+        self.connections.append(connection)
+        return connection
+
+    def write_config(self, extra=''):
+        """Point the config at a sideband section with the extra lines."""
+        with open('/tmp/archivei-sideband.cfg', 'w') as config_file:
+            config_file.write(self.config_text + extra)
+        set_config_name('/tmp/archivei-sideband.cfg')
+
+    def test_sideband_pool_config(self):
+        """Test the pool has a connection per request thread unless configured."""
+        self.write_config()
+        make_pooled_server('127.0.0.1', 0, None, threads=3).server_close()
+        hms_sideband_orm.init_database()
+        pool = hms_sideband_orm.DB.obj
+        self.assertEqual(pool.max_connections, 3)
+        self.assertEqual(pool.timeout, hms_sideband_orm.DEFAULT_CONNECTION_TIMEOUT)
+        self.assertEqual(pool.stale_timeout, hms_sideband_orm.DEFAULT_CONNECTION_MAX_AGE)
+        hms_sideband_orm.init_database()
+        self.assertTrue(hms_sideband_orm.DB.obj is pool)
+        self.write_config('max_connections = 20\nconnection_timeout = 5\n')
+        # pylint: disable=protected-access
+        hms_sideband_orm._DB_PID['pid'] = None
+        # pylint: enable=protected-access
+        hms_sideband_orm.init_database()
+        self.assertEqual(hms_sideband_orm.DB.obj.max_connections, 20)
+        self.assertEqual(hms_sideband_orm.DB.obj.timeout, 5)
+
+    def test_sideband_connection_release(self):
+        """Test connections go back to the pool and a full pool waits for one."""
+        self.write_config('max_connections = 1\n')
+        self.assertRaises(ValueError, sam_qfs_status, '/tmp/5030', '/demos/5030')
+        self.assertRaises(ValueError, sam_qfs_status, '/tmp/5031', '/demos/5031')
+        pool = hms_sideband_orm.DB.obj
+        # pylint: disable=protected-access
+        self.assertEqual(pool._in_use, {})
+        self.assertEqual(len(pool._connections), 1)
+        # pylint: enable=protected-access
+        self.assertEqual(len(self.connections), 1)
+
+        def hold():
+            """Hold the only connection for a while."""
+            SamInode.database_connect()
+            held.append(time.time())
+            time.sleep(0.5)
+            SamInode.database_close()
+        held = []
+        holder = Thread(target=hold)
+        holder.start()
+        while not held:
+            time.sleep(0.01)
+        SamInode.database_connect()
+        self.assertTrue(time.time() - held[0] >= 0.4)
+        SamInode.database_close()
+        holder.join()
+        self.assertEqual(len(self.connections), 1)
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Test the in process benchmarks."""
+
+    def test_memory_benchmark(self):
+        """Test a short run against the memory backend and comparing it."""
+        results = run_benchmarks('memory', '/tmp/', requests=5, small_size=100, stream_size=3 << 20, streams=1)
+        for workload in ('small_put', 'small_get', 'small_head', 'stream_put', 'stream_get'):
+            self.assertEqual(results[workload]['errors'], 0)
+        self.assertEqual(results['small_get']['requests'], 5)
+        self.assertTrue(results['stream_get']['megabytes_per_second'] > 0)
+        self.assertTrue(results['small_put']['latency_ms']['max'] >= results['small_put']['latency_ms']['p50'])
+        results = {'results': {'memory': results}}
+        self.assertEqual(compare(results, results), [])
+        slower = {'results': {'memory': {'small_get': dict(results['results']['memory']['small_get'])}}}
+        slower['results']['memory']['small_get']['requests_per_second'] *= 2
+        self.assertEqual(len(compare(results, slower, 0.1)), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,518 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Built in WSGI server for the archive interface.
+
+Extends the wsgiref simple server so a file returned through
+wsgi.file_wrapper that has a real fileno() is copied from disk to the
+socket by the kernel with sendfile(2) instead of being read into
+python a block at a time.
+
+For production use the server can also run prefork: a master process
+keeps a number of worker processes alive, each serving HTTP/1.1
+persistent connections from a fixed pool of threads and optionally
+recycled after a number of requests.
+
+Every server reloads the config file when the process gets SIGHUP.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import threading
+import traceback
+import ConfigParser
+from Queue import Queue
+from ctypes import CDLL, POINTER, byref, get_errno, c_int, c_int64, c_size_t, c_ssize_t
+from ctypes.util import find_library
+from wsgiref.simple_server import make_server, ServerHandler, WSGIRequestHandler, WSGIServer
+from archiveinterface.archive_utils import reload_config
+from archiveinterface.archive_interface_error import ArchiveInterfaceError
+from archiveinterface.metrics import METRICS, BYTES_READ
+
+# largest count to hand sendfile in one call
+SENDFILE_CHUNK = 1 << 30
+DEFAULT_WORKERS = 4
+DEFAULT_THREADS = 16
+# seconds an idle persistent connection is kept open
+DEFAULT_KEEP_ALIVE_TIMEOUT = 60
+# most unread request body to throw away to keep a connection open
+MAX_DRAIN = 1 << 16
+# responses to these never have a body
+NO_BODY_STATUS = ('204', '304')
+# seconds to wait before replacing a failed worker, doubled for each failure in a row
+RESPAWN_DELAY = 0.1
+MAX_RESPAWN_DELAY = 10
+# failures in a row after which the master gives up
+MAX_WORKER_FAILURES = 10
+# not defined by the socket module of older pythons
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# threads running requests in this process, for pools sized to match
+_REQUEST_THREADS = {'threads': DEFAULT_THREADS}
+
+
+def _load_sendfile():
+    """Load sendfile from libc, None if the platform doesn't have it."""
+    try:
+        libc = CDLL(find_library('c'), use_errno=True)
+        libc_sendfile = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [c_int, c_int, POINTER(c_int64), c_size_t]
+    libc_sendfile.restype = c_ssize_t
+    return libc_sendfile
+
+
+_SENDFILE = _load_sendfile()
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Copy count bytes starting at offset of in_fd to out_fd.
+
+    Returns the number of bytes copied, which is short only if the
+    file ended first.
+    """
+    c_offset = c_int64(offset)
+    sent = 0
+    while sent < count:
+        rcode = _SENDFILE(out_fd, in_fd, byref(c_offset), min(count - sent, SENDFILE_CHUNK))
+        if rcode < 0:
+            err = get_errno()
+            if err in (errno.EINTR, errno.EAGAIN):
+                continue
+            raise OSError(err, os.strerror(err))
+        if rcode == 0:
+            break
+        sent += rcode
+    return sent
+
+
+# pylint: disable=unused-argument
+def set_request_threads(threads):
+    """Record the number of threads running requests in this process."""
+    _REQUEST_THREADS['threads'] = threads
+
+
+def request_threads():
+    """Return the number of threads running requests in this process."""
+    return _REQUEST_THREADS['threads']
+
+
+def _reload_config(signum, frame):
+    """Reload the config file, keeping the old one if it can't be read."""
+    try:
+        reload_config()
+    except (ValueError, ConfigParser.Error) as ex:
+        sys.stderr.write("Can't reload config with error: {}\n".format(str(ex)))
+# pylint: enable=unused-argument
+
+
+def reload_on_hangup():
+    """Reload the config file whenever the process gets SIGHUP."""
+    signal.signal(signal.SIGHUP, _reload_config)
+
+
+class SendfileServerHandler(ServerHandler):
+    """Server handler that sends wrapped files with sendfile(2)."""
+
+    def sendfile(self):
+        """Send the wrapped file if it and the client socket have file numbers."""
+        filelike = self.result.filelike
+        if _SENDFILE is None or not hasattr(filelike, 'fileno') or not hasattr(self.stdout, 'fileno'):
+            return False
+        in_fd = filelike.fileno()
+        offset = os.lseek(in_fd, 0, os.SEEK_CUR)
+        content_length = self.headers.get('Content-Length')
+        if content_length is None:
+            count = os.fstat(in_fd).st_size - offset
+            self.headers['Content-Length'] = str(count)
+        else:
+            count = int(content_length)
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        sent = sendfile(self.stdout.fileno(), in_fd, offset, count)
+        self.bytes_sent += sent
+        METRICS.inc(BYTES_READ, sent)
+        return True
+
+
+class _RequestBody(object):
+    """The wsgi.input of a request, never reading past its body."""
+
+    def __init__(self, rfile, length):
+        """Read at most length bytes from rfile."""
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        """Read up to size bytes, all that are left if size is negative."""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self._rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        """Read a line of the body."""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self._rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        """Read the rest of the body as lines."""
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            if 0 < hint <= sum(len(item) for item in lines):
+                break
+            line = self.readline()
+        return lines
+
+    def __iter__(self):
+        """Iterate over the lines of the body."""
+        return iter(self.readline, '')
+
+    def drain(self):
+        """Throw away a small unread rest of the body.
+
+        Returns False if too much is left to be worth reading.
+        """
+        if self.remaining > MAX_DRAIN:
+            return False
+        while self.remaining and self.read(self.remaining):
+            pass
+        return not self.remaining
+
+
+class KeepAliveServerHandler(SendfileServerHandler):
+    """Server handler that keeps HTTP/1.1 connections open when it can."""
+
+    http_version = '1.1'
+
+    def has_body(self):
+        """Return False if the response must not carry a body."""
+        return self.environ['REQUEST_METHOD'] != 'HEAD' and self.status[:3] not in NO_BODY_STATUS
+
+    def finish_response(self):
+        """Send the response, without a body when the client expects none."""
+        if self.has_body():
+            if isinstance(self.result, str):
+                self.result = [self.result]
+            SendfileServerHandler.finish_response(self)
+            return
+        # a stray body would be read as the start of the next response
+        try:
+            if not self.headers_sent:
+                self.send_headers()
+        finally:
+            self.close()
+
+    def handle_error(self):
+        """Close the connection after a failed request."""
+        self.request_handler.close_connection = 1
+        SendfileServerHandler.handle_error(self)
+
+    def cleanup_headers(self):
+        """Close the connection unless the next request can follow."""
+        SendfileServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        has_length = 'Content-Length' in self.headers or not self.has_body()
+        if not has_length or not request_handler.body.drain():
+            request_handler.close_connection = 1
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class ArchiveRequestHandler(WSGIRequestHandler):
+    """Request handler that runs the app with the sendfile server handler."""
+
+    server_handler = SendfileServerHandler
+
+    def handle(self):
+        """Handle requests until the connection is to be closed."""
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def get_stdin(self):
+        """Return the file the request body is read from."""
+        return self.rfile
+
+    def handle_one_request(self):
+        """Handle a single HTTP request."""
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = self.server_handler(
+            self.get_stdin(), self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class KeepAliveRequestHandler(ArchiveRequestHandler):
+    """Request handler serving many requests on a persistent connection."""
+
+    protocol_version = 'HTTP/1.1'
+    server_handler = KeepAliveServerHandler
+    timeout = DEFAULT_KEEP_ALIVE_TIMEOUT
+    body = None
+
+    def handle_one_request(self):
+        """Handle a single HTTP request, keeping the connection if allowed."""
+        try:
+            ArchiveRequestHandler.handle_one_request(self)
+        except socket.error:
+            # the client went away or stayed idle past the timeout
+            self.close_connection = 1
+
+    def parse_request(self):
+        """Parse the request and limit its body to the content length."""
+        if not ArchiveRequestHandler.parse_request(self):
+            return False
+        if not self.server.count_request():
+            self.close_connection = 1
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+        except ValueError:
+            length = 0
+            self.close_connection = 1
+        if self.headers.getheader('transfer-encoding'):
+            self.close_connection = 1
+        self.body = _RequestBody(self.rfile, length)
+        return True
+
+    def get_stdin(self):
+        """Return the request body, which ends at its content length."""
+        return self.body
+
+
+def make_archive_server(address, port, app):
+    """Create the built in server for the app."""
+    return make_server(address, port, app, handler_class=ArchiveRequestHandler)
+
+
+class PooledWSGIServer(WSGIServer):
+    """WSGI server running connections on a fixed pool of threads.
+
+    After max_requests requests, when it is not zero, the server stops
+    accepting connections so its process can be replaced.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, server_address, handler_class, threads=DEFAULT_THREADS,
+                 max_requests=0, reuse_port=False):
+        """Bind the server, the threads start when it serves."""
+        self._threads = threads
+        self._max_requests = max_requests
+        self._reuse_port = reuse_port
+        self._requests = 0
+        set_request_threads(threads)
+        self._lock = threading.Lock()
+        self._connections = Queue()
+        self._started = False
+        WSGIServer.__init__(self, server_address, handler_class)
+
+    def server_bind(self):
+        """Bind the socket, sharing the port with other processes if asked."""
+        if self._reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        WSGIServer.server_bind(self)
+
+    def count_request(self):
+        """Count a request, returning False if it is the last one to serve."""
+        with self._lock:
+            self._requests += 1
+            last = self._max_requests and self._requests >= self._max_requests
+            stop = last and self._requests == self._max_requests
+        if stop:
+            # shutdown() waits for serve_forever, so not on this thread
+            stopper = threading.Thread(target=self.shutdown)
+            stopper.daemon = True
+            stopper.start()
+        return not last
+
+    def serve_forever(self, poll_interval=0.5):
+        """Start the threads and serve until shut down."""
+        if not self._started:
+            self._started = True
+            for _ in range(self._threads):
+                worker = threading.Thread(target=self._work, name='archive-worker')
+                worker.daemon = True
+                worker.start()
+        WSGIServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        """Queue the connection for the threads."""
+        self._connections.put((request, client_address))
+
+    def _work(self):
+        """Serve queued connections forever."""
+        while True:
+            request, client_address = self._connections.get()
+            try:
+                self.finish_request(request, client_address)
+            # pylint: disable=broad-except
+            except Exception:
+                self.handle_error(request, client_address)
+            # pylint: enable=broad-except
+            finally:
+                self.shutdown_request(request)
+                self._connections.task_done()
+
+    def wait_idle(self):
+        """Wait for the queued connections to be served."""
+        self._connections.join()
+
+
+def make_pooled_server(address, port, app, threads=DEFAULT_THREADS, max_requests=0, reuse_port=False):
+    """Create a thread pooled keep-alive server for the app."""
+    server = PooledWSGIServer((address, port), KeepAliveRequestHandler, threads, max_requests, reuse_port)
+    server.set_app(app)
+    return server
+
+
+class PreforkServer(object):
+    """Keep worker processes serving the app alive.
+
+    Workers share the master's listening socket, or with reuse_port
+    each binds its own and the kernel spreads connections across them.
+    A worker that exits, for example after serving max_requests, is
+    replaced and its metrics kept with those of the other exited
+    workers. A worker that fails is replaced after a delay that grows
+    with each failure in a row, and the master stops once workers have
+    failed MAX_WORKER_FAILURES times in a row.
+    """
+
+    def __init__(self, address, port, app, workers=DEFAULT_WORKERS, threads=DEFAULT_THREADS,
+                 max_requests=0, reuse_port=False):
+        """Create the master, binding the shared socket unless reusing the port."""
+        self._address = address
+        self._app = app
+        self._workers = workers
+        self._threads = threads
+        self._max_requests = max_requests
+        self._reuse_port = reuse_port
+        self._children = set()
+        self._stopping = False
+        self._server = None
+        self.server_port = port
+        if not reuse_port:
+            self._server = make_pooled_server(address, port, app, threads, max_requests)
+            self.server_port = self._server.server_port
+
+    def serve_forever(self):
+        """Run the workers until the master is told to stop."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        # metrics left by the workers of an earlier server
+        METRICS.clear()
+        failures = 0
+        try:
+            while not self._stopping:
+                while len(self._children) < self._workers and not self._stopping:
+                    if failures:
+                        time.sleep(min(RESPAWN_DELAY * 2 ** (failures - 1), MAX_RESPAWN_DELAY))
+                        if self._stopping:
+                            break
+                    self._spawn()
+                try:
+                    pid, status = os.wait()
+                except OSError as ex:
+                    if ex.errno not in (errno.EINTR, errno.ECHILD):
+                        raise
+                    continue
+                self._children.discard(pid)
+                METRICS.mark_process_dead(pid)
+                if not status or self._stopping:
+                    failures = 0
+                    continue
+                failures += 1
+                if failures >= MAX_WORKER_FAILURES:
+                    raise ArchiveInterfaceError(
+                        'Workers failed {} times in a row, stopping the server'.format(failures))
+        finally:
+            self.server_close()
+
+    def _spawn(self):
+        """Fork a worker process."""
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        reload_on_hangup()
+        status = 1
+        # pylint: disable=broad-except
+        try:
+            server = self._server
+            if server is None:
+                server = make_pooled_server(self._address, self.server_port, self._app,
+                                            self._threads, self._max_requests, True)
+            server.serve_forever()
+            server.wait_idle()
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+        # pylint: enable=broad-except
+
+    def _signal_children(self, signum):
+        """Send the signal to every worker."""
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    # pylint: disable=unused-argument
+    def _stop(self, signum, frame):
+        """Stop the master and its workers."""
+        self._stopping = True
+        self._signal_children(signal.SIGTERM)
+
+    def _reload(self, signum, frame):
+        """Reload the config in the master, for new workers, and every worker."""
+        _reload_config(signum, frame)
+        self._signal_children(signal.SIGHUP)
+    # pylint: enable=unused-argument
+
+    def server_close(self):
+        """Stop the workers and close the shared socket."""
+        self._stop(None, None)
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            self._children.discard(pid)
+            METRICS.mark_process_dead(pid)
+        if self._server is not None:
+            self._server.server_close()
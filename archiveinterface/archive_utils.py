@@ -6,6 +6,11 @@ Used in various parts of the archive interface.
 """
 import email.utils as eut
 import time
+import json
+import threading
+from itertools import islice
+from hashlib import sha1
+from base64 import b64decode, b64encode
 import ConfigParser
 from os import path
 from archiveinterface.archive_interface_error import ArchiveInterfaceError
@@ -13,6 +18,15 @@ from archiveinterface.archive_interface_error import ArchiveInterfaceError
 # defaulting to this, but the global is set in the archiveinterfaceserver if different
 # looks at command line first, then environment, and then falls back to config.cfg
 CONFIG_FILE = 'config.cfg'
+# parsed config file, see get_config()
+_CONFIG = None
+_CONFIG_LOCK = threading.Lock()
+
+# hashlib names of the digests the Digest header (RFC 3230) can carry
+HTTP_DIGEST_ALGORITHMS = {'md5': 'md5', 'sha': 'sha1', 'sha-1': 'sha1', 'sha-256': 'sha256'}
+DIGEST_HTTP_NAMES = {'md5': 'md5', 'sha1': 'sha', 'sha256': 'sha-256'}
+# paths of the endpoints that aren't files start with this, no file can
+ROUTE_PREFIX = '/_/'
 
 
 def un_abs_path(path_name):
@@ -42,27 +56,275 @@ def get_http_modified_time(env):
         raise ArchiveInterfaceError('Cant parse the files modtime: ' + str(ex))
 
 
-def set_config_name(name):
-    """Set the global config name."""
-    # pylint: disable=global-statement
-    global CONFIG_FILE
-    # pylint: enable=global-statement
-    CONFIG_FILE = name
+def get_http_byte_ranges(env, filesize):
+    """Get the byte ranges asked for by the Range header.
+
+    Returns None if the whole file should be sent, either because
+    there is no Range header or it can't be parsed. Otherwise returns
+    a sorted list of inclusive (first, last) byte offsets with any
+    overlapping ranges merged, which is empty if no range can be
+    satisfied.
+    """
+    header = env.get('HTTP_RANGE')
+    if not header:
+        return None
+    units, _sep, range_set = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for range_spec in range_set.split(','):
+        range_spec = range_spec.strip()
+        if not range_spec:
+            continue
+        first, sep, last = range_spec.partition('-')
+        try:
+            if not sep:
+                return None
+            if first:
+                first = int(first)
+                last = int(last) if last.strip() else filesize - 1
+                if last < first:
+                    return None
+            else:
+                first = filesize - int(last)
+                last = filesize - 1
+                first = max(first, 0)
+        except ValueError:
+            return None
+        if first < filesize and last >= first:
+            ranges.append((first, min(last, filesize - 1)))
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def get_http_date(timestamp):
+    """Format a unix timestamp as an HTTP date."""
+    return eut.formatdate(int(timestamp), usegmt=True)
+
+
+def get_http_etag(fileid, status):
+    """Get the entity tag for a file from its status.
+
+    Files are written to the archive once, so the id, size and mtime
+    are enough to tell different versions of a file apart.
+    """
+    tag = sha1('{}:{}:{!r}'.format(fileid, status.filesize, status.mtime))
+    return '"{}"'.format(tag.hexdigest())
+
+
+def if_range_matches(env, mtime, etag=None):
+    """Check the If-Range header still matches the file.
+
+    Returns True when there is no If-Range header so the Range
+    header should be honored.
+    """
+    if_range = env.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return etag is not None and if_range == etag
+    parsed = eut.parsedate_tz(if_range)
+    if parsed is None:
+        return False
+    return eut.mktime_tz(parsed) == int(mtime)
 
 
-def read_config_value(section, field):
-    """Read the value from the config file if exists."""
+def is_not_modified(env, etag, mtime):
+    """Check the conditional headers to see if the client's copy is current.
+
+    If-None-Match is used when given, otherwise If-Modified-Since.
+    """
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag in ('*', etag):
+                return True
+        return False
+    if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        parsed = eut.parsedate_tz(if_modified_since)
+        if parsed is not None:
+            return int(mtime) <= eut.mktime_tz(parsed)
+    return False
+
+
+def get_http_digests(env):
+    """Get the digests the client sent for the request body.
+
+    Reads the Content-MD5 and Digest (RFC 3230) headers and returns
+    hex digests by hashlib algorithm name. Unknown algorithms in the
+    Digest header are ignored.
+    """
+    digests = {}
+    try:
+        content_md5 = env.get('HTTP_CONTENT_MD5')
+        if content_md5:
+            digests['md5'] = b64decode(content_md5.strip()).encode('hex')
+        for instance_digest in env.get('HTTP_DIGEST', '').split(','):
+            name, sep, value = instance_digest.strip().partition('=')
+            algorithm = HTTP_DIGEST_ALGORITHMS.get(name.strip().lower())
+            if sep and algorithm:
+                digests[algorithm] = b64decode(value.strip()).encode('hex')
+    except TypeError as ex:
+        raise ArchiveInterfaceError('Cant parse the digest headers: ' + str(ex))
+    return digests
+
+
+def get_http_digest_header(digests):
+    """Format hex digests by algorithm as a Digest header value."""
+    return ', '.join(
+        '{}={}'.format(DIGEST_HTTP_NAMES[algorithm], b64encode(value.decode('hex')))
+        for algorithm, value in sorted(digests.items())
+    )
+
+
+def encode_digests(digests):
+    """Encode hex digests by algorithm to store with a file."""
+    return ','.join(
+        '{}:{}'.format(algorithm, value) for algorithm, value in sorted(digests.items())
+    )
+
+
+def decode_digests(value):
+    """Decode digests stored with a file, empty if there are none."""
+    if not value:
+        return {}
+    return dict(item.split(':', 1) for item in value.split(','))
+
+
+def get_http_json_body(env):
+    """Return the JSON document sent as the request body."""
     try:
+        content_length = int(env.get('CONTENT_LENGTH') or 0)
+        return json.loads(env['wsgi.input'].read(content_length))
+    except (ValueError, TypeError) as ex:
+        raise ArchiveInterfaceError("Can't read JSON request body with error: " + str(ex))
+
+
+def batched(items, size):
+    """Yield lists of at most size items."""
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+
+class ConfigSnapshot(object):
+    """Values of a config file parsed once, by section and field."""
+
+    def __init__(self, name):
+        """Parse the config file with the name."""
         config = ConfigParser.RawConfigParser()
-        dataset = config.read(CONFIG_FILE)
+        dataset = config.read(name)
         if not dataset:
             raise ValueError(
-                'Failed to open config file with name: {}'.format(str(CONFIG_FILE)))
-        value = config.get(section, field)
-        return value
-    except ConfigParser.NoSectionError:
-        raise ArchiveInterfaceError(
-            'Error reading config file, no section: ' + section)
-    except ConfigParser.NoOptionError:
-        raise ArchiveInterfaceError('Error reading config file, no field: ' + field +
-                                    ' in section: ' + section)
+                'Failed to open config file with name: {}'.format(str(name)))
+        self.name = name
+        self._sections = dict(
+            (section, dict(config.items(section))) for section in config.sections()
+        )
+
+    def get(self, section, field, default=None):
+        """Return the value of the field in the section.
+
+        If a default is given it is returned when the section or field
+        is missing instead of raising an error.
+        """
+        if section not in self._sections:
+            if default is not None:
+                return default
+            raise ArchiveInterfaceError(
+                'Error reading config file, no section: ' + section)
+        values = self._sections[section]
+        if field.lower() not in values:
+            if default is not None:
+                return default
+            raise ArchiveInterfaceError('Error reading config file, no field: ' + field +
+                                        ' in section: ' + section)
+        return values[field.lower()]
+
+
+def set_config_name(name):
+    """Set the global config name, it is read when next used."""
+    # pylint: disable=global-statement
+    global CONFIG_FILE, _CONFIG
+    # pylint: enable=global-statement
+    with _CONFIG_LOCK:
+        CONFIG_FILE = name
+        _CONFIG = None
+
+
+def get_config():
+    """Return the config snapshot, parsing the config file the first time."""
+    # pylint: disable=global-statement
+    global _CONFIG
+    # pylint: enable=global-statement
+    config = _CONFIG
+    if config is None:
+        with _CONFIG_LOCK:
+            if _CONFIG is None:
+                _CONFIG = ConfigSnapshot(CONFIG_FILE)
+            config = _CONFIG
+    return config
+
+
+def reload_config():
+    """Parse the config file again and swap in the new snapshot.
+
+    The old snapshot stays in use if the file can't be parsed.
+    """
+    # pylint: disable=global-statement
+    global _CONFIG
+    # pylint: enable=global-statement
+    with _CONFIG_LOCK:
+        _CONFIG = ConfigSnapshot(CONFIG_FILE)
+        return _CONFIG
+
+
+def read_config_value(section, field, default=None):
+    """Read the value from the config file if exists.
+
+    If a default is given it is returned when the section or field
+    is missing instead of raising an error.
+    """
+    return get_config().get(section, field, default)
+
+
+def read_config_bool(section, field, default=None):
+    """Read a true or false value from the config file."""
+    value = read_config_value(section, field, default)
+    if value.lower() not in ('true', 'false'):
+        raise ArchiveInterfaceError('Error reading config file, field: ' + field +
+                                    ' in section: ' + section + ' is not true or false')
+    return value.lower() == 'true'
+
+
+def read_config_int(section, field, default=None):
+    """Read an integer value from the config file."""
+    value = read_config_value(section, field, default)
+    try:
+        return int(value)
+    except ValueError:
+        raise ArchiveInterfaceError('Error reading config file, field: ' + field +
+                                    ' in section: ' + section + ' is not an integer')
+
+
+def read_config_float(section, field, default=None):
+    """Read a floating point value from the config file."""
+    value = read_config_value(section, field, default)
+    try:
+        return float(value)
+    except ValueError:
+        raise ArchiveInterfaceError('Error reading config file, field: ' + field +
+                                    ' in section: ' + section + ' is not a number')
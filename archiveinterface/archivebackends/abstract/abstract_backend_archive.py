@@ -6,8 +6,17 @@ Module that has the Abstract class for Archive Backends
 Any new backends need to inherit from this class and implement
 its methods. If the methods are not implemented in the child,
 the child object will not be able to be instantiated.
+
+The backend object built by the factory is never used to hold a file
+itself. Calling open on it returns a new handle for that one file so
+concurrent requests do not share state.
 """
 import abc
+import copy
+from archiveinterface.archive_utils import read_config_int, read_config_float
+from archiveinterface.archive_interface_error import ArchiveInterfaceError
+from archiveinterface.archivebackends.handle_pool import HandlePool, \
+    DEFAULT_MAX_HANDLES, DEFAULT_HANDLE_TIMEOUT
 
 
 class AbstractBackendArchive(object):
@@ -25,9 +34,11 @@ class AbstractBackendArchive(object):
         """Open File.
 
         Method that opens a file for the backend archive that implements
-        this class Should return a file like object, most likely self.
-        This method is also responsible for making sure the dirname of
-        the filepath exists before trying to open.
+        this class Should return a new file like handle for the file,
+        most likely built with _new_handle(), and must not disturb any
+        other handle already open. This method is also responsible for
+        making sure the dirname of the filepath exists before trying to
+        open.
         """
         pass
 
@@ -36,7 +47,8 @@ class AbstractBackendArchive(object):
         """Close File.
 
         Method that closes an open file for the backend archive that
-        implements this class.
+        implements this class. Should call _release_handle() so the
+        handle's context goes back to the pool.
         """
         pass
 
@@ -49,6 +61,16 @@ class AbstractBackendArchive(object):
         """
         pass
 
+    @abc.abstractmethod
+    def seek(self, offset):
+        """Seek File.
+
+        Method that moves the read position of an open file for the
+        backend archive that implements this class to offset bytes
+        from the start of the file.
+        """
+        pass
+
     @abc.abstractmethod
     def write(self, buf):
         """Write File.
@@ -78,6 +100,34 @@ class AbstractBackendArchive(object):
         """
         pass
 
+    def stat(self, filepath):
+        """Return status of the file without opening it.
+
+        Method that gets the status of a file in the archive before
+        any handle is opened for it, so requests that only need the
+        status don't open the file's data stream. Backends should
+        override this default, which opens a handle to ask.
+        """
+        handle = self.open(filepath, 'r')
+        try:
+            return handle.status()
+        finally:
+            handle.close()
+
+    def status_many(self, filepaths):
+        """Status Many Files.
+
+        Method that yields (filepath, status) for each of the files,
+        where status is None if the file doesn't exist and an
+        ArchiveInterfaceError if its status couldn't be read. Backends
+        override this to look up many files at once.
+        """
+        for filepath in filepaths:
+            try:
+                yield filepath, self.stat(filepath)
+            except ArchiveInterfaceError as ex:
+                yield filepath, ex
+
     @abc.abstractmethod
     def set_mod_time(self, mod_time):
         """Set Modification Time for File.
@@ -87,6 +137,27 @@ class AbstractBackendArchive(object):
         """
         pass
 
+    @abc.abstractmethod
+    def set_digests(self, digests):
+        """Set Digests for File.
+
+        Method that stores the hex digests of a files contents, keyed
+        by hashlib algorithm name, for the backend archive that
+        implements this class. The backend's status objects should
+        return them in their digests attribute.
+        """
+        pass
+
+    @abc.abstractmethod
+    def discard(self):
+        """Discard File.
+
+        Method that closes a file opened for writing and removes
+        what was written for the backend archive that implements
+        this class.
+        """
+        pass
+
     @abc.abstractmethod
     def set_file_permissions(self):
         """Set permissions for File.
@@ -95,3 +166,39 @@ class AbstractBackendArchive(object):
         implements this class.
         """
         pass
+
+    def _init_handle_pool(self, section, factory=None):
+        """Create the pool of contexts handles are checked out from.
+
+        The pool size and wait timeout are read from the max_handles
+        and handle_timeout fields of the backend's config section.
+        """
+        self._pool = HandlePool(
+            read_config_int(section, 'max_handles', DEFAULT_MAX_HANDLES),
+            read_config_float(section, 'handle_timeout', DEFAULT_HANDLE_TIMEOUT),
+            factory
+        )
+        self._context = None
+        self._has_context = False
+
+    def _new_handle(self):
+        """Return a new handle sharing this backend's configuration.
+
+        The handle holds a context from the backend's pool until
+        _release_handle() is called on it.
+        """
+        handle = copy.copy(self)
+        # pylint: disable=protected-access
+        handle._file = None
+        handle._filepath = None
+        handle._context = self._pool.acquire()
+        handle._has_context = True
+        # pylint: enable=protected-access
+        return handle
+
+    def _release_handle(self):
+        """Give this handle's context back to the pool."""
+        if self._has_context:
+            self._has_context = False
+            self._pool.release(self._context)
+            self._context = None
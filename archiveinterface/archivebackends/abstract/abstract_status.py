@@ -20,6 +20,7 @@ class AbstractStatus(object):
     defined_levels = None
     file_storage_media = None
     filepath = None
+    digests = None
 
     @abc.abstractmethod
     def __init__(self, mtime, ctime, bytes_per_level, filesize):
@@ -57,3 +58,11 @@ class AbstractStatus(object):
         to return the correct status of a file.
         """
         pass
+
+    def set_digests(self, digests):
+        """Set Digests.
+
+        Method that sets the hex digests of the file's contents
+        by hashlib algorithm name.
+        """
+        self.digests = digests
@@ -36,6 +36,10 @@ class ArchiveBackendFactory(object):
             from archiveinterface.archivebackends.hpss.hpss_backend_archive \
                 import HpssBackendArchive
             self.share_classes = {'hpss': HpssBackendArchive}
+        elif name == 'hpss_simulator':
+            from archiveinterface.archivebackends.hpss.hpss_simulator \
+                import HpssSimulatorBackendArchive
+            self.share_classes = {'hpss_simulator': HpssSimulatorBackendArchive}
         elif name == 'posix':
             from archiveinterface.archivebackends.posix.posix_backend_archive \
                 import PosixBackendArchive
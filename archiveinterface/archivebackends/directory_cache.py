@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Directory Cache Module.
+
+Module with the cache of directories backends know exist. Files are
+spread over a fixed tree of directories, so once a directory has been
+made opening more files in it doesn't need to check for it or make it
+again. A directory is forgotten when opening a file in it finds it
+missing, so it is made again the next time.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_DIRECTORY_CACHE_SIZE = 10000
+
+
+def make_local_directory(dirname):
+    """Make the local directory and its parents if it doesn't exist."""
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0755)
+
+
+class DirectoryCache(object):
+    """Bounded least recently used set of directories known to exist."""
+
+    def __init__(self, size=DEFAULT_DIRECTORY_CACHE_SIZE):
+        """Create a cache of at most size directories, zero disables it."""
+        self._size = size
+        self._directories = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, size):
+        """Change the size, forgetting directories that no longer fit."""
+        with self._lock:
+            self._size = size
+            while len(self._directories) > self._size:
+                self._directories.popitem(last=False)
+
+    def makedirs(self, dirname, makedirs):
+        """Make the directory by calling makedirs unless it is known to exist."""
+        with self._lock:
+            if self._directories.pop(dirname, False):
+                self._directories[dirname] = True
+                self.hits += 1
+                return
+            self.misses += 1
+        makedirs(dirname)
+        if not self._size:
+            return
+        with self._lock:
+            self._directories[dirname] = True
+            while len(self._directories) > self._size:
+                self._directories.popitem(last=False)
+
+    def clear(self):
+        """Forget every directory."""
+        with self._lock:
+            self._directories.clear()
+
+    def invalidate(self, dirname):
+        """Forget the directory, it has to be checked for again."""
+        with self._lock:
+            self._directories.pop(dirname, None)
+
+
+DIRECTORY_CACHE = DirectoryCache()
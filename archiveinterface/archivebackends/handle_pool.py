@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Handle Pool Module.
+
+Module with the bounded pool backends use to hand out per request
+file handles. Every open handle checks a context out of its backend's
+pool and gives it back when closed, so the number of transfers in
+flight is bounded and contexts can be reused between requests.
+"""
+import time
+import threading
+from archiveinterface.archive_interface_error import ArchiveInterfaceError
+
+DEFAULT_MAX_HANDLES = 64
+DEFAULT_HANDLE_TIMEOUT = 300
+
+
+class HandlePool(object):
+    """Bounded pool of reusable backend contexts."""
+
+    def __init__(self, size=DEFAULT_MAX_HANDLES, timeout=DEFAULT_HANDLE_TIMEOUT, factory=None):
+        """Create a pool of at most size contexts built with factory."""
+        if size < 1:
+            raise ArchiveInterfaceError(
+                'Handle pool size must be at least one, got: ' + str(size))
+        self._size = size
+        self._timeout = timeout
+        self._factory = factory if factory else object
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Check out a context, waiting for one to be released if needed."""
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+        with self._cond:
+            while not self._idle and self._created >= self._size:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ArchiveInterfaceError(
+                            'Timed out waiting for a free backend handle')
+                self._cond.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self._factory()
+        except Exception:
+            self.discard()
+            raise
+
+    def release(self, context):
+        """Return a context to the pool for reuse."""
+        with self._cond:
+            self._idle.append(context)
+            self._cond.notify()
+
+    def discard(self):
+        """Forget a checked out context that can not be reused."""
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+    def in_use(self):
+        """Return the number of contexts currently checked out."""
+        with self._cond:
+            return self._created - len(self._idle)
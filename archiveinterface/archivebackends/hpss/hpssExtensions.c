@@ -34,15 +34,14 @@ pacifica_archiveinterface_mtime(PyObject *self, PyObject *args)
     /*
         Get file descriptor so we can call the hpss fStat on the file.
     */
-   rcode = hpss_Stat(filepath, &Buf);
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_Stat(filepath, &Buf);
+    Py_END_ALLOW_THREADS
     if(rcode < 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
         return NULL;
     }
-    /* Sleep is a hack to get around other hpss thread not finished yet
-    */
-    usleep(30000);
     return Py_BuildValue("i", (int)Buf.hpss_st_mtime);
 }
 
@@ -64,15 +63,14 @@ pacifica_archiveinterface_ctime(PyObject *self, PyObject *args)
     /*
         Get file descriptor so we can call the hpss fStat on the file.
     */
-   rcode = hpss_Stat(filepath, &Buf);
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_Stat(filepath, &Buf);
+    Py_END_ALLOW_THREADS
     if(rcode < 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
         return NULL;
     }
-    /* Sleep is a hack to get around other hpss thread not finished yet
-    */
-    usleep(30000);
     return Py_BuildValue("i", (int)Buf.hpss_st_ctime);
 }
 
@@ -94,15 +92,14 @@ pacifica_archiveinterface_filesize(PyObject *self, PyObject *args)
     /*
         Get file descriptor so we can call the hpss fStat on the file.
     */
-   rcode = hpss_Stat(filepath, &Buf);
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_Stat(filepath, &Buf);
+    Py_END_ALLOW_THREADS
     if(rcode < 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
         return NULL;
     }
-    /* Sleep is a hack to get around other hpss thread not finished yet
-    */
-    usleep(30000);
     return Py_BuildValue("i", (int)Buf.st_size);
 }
 
@@ -126,10 +123,12 @@ pacifica_archiveinterface_status(PyObject *self, PyObject *args)
     }
 
     /* Store hpss file xattributes into attrs*/
+    Py_BEGIN_ALLOW_THREADS
     rcode = hpss_FileGetXAttributes(filepath, API_GET_STATS_FOR_ALL_LEVELS, 0, &attrs);
+    Py_END_ALLOW_THREADS
     if(rcode < 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
         return NULL;
     }
 
@@ -139,12 +138,161 @@ pacifica_archiveinterface_status(PyObject *self, PyObject *args)
         bytes = attrs.SCAttrib[i].BytesAtLevel;
         PyTuple_SetItem(bytes_per_level, i,  Py_BuildValue("L", (long long)bytes));
     }
-    /* Sleep is a hack to get around other hpss thread not finished yet
-    */
-    usleep(30000);
     return bytes_per_level;
 }
 
+/*
+    Build the (mtime, ctime, bytes_per_level, filesize, uda) status tuple
+    for one file from a single extended attribute lookup. Returns None
+    if the file doesn't exist and the error message for other failures.
+*/
+static PyObject *
+status_tuple(char *filepath, char *key)
+{
+    PyObject *bytes_per_level;
+    PyObject *uda;
+    int rcode;
+    int i;
+    char value[HPSS_XML_SIZE];
+    hpss_xfileattr_t attrs;
+    hpss_userattr_t attr;
+    hpss_userattr_list_t attr_list;
+
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_FileGetXAttributes(filepath, API_GET_STATS_FOR_ALL_LEVELS, 0, &attrs);
+    Py_END_ALLOW_THREADS
+    if(rcode == -ENOENT)
+    {
+        Py_RETURN_NONE;
+    }
+    if(rcode < 0)
+    {
+        return PyString_FromFormat("%s (code: %d)", strerror(-rcode), rcode);
+    }
+    bytes_per_level = PyTuple_New(HPSS_MAX_STORAGE_LEVELS);
+    for(i=0; i < HPSS_MAX_STORAGE_LEVELS; i++)
+    {
+        PyTuple_SetItem(bytes_per_level, i,
+                        Py_BuildValue("L", (long long)attrs.SCAttrib[i].BytesAtLevel));
+    }
+
+    value[0] = '\0';
+    attr.Key = key;
+    attr.Value = value;
+    attr_list.len = 1;
+    attr_list.Pair = &attr;
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_UserAttrGetAttrs(filepath, &attr_list, UDA_API_VALUE);
+    Py_END_ALLOW_THREADS
+    if(rcode == 0 && value[0] != '\0')
+    {
+        uda = Py_BuildValue("s", value);
+    }
+    else
+    {
+        Py_INCREF(Py_None);
+        uda = Py_None;
+    }
+
+    return Py_BuildValue("(iiNLN)",
+                         (int)attrs.Attrs.TimeModified,
+                         (int)attrs.Attrs.TimeCreated,
+                         bytes_per_level,
+                         (long long)attrs.Attrs.DataLength,
+                         uda);
+}
+
+/*
+    Get the (mtime, ctime, bytes_per_level, filesize, uda) status tuple
+    of a file from one extended attribute lookup, raising an error if
+    it doesn't exist or can't be read.
+*/
+static PyObject *
+pacifica_archiveinterface_stat(PyObject *self, PyObject *args)
+{
+    PyObject *status;
+    char *filepath;
+    char *key;
+
+    /*
+        get the filepath and the digests attribute key
+    */
+    if (!PyArg_ParseTuple(args, "ss", &filepath, &key))
+    {
+        PyErr_SetString(archiveInterfaceError, "Error parsing arguments");
+        return NULL;
+    }
+
+    status = status_tuple(filepath, key);
+    if(status == Py_None)
+    {
+        Py_DECREF(status);
+        PyErr_SetString(archiveInterfaceError, strerror(ENOENT));
+        return NULL;
+    }
+    if(status != NULL && PyString_Check(status))
+    {
+        PyErr_SetString(archiveInterfaceError, PyString_AsString(status));
+        Py_DECREF(status);
+        return NULL;
+    }
+    return status;
+}
+
+static PyObject *
+pacifica_archiveinterface_status_many(PyObject *self, PyObject *args)
+{
+    PyObject *filepaths;
+    PyObject *paths;
+    PyObject *statuses;
+    PyObject *status;
+    char *key;
+    char *filepath;
+    Py_ssize_t i;
+    Py_ssize_t count;
+
+    /*
+        get the list of filepaths and the digests attribute key
+    */
+    if (!PyArg_ParseTuple(args, "O!s", &PyList_Type, &filepaths, &key))
+    {
+        PyErr_SetString(archiveInterfaceError, "Error parsing arguments");
+        return NULL;
+    }
+
+    /*
+        The GIL is released during each lookup, so work from a tuple
+        other threads can't change under us.
+    */
+    paths = PyList_AsTuple(filepaths);
+    if(paths == NULL)
+    {
+        return NULL;
+    }
+    count = PyTuple_Size(paths);
+    statuses = PyList_New(count);
+    for(i=0; i < count; i++)
+    {
+        filepath = PyString_AsString(PyTuple_GetItem(paths, i));
+        if(filepath == NULL)
+        {
+            Py_DECREF(paths);
+            Py_DECREF(statuses);
+            return NULL;
+        }
+        status = status_tuple(filepath, key);
+        if(status == NULL)
+        {
+            Py_DECREF(paths);
+            Py_DECREF(statuses);
+            return NULL;
+        }
+        PyList_SetItem(statuses, i, status);
+    }
+    Py_DECREF(paths);
+    return statuses;
+}
+
 static PyObject *
 pacifica_archiveinterface_ping_core(PyObject *self, PyObject *args)
 {
@@ -180,11 +328,13 @@ pacifica_archiveinterface_ping_core(PyObject *self, PyObject *args)
     gettimeofday(&tv,NULL);
 
     /* Attempt to ping the CORE server*/
+    Py_BEGIN_ALLOW_THREADS
     ret = hpss_PingCore(&uuid,&secs,&usecs);
+    Py_END_ALLOW_THREADS
     //throw exception if server doesnt respond
     if(ret < 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-ret), ret);
         return NULL;
     }
 
@@ -216,26 +366,41 @@ pacifica_archiveinterface_stage(PyObject *self, PyObject *args)
     filepathCopy = strdup(filepath);
 
 
+    Py_BEGIN_ALLOW_THREADS
     fd = hpss_Open(filepathCopy, O_RDONLY | O_NONBLOCK, 000, NULL, NULL, NULL);
+    Py_END_ALLOW_THREADS
     if(fd < 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-fd), fd);
+        free(filepathCopy);
         return NULL;
     }
 
+    /*
+        Without BFS_ASYNCH_CALL the stage is synchronous, it returns
+        once the whole file is on disk so there is nothing to wait for.
+    */
+    Py_BEGIN_ALLOW_THREADS
     rcode = hpss_Stage(fd, 0, cast64m(0), 0, BFS_STAGE_ALL);
+    Py_END_ALLOW_THREADS
     if(rcode != 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        Py_BEGIN_ALLOW_THREADS
         hpss_Close(fd);
+        Py_END_ALLOW_THREADS
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
         free(filepathCopy);
         return NULL;
     }
-    hpss_Close(fd);
-    /* Sleep is a hack to get around other hpss thread not finished yet
-    */
     free(filepathCopy);
-    usleep(30000);
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_Close(fd);
+    Py_END_ALLOW_THREADS
+    if(rcode != 0)
+    {
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
+        return NULL;
+    }
     Py_RETURN_NONE;
 }
 
@@ -261,16 +426,94 @@ pacifica_archiveinterface_utime(PyObject *self, PyObject *args)
     t.actime = mtime;
 
 
+    Py_BEGIN_ALLOW_THREADS
     rcode = hpss_Utime(filepath, &t);
+    Py_END_ALLOW_THREADS
     if(rcode != 0)
     {
-        PyErr_SetString(archiveInterfaceError, strerror(errno));
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
         return NULL;
     }
     Py_RETURN_NONE;
 }
 
 
+static PyObject *
+pacifica_archiveinterface_setuda(PyObject *self, PyObject *args)
+{
+    char *filepath;
+    char *key;
+    char *value;
+    int rcode;
+    hpss_userattr_t attr;
+    hpss_userattr_list_t attr_list;
+
+    /*
+        get the filepath, attribute key and value passed in from the python code
+    */
+    if (!PyArg_ParseTuple(args, "sss", &filepath, &key, &value))
+    {
+        PyErr_SetString(archiveInterfaceError, "Error parsing arguments");
+        return NULL;
+    }
+
+    attr.Key = key;
+    attr.Value = value;
+    attr_list.len = 1;
+    attr_list.Pair = &attr;
+
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_UserAttrSetAttrs(filepath, &attr_list, NULL);
+    Py_END_ALLOW_THREADS
+    if(rcode != 0)
+    {
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+pacifica_archiveinterface_getuda(PyObject *self, PyObject *args)
+{
+    char *filepath;
+    char *key;
+    char value[HPSS_XML_SIZE];
+    int rcode;
+    hpss_userattr_t attr;
+    hpss_userattr_list_t attr_list;
+
+    /*
+        get the filepath and attribute key passed in from the python code
+    */
+    if (!PyArg_ParseTuple(args, "ss", &filepath, &key))
+    {
+        PyErr_SetString(archiveInterfaceError, "Error parsing arguments");
+        return NULL;
+    }
+
+    value[0] = '\0';
+    attr.Key = key;
+    attr.Value = value;
+    attr_list.len = 1;
+    attr_list.Pair = &attr;
+
+    Py_BEGIN_ALLOW_THREADS
+    rcode = hpss_UserAttrGetAttrs(filepath, &attr_list, UDA_API_VALUE);
+    Py_END_ALLOW_THREADS
+    /* a file without the attribute set is not an error */
+    if(rcode == -ENOENT || (rcode == 0 && value[0] == '\0'))
+    {
+        Py_RETURN_NONE;
+    }
+    if(rcode != 0)
+    {
+        PyErr_Format(archiveInterfaceError, "%s (code: %d)", strerror(-rcode), rcode);
+        return NULL;
+    }
+    return Py_BuildValue("s", value);
+}
+
 static PyObject *
 rec_makedirs(char *filepath)
 {
@@ -279,30 +522,48 @@ rec_makedirs(char *filepath)
     hpss_stat_t hpss_fstat;
     PyObject *err;
     int hpss_err;
+    Py_BEGIN_ALLOW_THREADS
     hpss_err = hpss_Stat(filepath, &hpss_fstat);
+    Py_END_ALLOW_THREADS
     if(hpss_err == 0) {
         if(S_ISDIR(hpss_fstat.st_mode)) {
             Py_RETURN_NONE;
-        } else {
-            PyErr_SetString(archiveInterfaceError, "File is not a directory.");
-            return NULL;
-        }
-    } else {
-        filep_copy = strdup(filepath);
-        dirname_str = dirname(filep_copy);
-        err = rec_makedirs(dirname_str);
-        if(err == NULL) {
-            free(filep_copy);
-            return NULL;
-        }
-        hpss_err = hpss_Mkdir(filepath, 0755);
-        if(hpss_err != 0) {
-            perror("mkdir");
-            free(filep_copy);
-            PyErr_SetString(archiveInterfaceError, "Unable to mkdir.");
-            return NULL;
         }
+        PyErr_SetString(archiveInterfaceError, "File is not a directory.");
+        return NULL;
+    }
+    filep_copy = strdup(filepath);
+    if(filep_copy == NULL) {
+        return PyErr_NoMemory();
+    }
+    dirname_str = dirname(filep_copy);
+    if(strcmp(dirname_str, filepath) == 0) {
+        /* the root can't be made */
         free(filep_copy);
+        PyErr_Format(archiveInterfaceError, "Unable to mkdir %s: %s (code: %d)",
+                     filepath, strerror(-hpss_err), hpss_err);
+        return NULL;
+    }
+    err = rec_makedirs(dirname_str);
+    free(filep_copy);
+    if(err == NULL) {
+        return NULL;
+    }
+    Py_DECREF(err);
+    Py_BEGIN_ALLOW_THREADS
+    hpss_err = hpss_Mkdir(filepath, 0755);
+    if(hpss_err == -EEXIST) {
+        /* another thread or process made it since the stat */
+        hpss_err = hpss_Stat(filepath, &hpss_fstat);
+        if(hpss_err == 0 && !S_ISDIR(hpss_fstat.st_mode)) {
+            hpss_err = -ENOTDIR;
+        }
+    }
+    Py_END_ALLOW_THREADS
+    if(hpss_err != 0) {
+        PyErr_Format(archiveInterfaceError, "Unable to mkdir %s: %s (code: %d)",
+                     filepath, strerror(-hpss_err), hpss_err);
+        return NULL;
     }
     Py_RETURN_NONE;
 }
@@ -322,6 +583,10 @@ pacifica_archiveinterface_makedirs(PyObject *self, PyObject *args)
 static PyMethodDef StatusMethods[] = {
     {"hpss_status", pacifica_archiveinterface_status, METH_VARARGS,
         "Get the status for a file in the archive."},
+    {"hpss_stat", pacifica_archiveinterface_stat, METH_VARARGS,
+        "Get the times, size, bytes per level and an attribute of a file in one lookup."},
+    {"hpss_status_many", pacifica_archiveinterface_status_many, METH_VARARGS,
+        "Get the status of a list of files in the archive."},
     {"hpss_mtime", pacifica_archiveinterface_mtime, METH_VARARGS,
         "Get the mtime for a file in the archive."},
     {"hpss_ctime", pacifica_archiveinterface_ctime, METH_VARARGS,
@@ -336,6 +601,10 @@ static PyMethodDef StatusMethods[] = {
         "Set the modified time on a file"},
     {"hpss_makedirs", pacifica_archiveinterface_makedirs, METH_VARARGS,
         "Make a recursive directory tree"},
+    {"hpss_setuda", pacifica_archiveinterface_setuda, METH_VARARGS,
+        "Set a user defined attribute on a file"},
+    {"hpss_getuda", pacifica_archiveinterface_getuda, METH_VARARGS,
+        "Get a user defined attribute of a file"},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -3,12 +3,16 @@
 """Module that implements the Abstract backend archive for an hpss backend."""
 import os
 import sys
-from ctypes import cdll, c_void_p, create_string_buffer, c_char_p, cast
-from archiveinterface.archive_utils import un_abs_path, read_config_value
+from ctypes import CDLL, get_errno, c_void_p, c_char_p, c_int, c_long, c_size_t, c_ssize_t, create_string_buffer, string_at, \
+    sizeof, resize
+from archiveinterface.archive_utils import un_abs_path, read_config_value, read_config_float, batched
 from archiveinterface.archive_interface_error import ArchiveInterfaceError
 from archiveinterface.archivebackends.abstract.abstract_backend_archive import (
     AbstractBackendArchive)
 from archiveinterface.id2filename import id2filename
+from archiveinterface.archivebackends.directory_cache import DIRECTORY_CACHE
+from archiveinterface.archivebackends.hpss.hpss_session import HpssSession, in_session, \
+    DEFAULT_CREDENTIAL_LIFETIME, DEFAULT_CREDENTIAL_REFRESH
 
 # Due to an update in hpss version we need to lazy load the linked
 # c types.  Doing this with dlopen flags. 8 is the UNIX flag Integer for
@@ -22,7 +26,8 @@ sys.setdlopenflags(RTLD_LAZY | RTLD_DEEPBIND)
 # pylint: enable=no-member
 # import cant be at top due to lazy load
 # pylint: disable=wrong-import-position
-from archiveinterface.archivebackends.hpss.hpss_extended import HpssExtended  # noqa: E402
+from archiveinterface.archivebackends.hpss.hpss_extended import HpssExtended, status_many, make_directories, \
+    check_credentials, CORE_MONITOR, DEFAULT_PING_INTERVAL  # noqa: E402
 # pylint: enable=wrong-import-position
 
 # place where hpss lib is installed on a unix machine
@@ -45,6 +50,18 @@ HPSS_RPC_AUTH_TYPE_KEYFILE = 3
 HPSS_RPC_AUTH_TYPE_KEY = 4
 HPSS_RPC_AUTH_TYPE_PASSWD = 5
 
+# whence for hpss_Fseek, same as stdio
+SEEK_SET = 0
+# most files to look up in one call to the c extensions
+STATUS_BATCH_SIZE = 500
+# size of the buffer each handle reads blocks into, grown if needed
+READ_BUFFER_SIZE = 1 << 20
+
+
+def new_read_buffer():
+    """Return a buffer for a handle to read blocks into."""
+    return create_string_buffer(READ_BUFFER_SIZE)
+
 
 def path_info_munge(filepath):
     """Munge the path for this filetype."""
@@ -65,49 +82,88 @@ class HpssBackendArchive(AbstractBackendArchive):
         self._filepath = None
         self._hpsslib = None
         self._latency = 5  # number not significant
+        CORE_MONITOR.configure(read_config_float('hpss', 'ping_interval', DEFAULT_PING_INTERVAL), self._latency)
         # need to load  the hpss libraries/ extensions
         try:
-            self._hpsslib = cdll.LoadLibrary(HPSS_LIBRARY_PATH)
+            self._hpsslib = self._load_library()
+            self._set_prototypes()
         except Exception as ex:
             err_str = "Can't load hpss libraries with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
-        # need to authenticate with hpss
-        try:
-            self.authenticate()
-        except Exception as ex:
-            err_str = "Can't authenticate with hpss, error: " + str(ex)
-            raise ArchiveInterfaceError(err_str)
+        # each process authenticates with hpss when it first needs to
+        self._session = HpssSession(
+            self.authenticate,
+            read_config_float('hpss', 'credential_lifetime', DEFAULT_CREDENTIAL_LIFETIME),
+            read_config_float('hpss', 'credential_refresh', DEFAULT_CREDENTIAL_REFRESH),
+            check_credentials
+        )
+        # each handle reads into the buffer of its context from the pool
+        self._init_handle_pool('hpss', new_read_buffer)
 
+    @in_session
     def open(self, filepath, mode):
-        """Open an hpss file."""
-        # want to close any open files first
-        try:
-            if self._file:
-                self.close()
-        except ArchiveInterfaceError as ex:
-            err_str = "Can't close previous hpss file before "\
-                      'opening new one with error: ' + str(ex)
-            raise ArchiveInterfaceError(err_str)
-
+        """Open an hpss file and return a new handle for it."""
+        handle = self._new_handle()
         # try to open file
         try:
-            fpath = un_abs_path(filepath)
-            filename = os.path.join(self._prefix, path_info_munge(fpath))
-            self._filepath = filename
-            hpss = HpssExtended(self._filepath, self._latency)
+            filename = self._archive_path(filepath)
+            hpss = HpssExtended(filename, self._latency)
             hpss.ping_core()
-            hpss.makedirs()
-            hpss_fopen = self._hpsslib.hpss_Fopen
-            hpss_fopen.restype = c_void_p
-            self._file = hpss_fopen(filename, mode)
-            if self._file < 0:
-                err_str = 'Failed opening Hpss File, code: ' + str(self._file)
+            # rec_makedirs costs a call to the core server for each part of the path
+            DIRECTORY_CACHE.makedirs(os.path.dirname(filename), make_directories)
+            hpss_file = self._hpsslib.hpss_Fopen(filename, mode)
+            if not hpss_file:
+                # the directory may have been removed since it was made
+                DIRECTORY_CACHE.invalidate(os.path.dirname(filename))
+                # hpss_Fopen sets errno like fopen
+                err_str = 'Failed opening Hpss File: {}, return value is: -{}'.format(filename, get_errno())
                 raise ArchiveInterfaceError(err_str)
-            return self
+            # pylint: disable=protected-access
+            handle._filepath = filename
+            handle._file = hpss_file
+            # pylint: enable=protected-access
+            return handle
         except Exception as ex:
+            # pylint: disable=protected-access
+            handle._release_handle()
+            # pylint: enable=protected-access
             err_str = "Can't open hpss file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    @staticmethod
+    def _load_library():
+        """Load the hpss client library."""
+        return CDLL(HPSS_LIBRARY_PATH, use_errno=True)
+
+    def _set_prototypes(self):
+        """Declare the types of the hpss library functions used.
+
+        They are declared once, before any handle is open, so threads
+        never change them under each other and file pointers are passed
+        at their full width. ctypes releases the GIL during each call so
+        transfers on other threads carry on.
+        """
+        prototypes = {
+            'hpss_SetLoginCred': ([c_char_p, c_int, c_int, c_int, c_char_p], c_int),
+            'hpss_Fopen': ([c_char_p, c_char_p], c_void_p),
+            # signed, they return a negative errno on failure
+            'hpss_Fread': ([c_void_p, c_size_t, c_size_t, c_void_p], c_ssize_t),
+            'hpss_Fwrite': ([c_void_p, c_size_t, c_size_t, c_void_p], c_ssize_t),
+            'hpss_Fseek': ([c_void_p, c_long, c_int], c_int),
+            'hpss_Fclose': ([c_void_p], c_int),
+            'hpss_Chmod': ([c_char_p, c_int], c_int),
+            'hpss_Unlink': ([c_char_p], c_int)
+        }
+        for name, (argtypes, restype) in prototypes.items():
+            function = getattr(self._hpsslib, name)
+            function.argtypes = argtypes
+            function.restype = restype
+
+    def _archive_path(self, filepath):
+        """Return the path in hpss for the file."""
+        fpath = un_abs_path(filepath)
+        return os.path.join(self._prefix, path_info_munge(fpath))
+
     def close(self):
         """Close an HPSS File."""
         try:
@@ -123,40 +179,65 @@ class HpssBackendArchive(AbstractBackendArchive):
         except Exception as ex:
             err_str = "Can't close hpss file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
+        finally:
+            self._release_handle()
 
     def read(self, blocksize):
         """Read a file from the hpss archive."""
         try:
             if self._filepath:
-                hpss = HpssExtended(self._filepath, self._latency)
-                hpss.ping_core()
-                buf = create_string_buffer('\000' * blocksize)
+                # the monitor keeps pinging the core server during transfers
+                CORE_MONITOR.check()
+                buf = self._context
+                if sizeof(buf) < blocksize:
+                    resize(buf, blocksize)
                 rcode = self._hpsslib.hpss_Fread(buf, 1, blocksize, self._file)
                 if rcode < 0:
                     err_str = 'Failed During HPSS Fread,'\
                               'return value is: ' + str(rcode)
                     raise ArchiveInterfaceError(err_str)
-                return buf.raw[:rcode]
+                # the only copy, out of the reused buffer
+                return string_at(buf, rcode)
         except Exception as ex:
             err_str = "Can't read hpss file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def seek(self, offset):
+        """Seek in a file from the hpss archive."""
+        try:
+            if self._filepath:
+                CORE_MONITOR.check()
+                rcode = self._hpsslib.hpss_Fseek(
+                    self._file, c_long(offset), SEEK_SET
+                )
+                if rcode < 0:
+                    err_str = 'Failed During HPSS Fseek,'\
+                              'return value is: ' + str(rcode)
+                    raise ArchiveInterfaceError(err_str)
+        except Exception as ex:
+            err_str = "Can't seek hpss file with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
     def write(self, buf):
         """Write a file to the hpss archive."""
         try:
             if self._filepath:
-                hpss = HpssExtended(self._filepath, self._latency)
-                hpss.ping_core()
-                buf_char_p = cast(buf, c_char_p)
+                CORE_MONITOR.check()
+                # ctypes passes the string's own bytes, without a copy
                 rcode = self._hpsslib.hpss_Fwrite(
-                    buf_char_p, 1, len(buf), self._file
+                    buf, 1, len(buf), self._file
                 )
+                if rcode < 0:
+                    err_str = 'Failed During HPSS Fwrite,'\
+                              'return value is: ' + str(rcode)
+                    raise ArchiveInterfaceError(err_str)
                 if rcode != len(buf):
                     raise ArchiveInterfaceError('Short write for hpss file')
         except Exception as ex:
             err_str = "Can't write hpss file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    @in_session
     def stage(self):
         """Stage an hpss file to the top level drive."""
         try:
@@ -168,17 +249,47 @@ class HpssBackendArchive(AbstractBackendArchive):
             err_str = "Can't stage hpss file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    @in_session
     def status(self):
         """Get the status of a file in the hpss archive."""
         try:
             if self._filepath:
-                hpss = HpssExtended(self._filepath, self._latency)
-                hpss.ping_core()
-                return hpss.status()
+                CORE_MONITOR.check()
+                return HpssExtended(self._filepath, self._latency).status()
+        except Exception as ex:
+            err_str = "Can't get hpss status with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    @in_session
+    def stat(self, filepath):
+        """Get the status of a file in the hpss archive without opening it."""
+        try:
+            # the lookup is the only call to the core server
+            CORE_MONITOR.check()
+            return HpssExtended(self._archive_path(filepath), self._latency).status()
         except Exception as ex:
             err_str = "Can't get hpss status with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def status_many(self, filepaths):
+        """Get the status of many files in the hpss archive, a call per batch."""
+        for batch in batched(filepaths, STATUS_BATCH_SIZE):
+            try:
+                paths = [self._archive_path(filepath) for filepath in batch]
+                statuses = self._session.run(self._status_batch, paths)
+            except Exception as ex:
+                err_str = "Can't get hpss status with error: " + str(ex)
+                statuses = [ArchiveInterfaceError(err_str)] * len(batch)
+            for filepath, status in zip(batch, statuses):
+                yield filepath, status
+
+    @staticmethod
+    def _status_batch(paths):
+        """Get the status of a batch of hpss paths in one call."""
+        CORE_MONITOR.check()
+        return status_many(paths)
+
+    @in_session
     def set_mod_time(self, mod_time):
         """Set the mod time for an hpss archive file."""
         try:
@@ -190,6 +301,33 @@ class HpssBackendArchive(AbstractBackendArchive):
             err_str = "Can't set hpss file mod time with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    @in_session
+    def set_digests(self, digests):
+        """Store the digests for an hpss archive file."""
+        try:
+            if self._filepath:
+                hpss = HpssExtended(self._filepath, self._latency)
+                hpss.ping_core()
+                hpss.set_digests(digests)
+        except Exception as ex:
+            err_str = "Can't set hpss file digests with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    def discard(self):
+        """Close an hpss archive file and remove it."""
+        self.close()
+        try:
+            if self._filepath:
+                rcode = self._hpsslib.hpss_Unlink(self._filepath)
+                if rcode < 0:
+                    err_str = 'Failed to unlink hpss file with code: ' + \
+                        str(rcode)
+                    raise ArchiveInterfaceError(err_str)
+        except Exception as ex:
+            err_str = "Can't discard hpss file with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    @in_session
     def set_file_permissions(self):
         """Set the file permissions for an hpss archive file."""
         try:
@@ -4,6 +4,10 @@
 
 Module that holds the class to the interface for the hpss c extensions.
 """
+import os
+import time
+import threading
+from collections import deque
 from os.path import dirname
 # c extension import not picked up by pylint, so disabling
 # pylint: disable=import-error
@@ -13,14 +17,181 @@ import archiveinterface.archivebackends.hpss._hpssExtensions as _hpssExtensions
 # pylint: enable=no-name-in-module
 from archiveinterface.archivebackends.hpss.hpss_status import HpssStatus
 from archiveinterface.archive_interface_error import ArchiveInterfaceError
+from archiveinterface.archive_utils import encode_digests, decode_digests
+from archiveinterface.metrics import METRICS, HPSS_PING_SECONDS
+from archiveinterface.archivebackends.hpss.hpss_session import is_auth_error
+
+# user defined attribute the file's digests are stored in
+DIGESTS_UDA = '/hpss/pacifica/digests'
+# seconds between pings of the core server by the monitor
+DEFAULT_PING_INTERVAL = 1.0
+# latency a ping may take before the core server is too slow
+DEFAULT_ACCEPT_LATENCY = 5
+# pings the rolling latency is taken over
+PING_WINDOW = 10
+
+
+def status_many(filepaths):
+    """Get the status of many files with one call to the c extensions.
+
+    Returns a status for each file, None if it doesn't exist or an
+    ArchiveInterfaceError if its status couldn't be read. Credentials
+    being refused raises the error instead, so the lookup is retried.
+    """
+    try:
+        results = _hpssExtensions.hpss_status_many(list(filepaths), DIGESTS_UDA)
+    except Exception as ex:
+        # Push the excpetion up the chain to the response
+        err_str = 'Error using c extensions for hpss status_many'\
+                  ' exception: ' + str(ex)
+        raise ArchiveInterfaceError(err_str)
+    statuses = []
+    for filepath, result in zip(filepaths, results):
+        if result is None or isinstance(result, str):
+            if result:
+                result = ArchiveInterfaceError(
+                    'Error using c extensions for hpss status exception: ' + result)
+                if is_auth_error(result):
+                    raise result
+            statuses.append(result)
+            continue
+        statuses.append(_make_status(filepath, result))
+    return statuses
+
+
+def make_directories(dirname):
+    """Make the hpss directory and its parents if it doesn't exist."""
+    try:
+        _hpssExtensions.hpss_makedirs(dirname)
+    except Exception as ex:
+        # Push the excpetion up the chain to the response
+        err_str = 'Error using c extension for hpss makedirs'\
+                  ' exception: ' + str(ex)
+        raise ArchiveInterfaceError(err_str)
+
+
+def check_credentials():
+    """Look up the root of the namespace, raising an error if hpss refuses the credentials."""
+    try:
+        _hpssExtensions.hpss_mtime('/')
+    except Exception as ex:
+        # Push the excpetion up the chain to the response
+        err_str = 'Error using c extension for hpss mtime'\
+                  ' exception: ' + str(ex)
+        raise ArchiveInterfaceError(err_str)
+
+
+def _make_status(filepath, result):
+    """Build the status of the file from its status tuple."""
+    mtime, ctime, bytes_per_level, filesize, digests = result
+    status = HpssStatus(mtime, ctime, bytes_per_level, filesize)
+    status.set_filepath(filepath)
+    status.set_digests(decode_digests(digests))
+    return status
+
+
+class CoreMonitor(object):
+    """Keep track of whether the core server is alive.
+
+    A background thread pings the core server every interval seconds
+    and remembers the result, so transfers can check the core server
+    is answering without a round trip to it for every block. When the
+    last ping is too old, because the thread is stuck or can't run,
+    the check pings the core server itself.
+    """
+
+    def __init__(self, interval=DEFAULT_PING_INTERVAL, accept_latency=DEFAULT_ACCEPT_LATENCY):
+        """Ping every interval seconds, pings slower than accept_latency fail."""
+        self._interval = interval
+        self._accept_latency = accept_latency
+        self._latencies = deque(maxlen=PING_WINDOW)
+        self._last_ping = None
+        self._error = None
+        self._lock = threading.Lock()
+        self._ping_lock = threading.Lock()
+        self._pid = None
+
+    def configure(self, interval, accept_latency):
+        """Change how often to ping and how slow a ping may be."""
+        with self._lock:
+            self._interval = interval
+            self._accept_latency = accept_latency
+
+    def record(self, latency=None, error=None):
+        """Remember the latency or error of a ping."""
+        with self._lock:
+            if latency is not None:
+                self._latencies.append(latency)
+            self._last_ping = time.time()
+            self._error = error
+
+    def ping(self):
+        """Ping the core server now, remembering the result."""
+        try:
+            HpssExtended(None, self._accept_latency, self).ping_core()
+        except ArchiveInterfaceError:
+            # ping_core has recorded the error
+            pass
+
+    def latency(self):
+        """Return the mean latency of the recent pings, None before the first."""
+        with self._lock:
+            if not self._latencies:
+                return None
+            return sum(self._latencies) / len(self._latencies)
+
+    def _stale(self):
+        """Return whether there is no ping recent enough to go by."""
+        with self._lock:
+            return (self._last_ping is None or
+                    time.time() - self._last_ping > max(3 * self._interval, self._accept_latency))
+
+    def check(self):
+        """Raise an error unless a recent ping succeeded, pinging now if none is recent."""
+        self._start()
+        if self._stale():
+            with self._ping_lock:
+                # another thread may have pinged while this one waited
+                if self._stale():
+                    self.ping()
+        with self._lock:
+            error = self._error
+        if error:
+            raise ArchiveInterfaceError(error)
+
+    def _start(self):
+        """Start the pinging thread, again in a process forked since."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            pinger = threading.Thread(target=self._run, name='hpss-core-monitor')
+            pinger.daemon = True
+            pinger.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        """Ping the core server forever."""
+        while True:
+            self.ping()
+            time.sleep(self._interval)
+
+
+CORE_MONITOR = CoreMonitor()
 
 
 class HpssExtended(object):
     """Provide the interface for the hpss ctypes."""
 
-    def __init__(self, filepath, accept_latency=5):
-        """Constructor for the HPSS Extended File type."""
+    def __init__(self, filepath, accept_latency=5, monitor=None):
+        """Constructor for the HPSS Extended File type.
+
+        Pings of the core server are recorded by the monitor, the
+        process's if none is given.
+        """
         self._accept_latency = accept_latency
+        self._monitor = monitor or CORE_MONITOR
         self._latency = None
         self._filepath = filepath
 
@@ -28,14 +199,23 @@ class HpssExtended(object):
         """Ping the Core server to see if its still active."""
         # Define acceptable latency in seconds
         acceptable_latency = self._accept_latency
-        latency_tuple = _hpssExtensions.hpss_ping_core()
+        try:
+            latency_tuple = _hpssExtensions.hpss_ping_core()
+        except Exception as ex:
+            err_str = 'Error using c extension for hpss ping_core'\
+                      ' exception: ' + str(ex)
+            self._monitor.record(error=err_str)
+            raise ArchiveInterfaceError(err_str)
         # Get the latency
         latency = self.parse_latency(latency_tuple)
+        METRICS.observe(HPSS_PING_SECONDS, latency)
 
         if latency > acceptable_latency:
             err_str = 'The archive core server is slow to respond'\
                       ' Latency is: ' + str(latency) + ' second(s)'
+            self._monitor.record(latency, err_str)
             raise ArchiveInterfaceError(err_str)
+        self._monitor.record(latency)
 
     def parse_latency(self, latency_tuple):
         """Parse the latency tuple.
@@ -64,25 +244,17 @@ class HpssExtended(object):
 
         If it is on tape or disk
         Found the documentation for this in the hpss programmers reference
-        section 2.3.6.2.8 "Get Extanded Attributes".
+        section 2.3.6.2.8 "Get Extanded Attributes". The times, size,
+        bytes per level and digests all come from one lookup.
         """
-        mtime = ''
-        ctime = ''
-        bytes_per_level = ''
-        filesize = ''
         try:
-            mtime = _hpssExtensions.hpss_mtime(self._filepath)
-            ctime = _hpssExtensions.hpss_ctime(self._filepath)
-            bytes_per_level = _hpssExtensions.hpss_status(self._filepath)
-            filesize = _hpssExtensions.hpss_filesize(self._filepath)
-            status = HpssStatus(mtime, ctime, bytes_per_level, filesize)
-            status.set_filepath(self._filepath)
+            result = _hpssExtensions.hpss_stat(self._filepath, DIGESTS_UDA)
         except Exception as ex:
             # Push the excpetion up the chain to the response
             err_str = 'Error using c extensions for hpss status'\
                       ' exception: ' + str(ex)
             raise ArchiveInterfaceError(err_str)
-        return status
+        return _make_status(self._filepath, result)
 
     def stage(self):
         """Stage an hpss file.
@@ -111,12 +283,18 @@ class HpssExtended(object):
                       ' exception: ' + str(ex)
             raise ArchiveInterfaceError(err_str)
 
-    def makedirs(self):
-        """Recursively make the directories for the filepath."""
+    def set_digests(self, digests):
+        """Use extensions to store the digests in a user defined attribute."""
         try:
-            _hpssExtensions.hpss_makedirs(dirname(self._filepath))
+            _hpssExtensions.hpss_setuda(
+                self._filepath, DIGESTS_UDA, encode_digests(digests))
+
         except Exception as ex:
             # Push the excpetion up the chain to the response
-            err_str = 'Error using c extension for hpss makedirs'\
+            err_str = 'Error using c extension for hpss setuda'\
                       ' exception: ' + str(ex)
             raise ArchiveInterfaceError(err_str)
+
+    def makedirs(self):
+        """Recursively make the directories for the filepath."""
+        make_directories(dirname(self._filepath))
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""HPSS Session Module.
+
+Module that keeps a process logged in to hpss. The login is made the
+first time a process needs it, so a server forked after the backend is
+created logs in once in each worker, and made again before the
+credentials expire. An operation hpss refuses with a permission error
+is retried once after logging in again, if looking up the root of the
+namespace shows it is the credentials hpss is refusing rather than
+access to the file.
+"""
+import os
+import re
+import sys
+import time
+import errno
+import threading
+from functools import wraps
+from archiveinterface.archive_interface_error import ArchiveInterfaceError
+
+# seconds the credentials from a login are good for
+DEFAULT_CREDENTIAL_LIFETIME = 28800
+# seconds before they expire to log in again
+DEFAULT_CREDENTIAL_REFRESH = 300
+# errors hpss returns when the credentials are no longer good
+AUTH_ERRNOS = (errno.EPERM, errno.EACCES)
+# the negative errno in the messages of the backend and the c extension
+ERROR_CODE = re.compile(r'(?:code|return value is): -(\d+)\b')
+
+
+def is_auth_error(ex):
+    """Return whether the error is a permission error hpss refuses credentials with."""
+    message = str(ex)
+    match = ERROR_CODE.search(message)
+    if match:
+        return int(match.group(1)) in AUTH_ERRNOS
+    return any(os.strerror(code) in message for code in AUTH_ERRNOS)
+
+
+class HpssSession(object):
+    """Login of the process to hpss."""
+
+    def __init__(self, authenticate, lifetime=DEFAULT_CREDENTIAL_LIFETIME,
+                 refresh=DEFAULT_CREDENTIAL_REFRESH, check_credentials=None):
+        """Log in by calling authenticate, again refresh seconds before lifetime is up.
+
+        check_credentials makes a call any valid credentials may, it
+        tells a refused login from a file the process can't access.
+        Without it every permission error is taken for a refused login.
+        """
+        self._authenticate = authenticate
+        self._check_credentials = check_credentials
+        self._lifetime = lifetime
+        self._refresh = refresh
+        self._pid = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def _valid(self):
+        """Return whether this process has credentials that aren't about to expire."""
+        return self._pid == os.getpid() and time.time() < self._expires
+
+    def login(self, force=False):
+        """Log in unless already logged in, or anyway if forced."""
+        if not force and self._valid():
+            return
+        with self._lock:
+            if not force and self._valid():
+                return
+            try:
+                self._authenticate()
+            except Exception as ex:
+                self._pid = None
+                err_str = "Can't authenticate with hpss, error: " + str(ex)
+                raise ArchiveInterfaceError(err_str)
+            self._pid = os.getpid()
+            self._expires = time.time() + self._lifetime - self._refresh
+
+    def _credentials_refused(self):
+        """Return whether hpss refuses the credentials of the process."""
+        if self._check_credentials is None:
+            return True
+        try:
+            self._check_credentials()
+        except ArchiveInterfaceError as ex:
+            return is_auth_error(ex)
+        return False
+
+    def run(self, operation, *args):
+        """Call the operation logged in, retrying once if the credentials are refused."""
+        self.login()
+        try:
+            return operation(*args)
+        except ArchiveInterfaceError as ex:
+            if not is_auth_error(ex):
+                raise
+            exc_info = sys.exc_info()
+        if not self._credentials_refused():
+            # a file the process can't access, logging in again won't help
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.login(force=True)
+        return operation(*args)
+
+
+def in_session(method):
+    """Decorate a backend method to run in the backend's hpss session."""
+    @wraps(method)
+    def run_in_session(self, *args):
+        """Run the method in the session."""
+        # pylint: disable=protected-access
+        return self._session.run(method, self, *args)
+        # pylint: enable=protected-access
+    return run_in_session
@@ -0,0 +1,455 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""HPSS Simulator Module.
+
+Module that stands in for libhpss and the _hpssExtensions c module on
+top of a local directory, so the hpss backend can be run, benchmarked
+and tested anywhere. Calls that go to the core server take the core
+latency. A new file has its bytes on the residency levels, and reading
+or staging a file that isn't on disk takes the recall delay.
+
+Residency and user defined attributes are kept in memory, so they are
+only seen by the process that set them. Like hpss, a process has to
+log in before calling the core server, and a forked process again.
+"""
+import os
+import sys
+import time
+import errno
+import threading
+from itertools import count
+from ctypes import memmove, string_at, set_errno, c_void_p
+from archiveinterface.archive_utils import read_config_value, read_config_float
+from archiveinterface.archive_interface_error import ArchiveInterfaceError
+
+# the hpss backend imports the c extensions under this name
+EXTENSIONS_MODULE = 'archiveinterface.archivebackends.hpss._hpssExtensions'
+# storage levels hpss reports bytes for
+HPSS_MAX_STORAGE_LEVELS = 5
+DEFAULT_CORE_LATENCY = 0.0
+DEFAULT_RECALL_DELAY = 0.0
+# levels a new file is on, disk with a copy on tape
+DEFAULT_RESIDENCY = '0, 1'
+
+
+class HpssSimulatorError(Exception):
+    """Error raised by the simulated c extensions."""
+
+    pass
+
+
+def _hpss_error(code):
+    """Return the simulated extension error for hpss returning -code."""
+    return HpssSimulatorError('{} (code: -{})'.format(os.strerror(code), code))
+
+
+def _os_error(ex):
+    """Return the simulated extension error for an OSError."""
+    return _hpss_error(ex.errno) if ex.errno else HpssSimulatorError(str(ex))
+
+
+def _mkdir_error(filepath, code):
+    """Return the message of the c extension failing to make a directory."""
+    return 'Unable to mkdir {}: {} (code: -{})'.format(filepath, os.strerror(code), code)
+
+
+class _CFunction(object):
+    """Function of the simulated library, with a restype like ctypes."""
+
+    def __init__(self, function, failure):
+        """Call function when called, returning failure if the core server refuses it."""
+        self._function = function
+        self._failure = failure
+        self.restype = None
+        self.argtypes = None
+
+    def __call__(self, *args):
+        """Call the function, converting what it returns to the restype like ctypes."""
+        try:
+            result = self._function(*args)
+        except HpssSimulatorError:
+            set_errno(errno.EACCES)
+            result = self._failure
+        if isinstance(result, (int, long)) and self.restype not in (None, c_void_p):
+            # an unsigned restype turns a negative errno into a huge count
+            result = self.restype(result).value
+        return result
+
+
+class _SimulatedLibrary(object):
+    """Functions of libhpss used by the hpss backend."""
+
+    def __init__(self, simulator):
+        """Make the functions of the library calling the simulator."""
+        for name in ('hpss_SetLoginCred', 'hpss_Fopen', 'hpss_Fread', 'hpss_Fwrite', 'hpss_Fseek',
+                     'hpss_Fclose', 'hpss_Chmod', 'hpss_Unlink'):
+            failure = None if name == 'hpss_Fopen' else -errno.EACCES
+            setattr(self, name, _CFunction(getattr(simulator, name), failure))
+
+
+class _SimulatedExtensions(object):
+    """Functions of the _hpssExtensions c module, calling the installed simulator."""
+
+    error = HpssSimulatorError
+
+    def __init__(self):
+        """Start with no simulator installed."""
+        self.simulator = None
+
+    def __getattr__(self, name):
+        """Return the extension function of the installed simulator."""
+        if not name.startswith('hpss_'):
+            raise AttributeError(name)
+        if self.simulator is None:
+            raise HpssSimulatorError('No hpss simulator is installed')
+        return getattr(self.simulator, 'ext_' + name)
+
+
+EXTENSIONS = _SimulatedExtensions()
+
+
+def register():
+    """Stand the simulated extensions in for the c extensions if they aren't loaded."""
+    module = sys.modules.setdefault(EXTENSIONS_MODULE, EXTENSIONS)
+    if module is not EXTENSIONS:
+        raise ArchiveInterfaceError("Can't simulate hpss, the hpss extensions are already loaded")
+    package = sys.modules[EXTENSIONS_MODULE.rsplit('.', 1)[0]]
+    package._hpssExtensions = EXTENSIONS
+
+
+def install(simulator):
+    """Make the simulated extensions call the simulator."""
+    register()
+    EXTENSIONS.simulator = simulator
+
+
+def parse_residency(value):
+    """Parse a comma separated list of storage levels."""
+    try:
+        levels = frozenset(int(level) for level in value.split(',') if level.strip())
+    except ValueError:
+        raise ArchiveInterfaceError("Can't parse hpss simulator residency: " + value)
+    if not levels or min(levels) < 0 or max(levels) >= HPSS_MAX_STORAGE_LEVELS:
+        raise ArchiveInterfaceError("Can't parse hpss simulator residency: " + value)
+    return levels
+
+
+class HpssSimulator(object):
+    """Simulated hpss system keeping its files in a local directory."""
+
+    def __init__(self, root='', core_latency=DEFAULT_CORE_LATENCY, recall_delay=DEFAULT_RECALL_DELAY,
+                 residency=DEFAULT_RESIDENCY):
+        """Create a simulator with hpss paths under root, the paths as they are if empty.
+
+        core_latency is the seconds each call to the core server takes,
+        residency the levels new files are on and recall_delay the
+        seconds taken to bring a file not on disk back to disk.
+        """
+        self.root = root
+        # like hpss the root of the namespace is always there
+        if root and not os.path.isdir(root):
+            os.makedirs(root, 0755)
+        self.core_latency = core_latency
+        self.recall_delay = recall_delay
+        self.residency = parse_residency(residency) if isinstance(residency, str) else frozenset(residency)
+        self.library = _SimulatedLibrary(self)
+        self.core_calls = 0
+        self.logins = 0
+        self.pings = 0
+        self.recalls = 0
+        self._login_pid = None
+        self._levels = {}
+        self._udas = {}
+        self._files = {}
+        self._handles = count(1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, section='hpss_simulator'):
+        """Create a simulator from the fields of the config section."""
+        return cls(
+            read_config_value(section, 'root', ''),
+            read_config_float(section, 'core_latency', DEFAULT_CORE_LATENCY),
+            read_config_float(section, 'recall_delay', DEFAULT_RECALL_DELAY),
+            read_config_value(section, 'residency', DEFAULT_RESIDENCY)
+        )
+
+    def local_path(self, filepath):
+        """Return the local path of the hpss path."""
+        if not self.root:
+            return filepath
+        return os.path.join(self.root, filepath.lstrip('/'))
+
+    def _core(self, login=True):
+        """Wait for a round trip to the core server, which needs a login if asked."""
+        with self._lock:
+            self.core_calls += 1
+            if login and self._login_pid != os.getpid():
+                raise _hpss_error(errno.EACCES)
+        if self.core_latency:
+            time.sleep(self.core_latency)
+
+    def levels(self, filepath):
+        """Return the storage levels the file is on."""
+        with self._lock:
+            return self._levels.get(self.local_path(filepath), self.residency)
+
+    def expire_login(self):
+        """Make the core server refuse calls until the process logs in again."""
+        with self._lock:
+            self._login_pid = None
+
+    def set_levels(self, filepath, levels):
+        """Move the file to the storage levels, such as purging it from disk."""
+        with self._lock:
+            self._levels[self.local_path(filepath)] = frozenset(levels)
+
+    def _recall(self, path):
+        """Bring the file at the local path back to disk if it isn't there."""
+        with self._lock:
+            levels = self._levels.get(path, self.residency)
+        if 0 in levels:
+            return
+        time.sleep(self.recall_delay)
+        with self._lock:
+            self._levels[path] = levels | frozenset([0])
+            self.recalls += 1
+
+    # the library functions keep the hpss names
+    # pylint: disable=invalid-name
+    # pylint: disable=unused-argument
+    # pylint: disable=too-many-arguments
+
+    def hpss_SetLoginCred(self, user, mech, cred_type, auth_type, auth):
+        """Log in to the core server."""
+        self._core(login=False)
+        if not user:
+            return -errno.EPERM
+        with self._lock:
+            self.logins += 1
+            self._login_pid = os.getpid()
+        return 0
+
+    def hpss_Fopen(self, filepath, mode):
+        """Open the file, returning None and setting errno if it can't be."""
+        self._core()
+        path = self.local_path(filepath)
+        try:
+            hpss_file = open(path, mode)
+        except (IOError, OSError) as ex:
+            set_errno(ex.errno)
+            return None
+        with self._lock:
+            if 'w' in mode:
+                self._levels[path] = self.residency
+                self._udas.pop(path, None)
+            handle = next(self._handles)
+            self._files[handle] = (hpss_file, path)
+        return handle
+
+    def hpss_Fread(self, buf, size, nitems, handle):
+        """Read up to nitems of size bytes into buf, returning the items read.
+
+        Reading a file that isn't on disk recalls it first.
+        """
+        try:
+            hpss_file, path = self._files[handle]
+            self._recall(path)
+            data = hpss_file.read(size * nitems)
+        except (IOError, ValueError, KeyError):
+            return -errno.EBADF
+        memmove(buf, data, len(data))
+        return len(data) // size
+
+    def hpss_Fwrite(self, buf, size, nitems, handle):
+        """Write nitems of size bytes from buf, returning the items written."""
+        try:
+            self._files[handle][0].write(string_at(buf, size * nitems))
+        except (IOError, ValueError, KeyError):
+            return -errno.EBADF
+        return nitems
+
+    def hpss_Fseek(self, handle, offset, whence):
+        """Move the position in the file."""
+        try:
+            self._files[handle][0].seek(getattr(offset, 'value', offset), whence)
+        except (IOError, KeyError):
+            return -errno.EINVAL
+        return 0
+
+    def hpss_Fclose(self, handle):
+        """Close the file."""
+        self._core()
+        with self._lock:
+            hpss_file, _path = self._files.pop(handle, (None, None))
+        if hpss_file is None:
+            return -errno.EBADF
+        hpss_file.close()
+        return 0
+
+    def hpss_Chmod(self, filepath, mode):
+        """Change the permissions of the file."""
+        self._core()
+        try:
+            os.chmod(self.local_path(filepath), mode)
+        except OSError as ex:
+            return -ex.errno
+        return 0
+
+    def hpss_Unlink(self, filepath):
+        """Remove the file."""
+        self._core()
+        path = self.local_path(filepath)
+        try:
+            os.unlink(path)
+        except OSError as ex:
+            return -ex.errno
+        with self._lock:
+            self._levels.pop(path, None)
+            self._udas.pop(path, None)
+        return 0
+
+    # pylint: enable=too-many-arguments
+    # pylint: enable=unused-argument
+    # pylint: enable=invalid-name
+
+    def _stat(self, filepath):
+        """Return the local stat of the file, raising the extension error."""
+        self._core()
+        try:
+            return os.stat(self.local_path(filepath))
+        except OSError as ex:
+            raise _os_error(ex)
+
+    def _bytes_per_level(self, path, size):
+        """Return the bytes of the file at each storage level."""
+        with self._lock:
+            levels = self._levels.get(path, self.residency)
+        return tuple(size if level in levels else 0 for level in range(HPSS_MAX_STORAGE_LEVELS))
+
+    def ext_hpss_ping_core(self):
+        """Ping the core server, returning its response and the time before."""
+        before = time.time()
+        self._core(login=False)
+        after = time.time()
+        with self._lock:
+            self.pings += 1
+        return (int(after), int(after % 1 * 1000000), int(before), int(before % 1 * 1000000))
+
+    def ext_hpss_mtime(self, filepath):
+        """Return the mtime of the file."""
+        return int(self._stat(filepath).st_mtime)
+
+    def ext_hpss_ctime(self, filepath):
+        """Return the ctime of the file."""
+        return int(self._stat(filepath).st_ctime)
+
+    def ext_hpss_filesize(self, filepath):
+        """Return the size of the file."""
+        return self._stat(filepath).st_size
+
+    def ext_hpss_status(self, filepath):
+        """Return the bytes of the file at each storage level."""
+        stat = self._stat(filepath)
+        return self._bytes_per_level(self.local_path(filepath), stat.st_size)
+
+    def _status_tuple(self, filepath, key):
+        """Return the status tuple of the file, None if missing or the error message."""
+        path = self.local_path(filepath)
+        try:
+            stat = self._stat(filepath)
+        except HpssSimulatorError as ex:
+            if not os.path.exists(path):
+                return None
+            return str(ex)
+        with self._lock:
+            uda = self._udas.get(path, {}).get(key)
+        return (int(stat.st_mtime), int(stat.st_ctime), self._bytes_per_level(path, stat.st_size),
+                stat.st_size, uda)
+
+    def ext_hpss_stat(self, filepath, key):
+        """Return the status tuple of the file from one lookup."""
+        status = self._status_tuple(filepath, key)
+        if status is None:
+            raise HpssSimulatorError(os.strerror(errno.ENOENT))
+        if isinstance(status, str):
+            raise HpssSimulatorError(status)
+        return status
+
+    def ext_hpss_status_many(self, filepaths, key):
+        """Return the status tuple of each file, None if missing or the error message."""
+        return [self._status_tuple(filepath, key) for filepath in filepaths]
+
+    def ext_hpss_stage(self, filepath):
+        """Stage the file to disk."""
+        path = self.local_path(filepath)
+        self._stat(filepath)
+        self._recall(path)
+
+    def ext_hpss_utime(self, filepath, mtime):
+        """Set the mtime of the file."""
+        self._core()
+        try:
+            os.utime(self.local_path(filepath), (mtime, mtime))
+        except OSError as ex:
+            raise _os_error(ex)
+
+    def ext_hpss_makedirs(self, filepath):
+        """Make the directory and its parents.
+
+        Like the c extension each part of the path is a stat and a mkdir
+        on the core server, so threads making the same directory race.
+        """
+        self._core()
+        path = self.local_path(filepath)
+        if os.path.isdir(path):
+            return
+        if os.path.exists(path):
+            raise HpssSimulatorError('File is not a directory.')
+        parent = os.path.dirname(filepath)
+        if parent == filepath:
+            raise HpssSimulatorError(_mkdir_error(filepath, errno.ENOENT))
+        self.ext_hpss_makedirs(parent)
+        self._core()
+        try:
+            os.mkdir(path, 0755)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise HpssSimulatorError(_mkdir_error(filepath, ex.errno))
+            # another thread or process made it since the stat
+            if not os.path.isdir(path):
+                raise HpssSimulatorError(_mkdir_error(filepath, errno.ENOTDIR))
+
+    def ext_hpss_setuda(self, filepath, key, value):
+        """Set a user defined attribute on the file."""
+        self._stat(filepath)
+        with self._lock:
+            self._udas.setdefault(self.local_path(filepath), {})[key] = value
+
+    def ext_hpss_getuda(self, filepath, key):
+        """Return a user defined attribute of the file, None if it isn't set."""
+        path = self.local_path(filepath)
+        self._core()
+        with self._lock:
+            return self._udas.get(path, {}).get(key) or None
+
+
+register()
+# the backend can only be imported once the extensions are registered
+# pylint: disable=wrong-import-position
+from archiveinterface.archivebackends.hpss.hpss_backend_archive import HpssBackendArchive  # noqa: E402
+# pylint: enable=wrong-import-position
+
+
+class HpssSimulatorBackendArchive(HpssBackendArchive):
+    """The HPSS backend archive running against a simulated hpss."""
+
+    def __init__(self, prefix, simulator=None):
+        """Create the backend on the simulator, one from the config if not given."""
+        self._simulator = simulator or HpssSimulator.from_config()
+        install(self._simulator)
+        super(HpssSimulatorBackendArchive, self).__init__(prefix)
+
+    def _load_library(self):
+        """Return the simulated hpss library."""
+        return self._simulator.library
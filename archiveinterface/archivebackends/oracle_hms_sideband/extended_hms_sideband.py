@@ -6,6 +6,105 @@ from archiveinterface.archivebackends.oracle_hms_sideband.hms_sideband_status im
     HmsSidebandStatus)
 from archiveinterface.archivebackends.oracle_hms_sideband.hms_sideband_orm import (
     SamInode, SamFile, SamPath)
+from archiveinterface.archivebackends.posix.extended_attributes import read_digests
+from archiveinterface.metrics import METRICS, HMS_QUERY_SECONDS
+
+
+def _sam_qfs_key(sam_qfs_path):
+    """Return the (directory, name) the sideband database keys a file by."""
+    # need to add a slash for sideband db
+    return os.path.dirname(sam_qfs_path) + '/', os.path.basename(sam_qfs_path)
+
+
+def sam_qfs_status(filepath, sam_qfs_path):
+    """Return status of the file at filepath from the sideband database."""
+    directory, filename = _sam_qfs_key(sam_qfs_path)
+    return _make_status(filepath, _stat_ino_sql(filename, directory))
+
+
+def sam_qfs_status_many(paths):
+    """Return the status of many (filepath, sam_qfs_path) pairs.
+
+    The records are looked up with a single query and a status of
+    None is returned for each file the database doesn't know about.
+    """
+    keys = [_sam_qfs_key(sam_qfs_path) for _, sam_qfs_path in paths]
+    records = _stat_ino_many_sql(keys)
+    return [_make_status(filepath, records.get(key)) for (filepath, _), key in zip(paths, keys)]
+
+
+def _make_status(filepath, stat_record):
+    """Build the status of the file from its database record."""
+    if stat_record:
+        mtime = stat_record['mtime']
+        ctime = stat_record['ctime']
+        # if the record is online then on disk, else say not on disk but on tape
+        if stat_record['online'] == 1:
+            bytes_per_level = (long(stat_record['size']),)
+        else:
+            bytes_per_level = (long(0), long(stat_record['size']))
+        filesize = stat_record['size']
+        status = HmsSidebandStatus(mtime, ctime, bytes_per_level, filesize)
+        status.set_filepath(filepath)
+        status.set_digests(read_digests(filepath))
+        return status
+    return None
+
+
+def _stat_ino_sql(fname, directory):
+    """Return the record for specified file and directory."""
+    SamInode.database_connect()
+    try:
+        with METRICS.timer(HMS_QUERY_SECONDS, (('query', 'status'),)):
+            result = (
+                SamInode.select()
+                .join(SamFile, on=(SamFile.ino == SamInode.ino))
+                .join(SamPath, on=(SamPath.ino == SamFile.p_ino))
+                .where(SamPath.path == str(directory), SamFile.name == str(fname))
+                .get()
+            )
+    finally:
+        # hand the connection back to the pool even when the file isn't found
+        SamInode.database_close()
+
+    if result:
+        return _make_status_dictionary(result)
+    return None
+
+
+def _stat_ino_many_sql(keys):
+    """Return the records for (directory, name) keys by key in one query."""
+    if not keys:
+        return {}
+    directories = list(set(directory for directory, _ in keys))
+    names = list(set(name for _, name in keys))
+    SamInode.database_connect()
+    try:
+        query = (
+            SamInode.select(SamInode, SamPath.path, SamFile.name)
+            .join(SamFile, on=(SamFile.ino == SamInode.ino))
+            .join(SamPath, on=(SamPath.ino == SamFile.p_ino))
+            .where((SamPath.path << directories) & (SamFile.name << names))
+            .naive()
+        )
+        wanted = set(keys)
+        records = {}
+        with METRICS.timer(HMS_QUERY_SECONDS, (('query', 'status_many'),)):
+            results = list(query)
+        for result in results:
+            key = (result.path, result.name)
+            if key in wanted:
+                records[key] = _make_status_dictionary(result)
+    finally:
+        SamInode.database_close()
+    return records
+
+
+def _make_status_dictionary(result):
+    """Break the query results into a dictionary."""
+    status = {'ino': result.ino, 'size': result.size, 'ctime': result.create_time,
+              'mtime': result.modify_time, 'online': result.online}
+    return status
 
 
 class ExtendedHmsSideband(file):
@@ -19,47 +118,8 @@ class ExtendedHmsSideband(file):
 
     def status(self):
         """Return status of file."""
-        filename = os.path.basename(self._sam_qfs_path)
-        # need to add a slash for sideband db
-        directory = os.path.dirname(self._sam_qfs_path) + '/'
-        stat_record = self._stat_ino_sql(filename, directory)
-        if stat_record:
-            mtime = stat_record['mtime']
-            ctime = stat_record['ctime']
-            # if the record is online then on disk, else say not on disk but on tape
-            if stat_record['online'] == 1:
-                bytes_per_level = (long(stat_record['size']),)
-            else:
-                bytes_per_level = (long(0), long(stat_record['size']))
-            filesize = stat_record['size']
-            status = HmsSidebandStatus(mtime, ctime, bytes_per_level, filesize)
-            status.set_filepath(self._path)
-            return status
-        return None
+        return sam_qfs_status(self._path, self._sam_qfs_path)
 
     def stage(self):
         """Stage a file. HMS stages a file when a read call is made."""
         self.read()
-
-    def _stat_ino_sql(self, fname, directory):
-        """Return the record for specified file and directory."""
-        SamInode.database_connect()
-        result = (
-            SamInode.select()
-            .join(SamFile, on=(SamFile.ino == SamInode.ino))
-            .join(SamPath, on=(SamPath.ino == SamFile.p_ino))
-            .where(SamPath.path == str(directory), SamFile.name == str(fname))
-            .get()
-        )
-        SamInode.database_close()
-
-        if result:
-            return self._make_status_dictionary(result)
-        return None
-
-    @staticmethod
-    def _make_status_dictionary(result):
-        """Break the query results into a dictionary."""
-        status = {'ino': result.ino, 'size': result.size, 'ctime': result.create_time,
-                  'mtime': result.modify_time, 'online': result.online}
-        return status
@@ -6,14 +6,20 @@ Module that implements the abstract_backend_archive class for a HMS Sideband
 backend.
 """
 import os
-from archiveinterface.archive_utils import un_abs_path, read_config_value
+import errno
+from archiveinterface.archive_utils import un_abs_path, read_config_value, batched
 from archiveinterface.archive_interface_error import ArchiveInterfaceError
 from archiveinterface.archivebackends.oracle_hms_sideband.extended_hms_sideband import (
-    ExtendedHmsSideband)
+    ExtendedHmsSideband, sam_qfs_status, sam_qfs_status_many)
+from archiveinterface.archivebackends.posix.extended_attributes import write_digests
 from archiveinterface.archivebackends.abstract.abstract_backend_archive \
     import AbstractBackendArchive
+from archiveinterface.archivebackends.directory_cache import DIRECTORY_CACHE, make_local_directory
 from archiveinterface.id2filename import id2filename
 
+# most files to look up in one sideband database query
+STATUS_BATCH_SIZE = 500
+
 
 def path_info_munge(filepath):
     """Munge the path for this filetype."""
@@ -38,33 +44,43 @@ class HmsSidebandBackendArchive(AbstractBackendArchive):
         # since the database prefix may be different then the system the file is mounted on
         self._sam_qfs_prefix = read_config_value(
             'hms_sideband', 'sam_qfs_prefix')
+        self._init_handle_pool('hms_sideband')
 
     def open(self, filepath, mode):
-        """Open a hms sideband file."""
-        # want to close any open files first
-        try:
-            self.close()
-        except ArchiveInterfaceError as ex:
-            err_str = "Can't close previous HMS Sideband file before opening new "\
-                      'one with error: ' + str(ex)
-            raise ArchiveInterfaceError(err_str)
+        """Open a hms sideband file and return a new handle for it."""
+        handle = self._new_handle()
         try:
-            self._fpath = un_abs_path(filepath)
-            filename = os.path.join(self._prefix, path_info_munge(self._fpath))
-            self._filepath = filename
-            # path database refers to, rather then just the file system mount path
-            sam_qfs_path = os.path.join(
-                self._sam_qfs_prefix, path_info_munge(self._fpath))
+            fpath = un_abs_path(filepath)
+            filename, sam_qfs_path = self._archive_paths(fpath)
             dirname = os.path.dirname(filename)
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname, 0755)
-            self._file = ExtendedHmsSideband(
-                self._filepath, mode, sam_qfs_path)
-            return self
+            DIRECTORY_CACHE.makedirs(dirname, make_local_directory)
+            # pylint: disable=protected-access
+            handle._fpath = fpath
+            handle._filepath = filename
+            try:
+                handle._file = ExtendedHmsSideband(filename, mode, sam_qfs_path)
+            except EnvironmentError as ex:
+                if ex.errno == errno.ENOENT:
+                    # the directory may have been removed since it was made
+                    DIRECTORY_CACHE.invalidate(dirname)
+                raise
+            # pylint: enable=protected-access
+            return handle
         except Exception as ex:
+            # pylint: disable=protected-access
+            handle._release_handle()
+            # pylint: enable=protected-access
             err_str = "Can't open HMS Sideband file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def _archive_paths(self, fpath):
+        """Return the mounted path and the database path for the file."""
+        filename = os.path.join(self._prefix, path_info_munge(fpath))
+        # path database refers to, rather then just the file system mount path
+        sam_qfs_path = os.path.join(
+            self._sam_qfs_prefix, path_info_munge(fpath))
+        return filename, sam_qfs_path
+
     def close(self):
         """Close a HMS Sideband file."""
         try:
@@ -74,6 +90,8 @@ class HmsSidebandBackendArchive(AbstractBackendArchive):
         except Exception as ex:
             err_str = "Can't close HMS Sideband file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
+        finally:
+            self._release_handle()
 
     def read(self, blocksize):
         """Read a HMS Sideband file."""
@@ -84,6 +102,26 @@ class HmsSidebandBackendArchive(AbstractBackendArchive):
             err_str = "Can't read HMS SIdeband file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def fileno(self):
+        """Return the file descriptor of the open HMS Sideband file.
+
+        Lets the WSGI server send the file with sendfile(2).
+        """
+        try:
+            return self._file.fileno()
+        except Exception as ex:
+            err_str = "Can't get HMS Sideband file descriptor with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    def seek(self, offset):
+        """Seek in a HMS Sideband file."""
+        try:
+            if self._file:
+                return self._file.seek(offset)
+        except Exception as ex:
+            err_str = "Can't seek HMS Sideband file with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
     def write(self, buf):
         """Write a HMS Sideband file to the archive."""
         try:
@@ -103,6 +141,25 @@ class HmsSidebandBackendArchive(AbstractBackendArchive):
                 str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def set_digests(self, digests):
+        """Store the digests of a HMS file in an extended attribute."""
+        try:
+            if self._filepath:
+                write_digests(self._filepath, digests)
+        except Exception as ex:
+            err_str = "Can't set HMS Sideband file digests with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    def discard(self):
+        """Close a HMS file and remove it."""
+        self.close()
+        try:
+            if self._filepath:
+                os.unlink(self._filepath)
+        except Exception as ex:
+            err_str = "Can't discard HMS Sideband file with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
     def set_file_permissions(self):
         """Set the file permissions for a posix file."""
         try:
@@ -131,3 +188,27 @@ class HmsSidebandBackendArchive(AbstractBackendArchive):
             err_str = "Can't get HMS Sideband file status with error: " + \
                 str(ex)
             raise ArchiveInterfaceError(err_str)
+
+    def stat(self, filepath):
+        """Get the status of a HMS Sideband file without opening it."""
+        try:
+            filename, sam_qfs_path = self._archive_paths(un_abs_path(filepath))
+            return sam_qfs_status(filename, sam_qfs_path)
+        except Exception as ex:
+            err_str = "Can't get HMS Sideband file status with error: " + \
+                str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    def status_many(self, filepaths):
+        """Get the status of many HMS Sideband files, a query per batch."""
+        for batch in batched(filepaths, STATUS_BATCH_SIZE):
+            try:
+                statuses = sam_qfs_status_many([
+                    self._archive_paths(un_abs_path(filepath)) for filepath in batch
+                ])
+            except Exception as ex:
+                err_str = "Can't get HMS Sideband file status with error: " + \
+                    str(ex)
+                statuses = [ArchiveInterfaceError(err_str)] * len(batch)
+            for filepath, status in zip(batch, statuses):
+                yield filepath, status
@@ -1,27 +1,66 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-"""ORM for the sideband database."""
+"""ORM for the sideband database.
+
+The models are bound to a proxy that is pointed at a pool of connections
+the first time a process queries the database, so importing the module
+doesn't connect and forked workers don't share connections. Connecting
+takes a connection from the pool and closing gives it back. The pool
+holds a connection for each thread running requests, a thread finding
+them all in use waits for one to be given back. The pool pings a
+connection before handing it out, dropping it if the server has gone
+away, and drops connections older than the max age.
+"""
 # disabling some pylint checks due to this being a database model
 # things like too few methods and invalid class attributes like id
 # pylint: disable=too-few-public-methods
 # pylint: disable=invalid-name
 
-from peewee import MySQLDatabase, CharField
+import os
+import threading
+from peewee import Proxy, CharField
 from peewee import IntegerField, BigIntegerField
 from peewee import Model, CompositeKey, FloatField
-from archiveinterface.archive_utils import read_config_value
+from playhouse.pool import PooledMySQLDatabase
+from archiveinterface.archive_utils import read_config_value, read_config_int
+from archiveinterface.archive_server import request_threads
 
-MYSQL_ADDR = read_config_value('hms_sideband', 'host')
-MYSQL_PORT = read_config_value('hms_sideband', 'port')
-MYSQL_USER = read_config_value('hms_sideband', 'user')
-MYSQL_PASS = read_config_value('hms_sideband', 'password')
-MYSQL_SCHEMA = read_config_value('hms_sideband', 'schema')
+# seconds a connection is used for before it is closed and opened again
+DEFAULT_CONNECTION_MAX_AGE = 3600
+# seconds to wait for a connection when all of them are in use
+DEFAULT_CONNECTION_TIMEOUT = 30
 
-DB = MySQLDatabase(MYSQL_SCHEMA,
-                   host=MYSQL_ADDR,
-                   port=int(MYSQL_PORT),
-                   user=MYSQL_USER,
-                   passwd=MYSQL_PASS)
+DB = Proxy()
+_DB_LOCK = threading.Lock()
+_DB_PID = {'pid': None}
+
+
+def _make_database():
+    """Create the pool of connections to the sideband database from the config.
+
+    Without max_connections the pool has a connection for each thread
+    running requests in the process.
+    """
+    return PooledMySQLDatabase(
+        read_config_value('hms_sideband', 'schema'),
+        max_connections=read_config_int('hms_sideband', 'max_connections', request_threads()),
+        stale_timeout=read_config_int('hms_sideband', 'connection_max_age', DEFAULT_CONNECTION_MAX_AGE),
+        timeout=read_config_int('hms_sideband', 'connection_timeout', DEFAULT_CONNECTION_TIMEOUT),
+        host=read_config_value('hms_sideband', 'host'),
+        port=read_config_int('hms_sideband', 'port'),
+        user=read_config_value('hms_sideband', 'user'),
+        passwd=read_config_value('hms_sideband', 'password')
+    )
+
+
+def init_database():
+    """Point the models at a pool of this process unless they already are."""
+    if _DB_PID['pid'] == os.getpid():
+        return
+    with _DB_LOCK:
+        if _DB_PID['pid'] != os.getpid():
+            DB.initialize(_make_database())
+            _DB_PID['pid'] = os.getpid()
 
 
 class BaseModel(Model):
@@ -34,8 +73,9 @@ class BaseModel(Model):
     def database_connect(cls):
         """Make sure database is connected.
 
-        Dont reopen connection.
+        Dont reopen connection, a new one is taken from the pool.
         """
+        init_database()
         # pylint: disable=no-member
         if cls._meta.database.is_closed():
             cls._meta.database.connect()
@@ -43,7 +83,7 @@ class BaseModel(Model):
 
     @classmethod
     def database_close(cls):
-        """Close the database connection."""
+        """Give the database connection back to the pool."""
         # pylint: disable=no-member
         if not cls._meta.database.is_closed():
             cls._meta.database.close()
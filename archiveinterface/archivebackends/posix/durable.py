@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Durable Write Module.
+
+Module that lets posix style backends write a file durably. The file
+is written under a temporary name in the same directory and committed
+by fsyncing it, renaming it into place and fsyncing the directory, so
+a crash never leaves a partial file at the final path.
+
+Commits from concurrent writers are grouped. While one batch is being
+flushed the next writers queue up and are flushed together by the
+first of them. The data of each file in a batch is synced, the files are
+renamed and each directory they went to is synced once. A batch can
+instead sync its files with one syncfs of each filesystem, which also
+flushes everything else written to the filesystem, such as other
+uploads in flight, so it is only done if asked for.
+"""
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import threading
+from uuid import uuid4
+
+
+def _load_syncfs():
+    """Return the syncfs function of the C library, None if there isn't one."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.syncfs
+    except (OSError, AttributeError):
+        return None
+
+
+_SYNCFS = _load_syncfs()
+# the size of a new file is still synced, the other metadata isn't needed
+datasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def syncfs(fdesc):
+    """Flush everything written to the filesystem holding fdesc to disk."""
+    if _SYNCFS(fdesc) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def temp_path(filepath):
+    """Return a unique temporary path next to filepath."""
+    dirname, basename = os.path.split(filepath)
+    return os.path.join(dirname, '.{}.{}.part'.format(basename, uuid4().hex))
+
+
+def check_not_read_only(filepath):
+    """Raise an IOError if filepath exists and has been made read only.
+
+    Files are made read only once they are archived, renaming over
+    them would bypass that even for root.
+    """
+    try:
+        mode = os.stat(filepath).st_mode
+    except OSError as ex:
+        if ex.errno == errno.ENOENT:
+            return
+        raise
+    if not mode & 0222:
+        raise IOError(errno.EACCES, os.strerror(errno.EACCES), filepath)
+
+
+def fsync_dir(dirname):
+    """Flush the entries of directory dirname to disk."""
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def commit_file(fileobj, temp_filepath, filepath):
+    """Durably move one written temporary file to filepath on its own."""
+    datasync(fileobj.fileno())
+    os.rename(temp_filepath, filepath)
+    fsync_dir(os.path.dirname(filepath))
+
+
+# pylint: disable=too-few-public-methods
+class _PendingCommit(object):
+    """A file waiting to be committed."""
+
+    def __init__(self, fileobj, temp_filepath, filepath):
+        """Save the open temporary file and where it goes."""
+        self.fileobj = fileobj
+        self.temp_filepath = temp_filepath
+        self.filepath = filepath
+        self.finished = False
+        self.error = None
+# pylint: enable=too-few-public-methods
+
+
+class GroupCommit(object):
+    """Commit temporary files into place in groups."""
+
+    def __init__(self, window=0, use_syncfs=False):
+        """Create a group commit waiting window seconds for more writers.
+
+        With use_syncfs the files of a batch are synced with a syncfs
+        of each filesystem, where the platform has it.
+        """
+        self._window = window
+        self._use_syncfs = use_syncfs and _SYNCFS is not None
+        self._cond = threading.Condition()
+        self._pending = []
+        self._flushing = False
+        self.batches = 0
+
+    def commit(self, fileobj, temp_filepath, filepath):
+        """Durably move the written temporary file to filepath.
+
+        The file object must be flushed and still open. Returns once
+        the file and its directory entry are on disk.
+        """
+        entry = _PendingCommit(fileobj, temp_filepath, filepath)
+        self._cond.acquire()
+        try:
+            self._pending.append(entry)
+            while not entry.finished:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                self._flushing = True
+                self._cond.release()
+                try:
+                    if self._window:
+                        time.sleep(self._window)
+                    with self._cond:
+                        batch, self._pending = self._pending, []
+                    self._flush(batch)
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if entry.error:
+            raise entry.error
+
+    # pylint: disable=broad-except
+    def _flush(self, batch):
+        """Sync, rename and sync the directories of a batch of files."""
+        self.batches += 1
+        if self._use_syncfs:
+            self._sync_filesystems(batch)
+        else:
+            self._sync_each(batch, lambda entry: datasync(entry.fileobj.fileno()))
+        for entry in batch:
+            if entry.error:
+                continue
+            try:
+                os.rename(entry.temp_filepath, entry.filepath)
+            except Exception as ex:
+                entry.error = ex
+        self._sync_each(batch, lambda entry: fsync_dir(os.path.dirname(entry.filepath)),
+                        lambda entry: os.path.dirname(entry.filepath))
+        for entry in batch:
+            entry.finished = True
+
+    @staticmethod
+    def _sync_each(batch, sync, key=id):
+        """Call sync once for each key of the entries without an error."""
+        errors = {}
+        for entry in batch:
+            if entry.error:
+                continue
+            try:
+                entry_key = key(entry)
+            except Exception as ex:
+                entry.error = ex
+                continue
+            if entry_key not in errors:
+                try:
+                    sync(entry)
+                    errors[entry_key] = None
+                except Exception as ex:
+                    errors[entry_key] = ex
+            entry.error = errors[entry_key]
+
+    @staticmethod
+    def _sync_filesystems(batch):
+        """Syncfs each filesystem the entries without an error are on once."""
+        def device(entry):
+            """Return the filesystem the entry is on."""
+            return os.fstat(entry.fileobj.fileno()).st_dev
+        GroupCommit._sync_each(batch, lambda entry: syncfs(entry.fileobj.fileno()), device)
+    # pylint: enable=broad-except
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Extended Attributes Module.
+
+Module that reads and writes extended attributes on posix files
+through libc, since python 2 has no os.getxattr or os.setxattr.
+"""
+import os
+import errno
+from ctypes import CDLL, create_string_buffer, get_errno, c_char_p, c_void_p, c_size_t, c_int, c_ssize_t
+from ctypes.util import find_library
+from archiveinterface.archive_utils import encode_digests, decode_digests
+
+# extended attribute the file's digests are stored in
+DIGESTS_XATTR = 'user.pacifica.digests'
+# errors that mean the filesystem can't hold extended attributes
+NOT_SUPPORTED = (errno.ENOTSUP, errno.EOPNOTSUPP)
+
+_LIBC = CDLL(find_library('c'), use_errno=True)
+_LIBC.setxattr.argtypes = [c_char_p, c_char_p, c_char_p, c_size_t, c_int]
+_LIBC.setxattr.restype = c_int
+_LIBC.getxattr.argtypes = [c_char_p, c_char_p, c_void_p, c_size_t]
+_LIBC.getxattr.restype = c_ssize_t
+
+
+def _raise_errno(filepath):
+    """Raise an OSError for the last libc error."""
+    err = get_errno()
+    raise OSError(err, os.strerror(err), filepath)
+
+
+def set_xattr(filepath, name, value):
+    """Set the extended attribute name on the file to value."""
+    if _LIBC.setxattr(filepath, name, value, len(value), 0) < 0:
+        _raise_errno(filepath)
+
+
+def get_xattr(filepath, name):
+    """Get the extended attribute name of the file, None if it isn't set."""
+    while True:
+        size = _LIBC.getxattr(filepath, name, None, 0)
+        if size < 0:
+            if get_errno() == errno.ENODATA:
+                return None
+            _raise_errno(filepath)
+        buf = create_string_buffer(size)
+        rcode = _LIBC.getxattr(filepath, name, buf, size)
+        if rcode >= 0:
+            return buf.raw[:rcode]
+        # the attribute grew between the two calls, ask again
+        if get_errno() != errno.ERANGE:
+            _raise_errno(filepath)
+
+
+def write_digests(filepath, digests):
+    """Store the digests on the file.
+
+    Filesystems without extended attributes silently keep nothing.
+    """
+    try:
+        set_xattr(filepath, DIGESTS_XATTR, encode_digests(digests))
+    except OSError as ex:
+        if ex.errno not in NOT_SUPPORTED:
+            raise
+
+
+def read_digests(filepath):
+    """Return the digests stored on the file, empty if there are none."""
+    try:
+        return decode_digests(get_xattr(filepath, DIGESTS_XATTR))
+    except OSError as ex:
+        if ex.errno not in NOT_SUPPORTED:
+            raise
+    return {}
@@ -12,6 +12,25 @@ to import:
 """
 import os
 from archiveinterface.archivebackends.posix.posix_status import PosixStatus
+from archiveinterface.archivebackends.posix.extended_attributes import read_digests
+
+
+def path_status(filepath, stat_result=None):
+    """Return status of the file at filepath without opening it.
+
+    Pass the file's os.stat() result if it was already taken.
+    """
+    if stat_result is None:
+        stat_result = os.stat(filepath)
+    mtime = stat_result.st_mtime
+    ctime = stat_result.st_ctime
+    bytes_per_level = (long(stat_result.st_size),)
+    filesize = stat_result.st_size
+    status = PosixStatus(mtime, ctime, bytes_per_level, filesize)
+    status.set_filepath(filepath)
+    status.set_digests(read_digests(filepath))
+
+    return status
 
 
 class ExtendedFile(file):
@@ -25,14 +44,7 @@ class ExtendedFile(file):
 
     def status(self):
         """Return status of file. Since POSIX, will always return disk."""
-        mtime = os.path.getmtime(self._path)
-        ctime = os.path.getctime(self._path)
-        bytes_per_level = (long(os.path.getsize(self._path)),)
-        filesize = os.path.getsize(self._path)
-        status = PosixStatus(mtime, ctime, bytes_per_level, filesize)
-        status.set_filepath(self._path)
-
-        return status
+        return path_status(self._path)
 
     def stage(self):
         """Stage a file. Since POSIX, essentially a no op."""
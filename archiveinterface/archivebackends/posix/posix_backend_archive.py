@@ -7,12 +7,17 @@ backend.
 """
 
 import os
-from archiveinterface.archive_utils import un_abs_path, read_config_value
+import errno
+from archiveinterface.archive_utils import un_abs_path, read_config_bool, read_config_float
 from archiveinterface.id2filename import id2filename
 from archiveinterface.archive_interface_error import ArchiveInterfaceError
-from archiveinterface.archivebackends.posix.extendedfile import ExtendedFile
+from archiveinterface.archivebackends.posix.extendedfile import ExtendedFile, path_status
+from archiveinterface.archivebackends.posix.extended_attributes import write_digests
+from archiveinterface.archivebackends.posix.durable import (
+    GroupCommit, commit_file, temp_path, check_not_read_only)
 from archiveinterface.archivebackends.abstract.abstract_backend_archive \
     import AbstractBackendArchive
+from archiveinterface.archivebackends.directory_cache import DIRECTORY_CACHE, make_local_directory
 
 
 class PosixBackendArchive(AbstractBackendArchive):
@@ -28,41 +33,79 @@ class PosixBackendArchive(AbstractBackendArchive):
         self._prefix = prefix
         self._file = None
         self._filepath = None
+        self._temp_filepath = None
         self._id2filename = lambda x: x
-        if read_config_value('posix', 'use_id2filename') == 'true':
+        if read_config_bool('posix', 'use_id2filename'):
             self._id2filename = lambda x: id2filename(int(x))
+        self._durable = read_config_bool('posix', 'durable_writes', 'false')
+        self._commit = commit_file
+        if read_config_bool('posix', 'group_commit', 'false'):
+            window = read_config_float('posix', 'group_commit_window', 0)
+            use_syncfs = read_config_bool('posix', 'group_commit_syncfs', 'false')
+            self._commit = GroupCommit(window, use_syncfs).commit
+        self._init_handle_pool('posix')
 
     def open(self, filepath, mode):
-        """Open a posix file."""
-        # want to close any open files first
+        """Open a posix file and return a new handle for it."""
+        handle = self._new_handle()
         try:
-            self.close()
-        except ArchiveInterfaceError as ex:
-            err_str = "Can't close previous posix file before opening new "\
-                      'one with error: ' + str(ex)
-            raise ArchiveInterfaceError(err_str)
-        try:
-            fpath = un_abs_path(self._id2filename(filepath))
-            filename = os.path.join(self._prefix, fpath)
+            filename = self._archive_path(filepath)
             dirname = os.path.dirname(filename)
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname, 0755)
-            self._filepath = filename
-            self._file = ExtendedFile(self._filepath, mode)
-            return self
+            DIRECTORY_CACHE.makedirs(dirname, make_local_directory)
+            # pylint: disable=protected-access
+            handle._filepath = filename
+            try:
+                if self._durable and 'w' in mode:
+                    # written under a temporary name and renamed into place on close
+                    check_not_read_only(filename)
+                    handle._temp_filepath = temp_path(filename)
+                    handle._file = ExtendedFile(handle._temp_filepath, mode)
+                else:
+                    handle._file = ExtendedFile(filename, mode)
+            except EnvironmentError as ex:
+                if ex.errno == errno.ENOENT:
+                    # the directory may have been removed since it was made
+                    DIRECTORY_CACHE.invalidate(dirname)
+                raise
+            # pylint: enable=protected-access
+            return handle
         except Exception as ex:
+            # pylint: disable=protected-access
+            handle._release_handle()
+            # pylint: enable=protected-access
             err_str = "Can't open posix file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def _archive_path(self, filepath):
+        """Return the path on disk for the file."""
+        fpath = un_abs_path(self._id2filename(filepath))
+        return os.path.join(self._prefix, fpath)
+
     def close(self):
-        """Close a posix file."""
+        """Close a posix file, committing it first if written durably."""
         try:
             if self._file:
+                if self._temp_filepath:
+                    self._file.flush()
+                    self._commit(self._file, self._temp_filepath, self._filepath)
+                    self._temp_filepath = None
                 self._file.close()
                 self._file = None
         except Exception as ex:
+            self._remove_temp_file()
             err_str = "Can't close posix file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
+        finally:
+            self._release_handle()
+
+    def _remove_temp_file(self):
+        """Close and remove an uncommitted temporary file."""
+        if self._temp_filepath:
+            if self._file:
+                self._file.close()
+                self._file = None
+            os.unlink(self._temp_filepath)
+            self._temp_filepath = None
 
     def read(self, blocksize):
         """Read a posix file."""
@@ -73,6 +116,26 @@ class PosixBackendArchive(AbstractBackendArchive):
             err_str = "Can't read posix file with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def fileno(self):
+        """Return the file descriptor of the open posix file.
+
+        Lets the WSGI server send the file with sendfile(2).
+        """
+        try:
+            return self._file.fileno()
+        except Exception as ex:
+            err_str = "Can't get posix file descriptor with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    def seek(self, offset):
+        """Seek in a posix file."""
+        try:
+            if self._file:
+                return self._file.seek(offset)
+        except Exception as ex:
+            err_str = "Can't seek posix file with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
     def write(self, buf):
         """Write a posix file to the archive."""
         try:
@@ -93,6 +156,35 @@ class PosixBackendArchive(AbstractBackendArchive):
             err_str = "Can't set posix file mod time with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
 
+    def set_digests(self, digests):
+        """Store the digests of a posix file in an extended attribute."""
+        try:
+            if self._filepath:
+                write_digests(self._filepath, digests)
+        except Exception as ex:
+            err_str = "Can't set posix file digests with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    def discard(self):
+        """Close a posix file and remove it."""
+        if self._temp_filepath:
+            # nothing was committed, leave whatever is at the final path
+            try:
+                self._remove_temp_file()
+            except Exception as ex:
+                err_str = "Can't discard posix file with error: " + str(ex)
+                raise ArchiveInterfaceError(err_str)
+            finally:
+                self._release_handle()
+            return
+        self.close()
+        try:
+            if self._filepath:
+                os.unlink(self._filepath)
+        except Exception as ex:
+            err_str = "Can't discard posix file with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
     def set_file_permissions(self):
         """Set the file permissions for a posix file."""
         try:
@@ -119,3 +211,29 @@ class PosixBackendArchive(AbstractBackendArchive):
         except Exception as ex:
             err_str = "Can't get posix file status with error: " + str(ex)
             raise ArchiveInterfaceError(err_str)
+
+    def stat(self, filepath):
+        """Get the status of a posix file without opening it."""
+        try:
+            return path_status(self._archive_path(filepath))
+        except Exception as ex:
+            err_str = "Can't get posix file status with error: " + str(ex)
+            raise ArchiveInterfaceError(err_str)
+
+    def status_many(self, filepaths):
+        """Get the status of many posix files, one stat each."""
+        for filepath in filepaths:
+            try:
+                archive_path = self._archive_path(filepath)
+                try:
+                    stat_result = os.stat(archive_path)
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    yield filepath, None
+                    continue
+                status = path_status(archive_path, stat_result)
+            except Exception as ex:
+                err_str = "Can't get posix file status with error: " + str(ex)
+                status = ArchiveInterfaceError(err_str)
+            yield filepath, status
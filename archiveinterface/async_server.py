@@ -0,0 +1,454 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Event loop server for the archive interface.
+
+Serves the WSGI application from a single asyncore event loop that
+owns every client connection. Requests are handed to a bounded pool
+of worker threads, so only requests being worked on hold a thread and
+an idle or slow client costs just its connection.
+
+Request bodies and responses move between the loop and the workers
+through bounded per connection buffers. A worker writing a response
+waits while the client is slow to take it, and the loop stops reading
+a request body while the worker is slow to consume it, so memory per
+connection stays bounded either way.
+"""
+import os
+import sys
+import errno
+import fcntl
+import socket
+import asyncore
+import threading
+from Queue import Queue
+from collections import deque
+from urllib import unquote
+from email.utils import formatdate
+from archiveinterface.archive_server import DEFAULT_THREADS, set_request_threads
+
+# most bytes buffered per connection in each direction
+DEFAULT_BUFFER_SIZE = 4 << 20
+MAX_HEADER_SIZE = 65536
+RECV_SIZE = 65536
+SERVER_SOFTWARE = 'PacificaArchiveInterface/async'
+
+
+class _Trigger(asyncore.file_dispatcher):
+    """Pipe that wakes the event loop when worker threads have news."""
+
+    def __init__(self, channel_map):
+        """Create the pipe and watch its read end."""
+        read_fd, self._write_fd = os.pipe()
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, channel_map)
+        # file_dispatcher keeps a duplicate of the descriptor
+        os.close(read_fd)
+
+    def pull(self):
+        """Wake the loop up so it looks at its connections again."""
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError as ex:
+            # a full pipe already has the loop waking up
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def readable(self):
+        """Always watch for wake ups."""
+        return True
+
+    def writable(self):
+        """Never write to the pipe from the loop."""
+        return False
+
+    def handle_read(self):
+        """Drain the wake ups."""
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+
+    def close(self):
+        """Close both ends of the pipe."""
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class _Buffer(object):
+    """Bounded buffer of bytes passed between a worker and the loop."""
+
+    def __init__(self, limit, trigger):
+        """Create an empty buffer holding up to about limit bytes."""
+        self._limit = limit
+        self._trigger = trigger
+        self._cond = threading.Condition()
+        self._chunks = deque()
+        self.size = 0
+        self.finished = False
+        self.closed = False
+
+    def full(self):
+        """Return True if the buffer is holding its limit."""
+        with self._cond:
+            return self.size >= self._limit
+
+    def pending(self):
+        """Return True if there are bytes waiting to be taken."""
+        with self._cond:
+            return self.size > 0
+
+    def put(self, data):
+        """Add data, waiting while the buffer is full.
+
+        Raises IOError if the other side went away.
+        """
+        with self._cond:
+            while self.size >= self._limit and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                raise IOError('Client connection closed')
+            self._chunks.append(data)
+            self.size += len(data)
+        self._trigger.pull()
+
+    def fill(self, data):
+        """Add data without waiting, for the loop which checks full() first."""
+        with self._cond:
+            self._chunks.append(data)
+            self.size += len(data)
+            self._cond.notify_all()
+
+    def finish(self):
+        """Mark that no more data will be put."""
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+        self._trigger.pull()
+
+    def close(self):
+        """Give up on the buffer, waking anyone waiting on it."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self._trigger.pull()
+
+    def take(self, size, wait=False):
+        """Remove and return up to size bytes.
+
+        Returns '' once the buffer is finished and empty. With wait
+        the call blocks until there is data.
+        """
+        with self._cond:
+            while wait and not self._chunks and not self.finished and not self.closed:
+                self._cond.wait()
+            data = []
+            taken = 0
+            while self._chunks and taken < size:
+                chunk = self._chunks.popleft()
+                if taken + len(chunk) > size:
+                    self._chunks.appendleft(chunk[size - taken:])
+                    chunk = chunk[:size - taken]
+                data.append(chunk)
+                taken += len(chunk)
+            self.size -= taken
+            self._cond.notify_all()
+        if taken and wait:
+            # the loop may be waiting for room to read more
+            self._trigger.pull()
+        return ''.join(data)
+
+    def done(self):
+        """Return True once the buffer is finished and empty."""
+        with self._cond:
+            return self.finished and not self._chunks
+
+
+class _Input(object):
+    """The wsgi.input of a request, reading the body from the loop."""
+
+    def __init__(self, body, length):
+        """Read length bytes from the body buffer."""
+        self._body = body
+        self._remaining = length
+
+    def read(self, size=-1):
+        """Read up to size bytes, everything left if size is negative."""
+        if size < 0:
+            data = []
+            chunk = self.read(self._remaining)
+            while chunk:
+                data.append(chunk)
+                chunk = self.read(self._remaining)
+            return ''.join(data)
+        if not size or not self._remaining:
+            return ''
+        chunk = self._body.take(min(size, self._remaining), wait=True)
+        self._remaining -= len(chunk)
+        return chunk
+
+    def readline(self, size=-1):
+        """Read a line of the body."""
+        line = []
+        while size < 0 or len(line) < size:
+            char = self.read(1)
+            if not char:
+                break
+            line.append(char)
+            if char == '\n':
+                break
+        return ''.join(line)
+
+    # pylint: disable=unused-argument
+    def readlines(self, hint=-1):
+        """Read the rest of the body as lines."""
+        return list(iter(self.readline, ''))
+    # pylint: enable=unused-argument
+
+    def __iter__(self):
+        """Iterate over the lines of the body."""
+        return iter(self.readline, '')
+
+
+class _Channel(asyncore.dispatcher):
+    """One client connection owned by the event loop."""
+
+    def __init__(self, sock, addr, server):
+        """Start reading the request from the connection."""
+        asyncore.dispatcher.__init__(self, sock, server.channel_map)
+        self._server = server
+        self._addr = addr
+        self._header = ''
+        self._body = None
+        self._body_remaining = 0
+        self._output = _Buffer(server.buffer_size, server.trigger)
+        self._sending = ''
+
+    def readable(self):
+        """Read headers, then the body while the worker keeps up."""
+        if self._body is None:
+            return True
+        return self._body_remaining > 0 and not self._body.full()
+
+    def writable(self):
+        """Write while there is response data to send."""
+        return bool(self._sending) or self._output.pending() or self._output.done()
+
+    def handle_read(self):
+        """Read the request headers or the next piece of the body."""
+        data = self.recv(RECV_SIZE)
+        if not data:
+            return
+        if self._body is not None:
+            self._feed_body(data)
+            return
+        self._header += data
+        end = self._header.find('\r\n\r\n')
+        if end < 0:
+            if len(self._header) > MAX_HEADER_SIZE:
+                self._simple_response('431 Request Header Fields Too Large')
+            return
+        header, rest = self._header[:end], self._header[end + 4:]
+        self._header = ''
+        environ = self._server.make_environ(header, self._addr)
+        if environ is None:
+            self._simple_response('400 Bad Request')
+            return
+        try:
+            self._body_remaining = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self._simple_response('400 Bad Request')
+            return
+        self._body = _Buffer(self._server.buffer_size, self._server.trigger)
+        environ['wsgi.input'] = _Input(self._body, self._body_remaining)
+        self._feed_body(rest)
+        self._server.submit(self, environ)
+
+    def _feed_body(self, data):
+        """Pass received body data on to the worker."""
+        data = data[:self._body_remaining]
+        if data:
+            self._body_remaining -= len(data)
+            self._body.fill(data)
+        if self._body_remaining <= 0:
+            self._body.finish()
+
+    def handle_write(self):
+        """Send as much of the response as the client will take."""
+        if not self._sending:
+            self._sending = self._output.take(RECV_SIZE)
+        if self._sending:
+            sent = self.send(self._sending)
+            self._sending = self._sending[sent:]
+        elif self._output.done():
+            self.handle_close()
+
+    def handle_close(self):
+        """Close the connection and release the worker if it is waiting."""
+        self._output.close()
+        if self._body is not None:
+            self._body.close()
+        self.close()
+
+    def handle_error(self):
+        """Drop the connection on unexpected errors."""
+        self.handle_close()
+
+    def _simple_response(self, status):
+        """Answer the request from the loop without running the app."""
+        self._body = _Buffer(0, self._server.trigger)
+        self._output.put('HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(status))
+        self._output.finish()
+
+    def output(self):
+        """Return the buffer the response is written to."""
+        return self._output
+
+
+def _run_app(app, channel, environ):
+    """Run the WSGI app for a request in a worker thread."""
+    output = channel.output()
+    head_only = environ['REQUEST_METHOD'] == 'HEAD'
+    state = {'status': None, 'headers': None, 'sent': False}
+
+    def send_headers():
+        """Send the status line and headers."""
+        names = set(name.lower() for name, _ in state['headers'])
+        lines = ['HTTP/1.1 ' + state['status']]
+        lines.extend('{}: {}'.format(name, value) for name, value in state['headers'])
+        if 'date' not in names:
+            lines.append('Date: ' + formatdate(usegmt=True))
+        if 'server' not in names:
+            lines.append('Server: ' + SERVER_SOFTWARE)
+        lines.append('Connection: close')
+        output.put('\r\n'.join(lines) + '\r\n\r\n')
+        state['sent'] = True
+
+    def write(data):
+        """Write part of the response body."""
+        if not state['sent']:
+            send_headers()
+        if data and not head_only:
+            output.put(data)
+
+    def start_response(status, headers, exc_info=None):
+        """Start the response."""
+        if exc_info and state['sent']:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        state['status'] = status
+        state['headers'] = headers
+        return write
+
+    # pylint: disable=broad-except
+    try:
+        result = app(environ, start_response)
+        try:
+            for data in result:
+                write(data)
+            write('')
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    except IOError:
+        pass
+    except Exception:
+        environ['wsgi.errors'].write('Error serving {}\n'.format(environ.get('PATH_INFO')))
+        if not state['sent']:
+            state['status'] = '500 Internal Server Error'
+            state['headers'] = [('Content-Length', '0')]
+            try:
+                write('')
+            except IOError:
+                pass
+    # pylint: enable=broad-except
+    output.finish()
+
+
+class AsyncArchiveServer(asyncore.dispatcher):
+    """Event loop server handing requests to a bounded thread pool."""
+
+    def __init__(self, address, port, app, threads=DEFAULT_THREADS, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Listen on the address and port for the WSGI app."""
+        self.channel_map = {}
+        asyncore.dispatcher.__init__(self, map=self.channel_map)
+        self.trigger = _Trigger(self.channel_map)
+        self.buffer_size = buffer_size
+        self._app = app
+        self._requests = Queue()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((address, port))
+        self.listen(1024)
+        self.server_name = socket.getfqdn(address)
+        self.server_port = self.socket.getsockname()[1]
+        set_request_threads(threads)
+        for _ in range(threads):
+            worker = threading.Thread(target=self._work, name='archive-worker')
+            worker.daemon = True
+            worker.start()
+
+    def handle_accept(self):
+        """Start a channel for a new connection."""
+        pair = self.accept()
+        if pair is not None:
+            _Channel(pair[0], pair[1], self)
+
+    def submit(self, channel, environ):
+        """Queue a parsed request for the worker threads."""
+        self._requests.put((channel, environ))
+
+    def _work(self):
+        """Run queued requests forever."""
+        while True:
+            channel, environ = self._requests.get()
+            _run_app(self._app, channel, environ)
+
+    def make_environ(self, header, addr):
+        """Return the WSGI environ for the request header, None if it is bad."""
+        lines = header.split('\r\n')
+        try:
+            method, target, protocol = lines[0].split()
+        except ValueError:
+            return None
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': str(self.server_port),
+            'SERVER_PROTOCOL': protocol,
+            'SERVER_SOFTWARE': SERVER_SOFTWARE,
+            'REMOTE_ADDR': addr[0] if addr else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    def serve_forever(self):
+        """Run the event loop."""
+        asyncore.loop(timeout=30, use_poll=True, map=self.channel_map)
+
+    def server_close(self):
+        """Stop listening and close every connection."""
+        asyncore.close_all(self.channel_map)
+
+
+def make_async_server(address, port, app, threads=DEFAULT_THREADS):
+    """Create the event loop server for the app."""
+    return AsyncArchiveServer(address, port, app, threads)
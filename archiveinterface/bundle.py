@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Bundle Module.
+
+Module that streams many archive files to the client as a single tar
+or zip file. The bundle is generated on the fly while each file is
+read through the backend a block at a time, nothing is staged in
+temporary files. The size of every member is known from its status
+so the length of the whole bundle is known before it is sent.
+
+Uploaded tar bundles are read as a stream too, see BoundedReader.
+"""
+import time
+import zlib
+import struct
+import tarfile
+import posixpath
+from archiveinterface.archive_interface_error import ArchiveInterfaceError
+from archiveinterface.archive_utils import ROUTE_PREFIX
+
+TAR_BLOCK = tarfile.BLOCKSIZE
+TAR_RECORD = tarfile.RECORDSIZE
+# zip without zip64 extensions can't address past 4 GiB
+ZIP_MAX_SIZE = 0xFFFFFFFF
+ZIP_MAX_MEMBERS = 0xFFFF
+# data descriptor follows the member data, names are utf-8
+ZIP_FLAGS = 0x08 | 0x800
+ZIP_VERSION = 20
+BUNDLE_FORMATS = {
+    'tar': 'application/x-tar',
+    'zip': 'application/zip'
+}
+
+
+# pylint: disable=too-few-public-methods
+class BundleMember(object):
+    """A file to put in a bundle."""
+
+    def __init__(self, filepath, status):
+        """Create a member for the file with its status."""
+        self.filepath = filepath
+        self.name = filepath.lstrip('/')
+        self.size = long(status.filesize)
+        self.mtime = int(float(status.mtime))
+# pylint: enable=too-few-public-methods
+
+
+class BoundedReader(object):
+    """File like reader of a request body that stops at its length.
+
+    Lets tarfile read an upload as a stream without reading past the
+    end of the request.
+    """
+
+    def __init__(self, fileobj, length):
+        """Read at most length bytes from fileobj."""
+        self._fileobj = fileobj
+        self._remaining = length
+
+    def read(self, size=-1):
+        """Read up to size bytes, all that remain if size is negative."""
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        if size == 0:
+            return ''
+        buf = self._fileobj.read(size)
+        self._remaining -= len(buf)
+        return buf
+
+
+def member_filepath(name):
+    """Return the archive path for the name of an uploaded tar member.
+
+    Names with .. components are refused rather than resolved, they
+    would otherwise name files outside the ones the bundle is for, as
+    are names under the paths reserved for the other endpoints.
+    """
+    if '..' in name.split('/'):
+        raise ArchiveInterfaceError('Bundle member name {} has a .. component'.format(name))
+    filepath = posixpath.normpath('/' + name.lstrip('/'))
+    if filepath == '/':
+        raise ArchiveInterfaceError('Bundle member name {} names no file'.format(name))
+    if filepath.startswith(ROUTE_PREFIX):
+        raise ArchiveInterfaceError('Bundle member name {} is under the reserved {}'.format(name, ROUTE_PREFIX))
+    return filepath
+
+
+def _read_member(archive, member, block_size):
+    """Yield the contents of the member read through the backend."""
+    archivefile = archive.open(member.filepath, 'r')
+    try:
+        remaining = member.size
+        while remaining > 0:
+            buf = archivefile.read(min(block_size, remaining))
+            if not buf:
+                raise ArchiveInterfaceError(
+                    'File {} ended {} bytes short of its size'.format(member.filepath, remaining))
+            remaining -= len(buf)
+            yield buf
+    finally:
+        archivefile.close()
+
+
+def _tar_header(member):
+    """Return the tar header blocks for the member."""
+    tarinfo = tarfile.TarInfo(member.name)
+    tarinfo.size = member.size
+    tarinfo.mtime = member.mtime
+    tarinfo.mode = 0444
+    return tarinfo.tobuf(tarfile.GNU_FORMAT)
+
+
+def _tar_padding(size, block):
+    """Return the number of bytes that pad size up to a whole block."""
+    return -size % block
+
+
+def tar_bundle(archive, members, block_size):
+    """Return the length and content generator of a tar of the members."""
+    headers = [_tar_header(member) for member in members]
+    length = sum(
+        len(header) + member.size + _tar_padding(member.size, TAR_BLOCK)
+        for header, member in zip(headers, members)
+    ) + 2 * TAR_BLOCK
+    tail = '\0' * (2 * TAR_BLOCK + _tar_padding(length, TAR_RECORD))
+    length += _tar_padding(length, TAR_RECORD)
+
+    def generate():
+        """Yield the tar a piece at a time."""
+        for header, member in zip(headers, members):
+            yield header
+            for buf in _read_member(archive, member, block_size):
+                yield buf
+            yield '\0' * _tar_padding(member.size, TAR_BLOCK)
+        yield tail
+    return length, generate()
+
+
+def _dos_time(mtime):
+    """Return the zip (time, date) of the mtime."""
+    local = time.localtime(max(mtime, 315532800))
+    return (
+        local.tm_hour << 11 | local.tm_min << 5 | local.tm_sec // 2,
+        (local.tm_year - 1980) << 9 | local.tm_mon << 5 | local.tm_mday
+    )
+
+
+def _zip_local_header(member):
+    """Return the zip local file header for the member."""
+    dos_time, dos_date = _dos_time(member.mtime)
+    return struct.pack(
+        '<IHHHHHIIIHH', 0x04034b50, ZIP_VERSION, ZIP_FLAGS, 0,
+        dos_time, dos_date, 0, 0, 0, len(member.name), 0
+    ) + member.name
+
+
+def _zip_central_header(member, crc, offset):
+    """Return the zip central directory entry for the member."""
+    dos_time, dos_date = _dos_time(member.mtime)
+    return struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS, 0,
+        dos_time, dos_date, crc, member.size, member.size, len(member.name),
+        0, 0, 0, 0, 0100444 << 16, offset
+    ) + member.name
+
+
+def zip_bundle(archive, members, block_size):
+    """Return the length and content generator of a zip of the members.
+
+    The members are stored without compression so the length is known
+    up front.
+    """
+    local_sizes = [30 + len(member.name) + member.size + 16 for member in members]
+    central_size = sum(46 + len(member.name) for member in members)
+    length = sum(local_sizes) + central_size + 22
+    if length > ZIP_MAX_SIZE or len(members) > ZIP_MAX_MEMBERS:
+        raise ArchiveInterfaceError('Bundle is too large for zip, use tar instead')
+
+    def generate():
+        """Yield the zip a piece at a time."""
+        central = []
+        offset = 0
+        for member, local_size in zip(members, local_sizes):
+            yield _zip_local_header(member)
+            crc = 0
+            for buf in _read_member(archive, member, block_size):
+                crc = zlib.crc32(buf, crc)
+                yield buf
+            crc &= 0xFFFFFFFF
+            yield struct.pack('<IIII', 0x08074b50, crc, member.size, member.size)
+            central.append(_zip_central_header(member, crc, offset))
+            offset += local_size
+        for entry in central:
+            yield entry
+        yield struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, len(members), len(members),
+            central_size, offset, 0
+        )
+    return length, generate()
+
+
+def make_bundle(archive, members, bundle_format, block_size):
+    """Return the length and content generator of the bundle."""
+    if bundle_format == 'zip':
+        return zip_bundle(archive, members, block_size)
+    return tar_bundle(archive, members, block_size)
@@ -0,0 +1,606 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Metrics Module.
+
+Module that keeps the Prometheus metrics of the archive interface.
+Each process adds to its own memory mapped file in a directory shared
+by every worker of the server, so the totals reported by any worker
+cover them all. Recording a value is a few dictionary lookups and a
+write to memory, cheap enough to time every block copied. The counters
+and histograms of a process that has exited are added to one file of
+every exited process and its own file is removed, so the directory
+doesn't grow as workers are replaced.
+"""
+import os
+import mmap
+import json
+import time
+import fcntl
+import struct
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+
+REQUEST_SECONDS = 'archivei_http_request_duration_seconds'
+REQUESTS_IN_FLIGHT = 'archivei_http_requests_in_flight'
+BYTES_READ = 'archivei_bytes_read_total'
+BYTES_WRITTEN = 'archivei_bytes_written_total'
+BACKEND_SECONDS = 'archivei_backend_operation_duration_seconds'
+HPSS_PING_SECONDS = 'archivei_hpss_ping_core_latency_seconds'
+HMS_QUERY_SECONDS = 'archivei_hms_query_duration_seconds'
+
+METRIC_TYPES = {
+    REQUEST_SECONDS: ('histogram', 'Time to serve a request by method and status code.'),
+    REQUESTS_IN_FLIGHT: ('gauge', 'Requests being served.'),
+    BYTES_READ: ('counter', 'Bytes of file data read from the archive.'),
+    BYTES_WRITTEN: ('counter', 'Bytes of file data written to the archive.'),
+    BACKEND_SECONDS: ('histogram', 'Time spent in backend operations by operation.'),
+    HPSS_PING_SECONDS: ('histogram', 'Latency of the HPSS core server reported by ping_core.'),
+    HMS_QUERY_SECONDS: ('histogram', 'Time spent querying the HMS sideband database.')
+}
+# handle methods timed besides read and write
+TIMED_OPERATIONS = frozenset((
+    'close', 'seek', 'stage', 'status', 'set_mod_time', 'set_digests', 'set_file_permissions', 'discard'
+))
+# bytes read at a time when a backend file handle is iterated over
+FILE_BLOCK_SIZE = 1 << 20
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# the file starts with the bytes used, then entries of the key's length,
+# the key padded to 8 bytes and the value as a double
+HEADER = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+INITIAL_FILE_SIZE = 1 << 16
+FILE_PREFIX = 'metrics_'
+FILE_SUFFIX = '.db'
+# values of the processes that have exited
+EXITED_FILE = 'exited.db'
+# locked while the files of exited processes are merged
+LOCK_FILE = 'metrics.lock'
+
+
+def _entry(key):
+    """Return the bytes of a new entry for the key."""
+    encoded = key.encode('utf-8')
+    padding = -(KEY_LENGTH.size + len(encoded)) % 8
+    return KEY_LENGTH.pack(len(encoded)) + encoded + ' ' * padding + VALUE.pack(0.0)
+
+
+def _read_entries(data, used):
+    """Yield (key, value, offset of value) for the entries in data."""
+    pos = HEADER.size
+    while pos < used:
+        length = KEY_LENGTH.unpack_from(data, pos)[0]
+        pos += KEY_LENGTH.size
+        key = data[pos:pos + length].decode('utf-8')
+        pos += length + (-(KEY_LENGTH.size + length) % 8)
+        yield key, VALUE.unpack_from(data, pos)[0], pos
+        pos += VALUE.size
+
+
+def read_values(filename):
+    """Return the (key, value) pairs stored in the values file."""
+    with open(filename, 'rb') as values_file:
+        data = values_file.read()
+    if len(data) < HEADER.size:
+        return []
+    used = min(HEADER.unpack_from(data, 0)[0], len(data))
+    return [(key, value) for key, value, _ in _read_entries(data, used)]
+
+
+class MmapValues(object):
+    """Float values by key in a memory mapped file written by one process.
+
+    Entries are only ever appended and the bytes used are updated after
+    an entry is written, so other processes can read the file at any
+    time.
+    """
+
+    def __init__(self, filename):
+        """Open the values file, creating it if needed."""
+        self._file = open(filename, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER.size:
+            size = INITIAL_FILE_SIZE
+            self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._used = HEADER.unpack_from(self._mmap, 0)[0]
+        if not self._used:
+            self._used = HEADER.size
+            HEADER.pack_into(self._mmap, 0, self._used)
+        self._positions = dict((key, pos) for key, _, pos in _read_entries(self._mmap, self._used))
+
+    def _position(self, key):
+        """Return the offset of the key's value, adding the key if needed."""
+        pos = self._positions.get(key)
+        if pos is None:
+            entry = _entry(key)
+            if self._used + len(entry) > len(self._mmap):
+                size = max(len(self._mmap) * 2, self._used + len(entry))
+                self._mmap.close()
+                self._file.truncate(size)
+                self._mmap = mmap.mmap(self._file.fileno(), size)
+            self._mmap[self._used:self._used + len(entry)] = entry
+            pos = self._used + len(entry) - VALUE.size
+            self._used += len(entry)
+            HEADER.pack_into(self._mmap, 0, self._used)
+            self._positions[key] = pos
+        return pos
+
+    def add(self, key, amount):
+        """Add amount to the key's value."""
+        pos = self._position(key)
+        VALUE.pack_into(self._mmap, pos, VALUE.unpack_from(self._mmap, pos)[0] + amount)
+
+    def set(self, key, value):
+        """Set the key's value."""
+        VALUE.pack_into(self._mmap, self._position(key), value)
+
+    def items(self):
+        """Return the (key, value) pairs of the file."""
+        return [(key, value) for key, value, _ in _read_entries(self._mmap, self._used)]
+
+    def close(self):
+        """Unmap and close the file."""
+        self._mmap.close()
+        self._file.close()
+
+
+def _pid_alive(pid):
+    """Return True if a process with the pid is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _format_labels(labels):
+    """Format label pairs for the exposition format."""
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    ) + '}'
+
+
+def _format_value(value):
+    """Format a value for the exposition format."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metrics(object):
+    """Counters, gauges and histograms shared by the server's processes."""
+
+    def __init__(self, directory=None):
+        """Keep values in the directory, a temporary one if it is None."""
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._values = None
+        self._keys = {}
+
+    def set_directory(self, directory=None):
+        """Keep values in the directory.
+
+        Without a directory a temporary one is made, unless one was
+        already, so call this before the server forks its workers.
+        """
+        with self._lock:
+            if directory is None:
+                directory = self._directory or tempfile.mkdtemp(prefix='archivei-metrics-')
+            if directory != self._directory:
+                if self._values is not None and self._pid == os.getpid():
+                    self._values.close()
+                self._directory = directory
+                self._pid = None
+
+    def _local_values(self):
+        """Return this process's values, opening its file after a fork."""
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix='archivei-metrics-')
+            self._values = MmapValues(self._pid_filename(pid))
+            # a process that had this pid before is gone, so are its requests
+            for key, _ in self._values.items():
+                if METRIC_TYPES.get(json.loads(key)[0], ('',))[0] == 'gauge':
+                    self._values.set(key, 0.0)
+            self._pid = pid
+        return self._values
+
+    def _locked(self, operation):
+        """Return the lock file of the directory, locked with the flock operation."""
+        lock_file = open(os.path.join(self._directory, LOCK_FILE), 'a')
+        fcntl.flock(lock_file.fileno(), operation)
+        return lock_file
+
+    def _pid_filename(self, pid):
+        """Return the path of the values file of the process with the pid."""
+        return os.path.join(self._directory, '{}{}{}'.format(FILE_PREFIX, pid, FILE_SUFFIX))
+
+    def _process_pids(self):
+        """Return the pids of the processes with a values file."""
+        pids = []
+        for filename in os.listdir(self._directory):
+            if filename.startswith(FILE_PREFIX) and filename.endswith(FILE_SUFFIX):
+                pids.append(int(filename[len(FILE_PREFIX):-len(FILE_SUFFIX)]))
+        return pids
+
+    def mark_process_dead(self, pid):
+        """Add the counters and histograms of an exited process to those of every exited process.
+
+        Its gauges are dropped with the rest of its file.
+        """
+        if self._directory is None or not os.path.isdir(self._directory):
+            return
+        filename = self._pid_filename(pid)
+        with self._locked(fcntl.LOCK_EX):
+            if not os.path.exists(filename):
+                return
+            exited = MmapValues(os.path.join(self._directory, EXITED_FILE))
+            try:
+                for key, value in read_values(filename):
+                    if METRIC_TYPES.get(json.loads(key)[0], ('',))[0] != 'gauge':
+                        exited.add(key, value)
+            finally:
+                exited.close()
+            os.unlink(filename)
+
+    def clear(self):
+        """Remove the values of every process not running, as when the server starts."""
+        if self._directory is None or not os.path.isdir(self._directory):
+            return
+        with self._locked(fcntl.LOCK_EX):
+            for pid in self._process_pids():
+                if pid != os.getpid() and not _pid_alive(pid):
+                    os.unlink(self._pid_filename(pid))
+            if os.path.exists(os.path.join(self._directory, EXITED_FILE)):
+                os.unlink(os.path.join(self._directory, EXITED_FILE))
+
+    def _key(self, name, labels):
+        """Return the key of the metric with the labels."""
+        key = self._keys.get((name, labels))
+        if key is None:
+            key = json.dumps([name, labels])
+            self._keys[(name, labels)] = key
+        return key
+
+    def inc(self, name, amount=1, labels=()):
+        """Add amount to a counter or gauge."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._local_values().add(key, amount)
+
+    def observe(self, name, value, labels=()):
+        """Record a value in a histogram."""
+        bucket = self._key(name + '_bucket', labels + (('le', bisect_left(BUCKETS, value)),))
+        total = self._key(name + '_sum', labels)
+        count = self._key(name + '_count', labels)
+        with self._lock:
+            values = self._local_values()
+            values.add(bucket, 1)
+            values.add(total, value)
+            values.add(count, 1)
+
+    def timer(self, name, labels=()):
+        """Return a context manager recording its time in a histogram."""
+        return _Timer(self, name, labels)
+
+    def collect(self):
+        """Return the values summed over every process by (name, labels).
+
+        The files of processes found to have exited are merged first,
+        their gauges aren't included.
+        """
+        totals = defaultdict(float)
+        if self._directory is None or not os.path.isdir(self._directory):
+            return totals
+        for pid in self._process_pids():
+            if pid != os.getpid() and not _pid_alive(pid):
+                self.mark_process_dead(pid)
+        with self._locked(fcntl.LOCK_SH):
+            filenames = [self._pid_filename(pid) for pid in self._process_pids()]
+            if os.path.exists(os.path.join(self._directory, EXITED_FILE)):
+                filenames.append(os.path.join(self._directory, EXITED_FILE))
+            for filename in filenames:
+                for key, value in read_values(filename):
+                    name, labels = json.loads(key)
+                    totals[(name, tuple(tuple(label) for label in labels))] += value
+        return totals
+
+    def exposition(self):
+        """Return the metrics in the Prometheus text format."""
+        totals = self.collect()
+        lines = []
+        for name in sorted(METRIC_TYPES):
+            metric_type, description = METRIC_TYPES[name]
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            if metric_type == 'histogram':
+                lines.extend(self._histogram_lines(name, totals))
+                continue
+            for (key_name, labels), value in sorted(totals.items()):
+                if key_name == name:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram_lines(name, totals):
+        """Return the exposition lines of a histogram."""
+        buckets = defaultdict(lambda: [0.0] * (len(BUCKETS) + 1))
+        for (key_name, labels), value in totals.items():
+            if key_name == name + '_bucket':
+                buckets[labels[:-1]][labels[-1][1]] += value
+        lines = []
+        for labels in sorted(buckets):
+            cumulative = 0.0
+            for bound, count in zip(BUCKETS + (float('inf'),), buckets[labels]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels + (('le', _format_value(bound)),)), _format_value(cumulative)))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), _format_value(totals[(name + '_sum', labels)])))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(labels), _format_value(totals[(name + '_count', labels)])))
+        return lines
+
+
+# pylint: disable=too-few-public-methods
+class _Timer(object):
+    """Context manager recording the time spent in it.
+
+    The time goes in the metrics histogram with the name and labels,
+    if metrics are given, and in the phase of the request, if a
+    request is given.
+    """
+
+    def __init__(self, metrics, name, labels, request=None, phase=None):
+        """Record in the histogram and the request's phase."""
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._request = request
+        self._phase = phase
+        self._start = None
+
+    def __enter__(self):
+        """Start timing."""
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Record the time since entering."""
+        elapsed = time.time() - self._start
+        if self._metrics is not None:
+            self._metrics.observe(self._name, elapsed, self._labels)
+        if self._request is not None:
+            self._request.add_phase(self._phase, elapsed)
+# pylint: enable=too-few-public-methods
+
+
+# the metrics of this process, shared by everything that records them
+METRICS = Metrics()
+
+
+class RequestMetrics(object):
+    """Record the time, phases and outcome of one request.
+
+    The time spent in each phase of the request so far is sent in the
+    Server-Timing header and all of them in the access log entry once
+    the response has been sent.
+    """
+
+    def __init__(self, env, start_response, access_log=None):
+        """Start timing a request calling start_response."""
+        self._env = env
+        self._method = env['REQUEST_METHOD']
+        self._start_response = start_response
+        self._access_log = access_log
+        self._start = time.time()
+        self._finished = False
+        self._length = None
+        self._file_result = None
+        self.phases = OrderedDict()
+        self.code = '500'
+        METRICS.inc(REQUESTS_IN_FLIGHT)
+
+    def add_phase(self, phase, seconds):
+        """Add seconds to the time spent in the phase."""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def phase(self, phase):
+        """Return a context manager adding its time to the phase."""
+        return _Timer(None, None, None, self, phase)
+
+    def server_timing(self):
+        """Return the Server-Timing header value of the phases so far."""
+        timings = ['{};dur={:.3f}'.format(phase, seconds * 1000) for phase, seconds in self.phases.items()]
+        timings.append('total;dur={:.3f}'.format((time.time() - self._start) * 1000))
+        return ', '.join(timings)
+
+    def start_response(self, status, headers, exc_info=None):
+        """Note the status code and start the response with its timing."""
+        self.code = status[:3]
+        for name, value in headers:
+            # error responses to HEAD send 'Error' as the length
+            if name.lower() == 'content-length' and value.isdigit():
+                self._length = int(value)
+        headers = list(headers) + [('Server-Timing', self.server_timing())]
+        if exc_info:
+            return self._start_response(status, headers, exc_info)
+        return self._start_response(status, headers)
+
+    def finish(self):
+        """Record the request once it has been sent."""
+        if self._finished:
+            return
+        self._finished = True
+        duration = time.time() - self._start
+        METRICS.inc(REQUESTS_IN_FLIGHT, -1)
+        METRICS.observe(REQUEST_SECONDS, duration, (('method', self._method), ('code', self.code)))
+        if self._access_log is not None:
+            self._access_log.log({
+                'time': self._start,
+                'remote_addr': self._env.get('REMOTE_ADDR'),
+                'method': self._method,
+                'path': self._env.get('PATH_INFO'),
+                'query': self._env.get('QUERY_STRING') or None,
+                'status': int(self.code),
+                'bytes': self._length,
+                'duration_ms': round(duration * 1000, 3),
+                'phases_ms': OrderedDict(
+                    (phase, round(seconds * 1000, 3)) for phase, seconds in self.phases.items())
+            })
+
+    def file_response(self, result):
+        """Return a wsgi.file_wrapper result, calling finish once it is closed.
+
+        The result is handed to the server as it is, the server may send
+        the file from its descriptor when it recognizes its own wrapper.
+        """
+        try:
+            result.close = self._closer(getattr(result, 'close', None))
+        except (AttributeError, TypeError):
+            self.finish()
+        self._file_result = result
+        return result
+
+    def wrap(self, result):
+        """Return the app's result, calling finish once it is sent."""
+        if isinstance(result, str):
+            self.finish()
+            return result
+        if result is self._file_result:
+            return result
+        return _FinishingIterable(result, self)
+
+    def _closer(self, close):
+        """Return a close that calls close and then finish."""
+        def close_and_finish():
+            """Close the result and record the request."""
+            try:
+                if close:
+                    close()
+            finally:
+                self.finish()
+        return close_and_finish
+
+
+class _FinishingIterable(object):
+    """Iterable over an app's result recording the request when done."""
+
+    def __init__(self, result, request):
+        """Iterate over result for the request."""
+        self._result = result
+        self._request = request
+
+    def __iter__(self):
+        """Yield the result, recording the request at its end."""
+        for data in self._result:
+            yield data
+        self._request.finish()
+
+    def close(self):
+        """Close the result and record the request."""
+        try:
+            if hasattr(self._result, 'close'):
+                self._result.close()
+        finally:
+            self._request.finish()
+
+
+def _operation_timer(operation, request):
+    """Return a timer of the backend operation for the request."""
+    return _Timer(METRICS, BACKEND_SECONDS, (('operation', operation),), request, operation)
+
+
+class InstrumentedFile(object):
+    """Backend file handle that times the backend's operations.
+
+    The times are also added to the phases of the request if given.
+    Iterating over it reads the file a block at a time and fileno is
+    passed through when the handle has one, so it can be returned by a
+    wsgi.file_wrapper that gives back the file itself.
+    """
+
+    def __init__(self, handle, request=None):
+        """Time the operations of the handle."""
+        self._handle = handle
+        self._request = request
+
+    def read(self, blocksize):
+        """Read from the file, counting the bytes."""
+        with _operation_timer('read', self._request):
+            buf = self._handle.read(blocksize)
+        if buf:
+            METRICS.inc(BYTES_READ, len(buf))
+        return buf
+
+    def __iter__(self):
+        """Return the file, iterating over its blocks."""
+        return self
+
+    def next(self):
+        """Return the next block of the file."""
+        buf = self.read(FILE_BLOCK_SIZE)
+        if not buf:
+            raise StopIteration
+        return buf
+
+    def write(self, buf):
+        """Write to the file, counting the bytes."""
+        with _operation_timer('write', self._request):
+            self._handle.write(buf)
+        METRICS.inc(BYTES_WRITTEN, len(buf))
+
+    def __getattr__(self, name):
+        """Time the other operations, passing anything else through."""
+        attr = getattr(self._handle, name)
+        if name not in TIMED_OPERATIONS:
+            return attr
+
+        def timed(*args):
+            """Call the operation, recording how long it took."""
+            with _operation_timer(name, self._request):
+                return attr(*args)
+        return timed
+
+
+class InstrumentedArchive(object):
+    """Backend archive whose handles time the backend's operations."""
+
+    def __init__(self, archive):
+        """Time the operations of the archive."""
+        self._archive = archive
+
+    def open(self, filepath, mode, request=None):
+        """Open a timed handle for the file, for the request if given."""
+        with _operation_timer('open', request):
+            return InstrumentedFile(self._archive.open(filepath, mode), request)
+
+    def stat(self, filepath):
+        """Return the status of the file, timing it."""
+        with _operation_timer('status', None):
+            return self._archive.stat(filepath)
+
+    def status_many(self, filepaths):
+        """Yield the statuses of the files, timing the wait for each."""
+        statuses = iter(self._archive.status_many(filepaths))
+        while True:
+            start = time.time()
+            try:
+                item = next(statuses)
+            except StopIteration:
+                return
+            METRICS.observe(BACKEND_SECONDS, time.time() - start, (('operation', 'status_many'),))
+            yield item
+
+    def __getattr__(self, name):
+        """Pass anything else through to the archive."""
+        return getattr(self._archive, name)
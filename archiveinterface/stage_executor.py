@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Stage Executor Module.
+
+Module with the background executor that stages files for the archive
+interface. Staging a file from tape can take minutes, so stage
+requests enqueue their files as a job and return right away. Clients
+poll the job for the progress of each file.
+
+The files of a job are staged by the threads of the process the job
+was submitted to, which writes the job's progress to a directory shared
+by every worker, so any worker can answer a poll for it. The progress is
+written when the state of the job changes and otherwise at most every
+JOB_SAVE_INTERVAL seconds. Now and then the directory is tidied: the
+unfinished jobs of worker processes that have exited are failed and the
+oldest finished jobs beyond the history limit are removed.
+"""
+import os
+import re
+import json
+import time
+import errno
+import socket
+import tempfile
+import threading
+from uuid import uuid4
+from Queue import Queue
+from collections import OrderedDict
+
+DEFAULT_STAGE_WORKERS = 4
+DEFAULT_STAGE_JOB_HISTORY = 1000
+
+QUEUED = 'queued'
+STAGING = 'staging'
+STAGED = 'staged'
+ERROR = 'error'
+JOB_SUFFIX = '.json'
+JOB_ID_PATTERN = re.compile('^[0-9a-f]{32}$')
+# seconds between writes of a job's progress while its state doesn't change
+JOB_SAVE_INTERVAL = 1.0
+# seconds between tidying the job directory
+JOB_TIDY_INTERVAL = 60.0
+WORKER_EXITED = 'The worker process staging the file exited'
+HOSTNAME = socket.gethostname()
+
+
+def _summarize(files):
+    """Return the state of a job and the counts of its files in each state."""
+    counts = dict((state, 0) for state in (QUEUED, STAGING, STAGED, ERROR))
+    for entry in files:
+        counts[entry['state']] += 1
+    state = STAGING
+    if counts[QUEUED] == len(files):
+        state = QUEUED
+    elif counts[STAGED] + counts[ERROR] == len(files):
+        state = ERROR if counts[ERROR] else STAGED
+    return state, counts
+
+
+def _write_job_file(path, report):
+    """Replace the job file at path with the report."""
+    temp_path = '{}.{}.part'.format(path, uuid4().hex)
+    with open(temp_path, 'w') as job_file:
+        json.dump(report, job_file)
+    os.rename(temp_path, path)
+
+
+def _owner_alive(owner):
+    """Return whether the worker process that wrote a job file may still be staging it."""
+    if not owner or owner.get('host') != HOSTNAME:
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+    return True
+
+
+def _fail_unfinished(report):
+    """Return the report with the files still queued or staging failed."""
+    for entry in report['files']:
+        if entry['state'] in (QUEUED, STAGING):
+            entry['state'] = ERROR
+            entry['message'] = WORKER_EXITED
+    report['state'], report['counts'] = _summarize(report['files'])
+    return report
+
+
+class StageJob(object):
+    """A group of files being staged together."""
+
+    def __init__(self, filepaths, directory=None):
+        """Create a job with every file queued.
+
+        The progress is written to a file in directory if one is given.
+        """
+        self.job_id = uuid4().hex
+        self.created = time.time()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._saved_state = None
+        self._saved = 0.0
+        self._path = None
+        if directory:
+            self._path = os.path.join(directory, self.job_id + JOB_SUFFIX)
+        self.filepaths = list(OrderedDict.fromkeys(filepaths))
+        self._files = OrderedDict(
+            (filepath, {'file': filepath, 'state': QUEUED}) for filepath in self.filepaths
+        )
+
+    def update(self, filepath, state, message=None):
+        """Record the new state of one of the job's files."""
+        with self._lock:
+            entry = {'file': filepath, 'state': state}
+            if message:
+                entry['message'] = message
+            self._files[filepath] = entry
+        self.save(False)
+
+    def save(self, force=True):
+        """Write the progress of the job to its file.
+
+        Unless forced it is only written if the state of the job changed
+        or it was last written JOB_SAVE_INTERVAL seconds ago.
+        """
+        if not self._path:
+            return
+        with self._save_lock:
+            report = self.report()
+            if not force and report['state'] == self._saved_state and \
+                    time.time() - self._saved < JOB_SAVE_INTERVAL:
+                return
+            report['owner'] = {'host': HOSTNAME, 'pid': os.getpid()}
+            _write_job_file(self._path, report)
+            self._saved_state = report['state']
+            self._saved = time.time()
+
+    def finished(self):
+        """Return True once no file is waiting or staging."""
+        with self._lock:
+            return all(entry['state'] in (STAGED, ERROR) for entry in self._files.values())
+
+    def report(self):
+        """Return the progress of the job as a dictionary."""
+        with self._lock:
+            files = [dict(entry) for entry in self._files.values()]
+        state, counts = _summarize(files)
+        return {
+            'job': self.job_id,
+            'state': state,
+            'created': self.created,
+            'counts': counts,
+            'files': files
+        }
+
+
+class StageExecutor(object):
+    """Stage files in background worker threads."""
+
+    def __init__(self, archive, workers=DEFAULT_STAGE_WORKERS, history=DEFAULT_STAGE_JOB_HISTORY,
+                 status_cache=None, directory=None):
+        """Create an executor staging through the backend archive.
+
+        At most history jobs are remembered, the oldest finished jobs
+        are forgotten first. The cached status of each file staged is
+        forgotten from status_cache if one is given. The progress of
+        the jobs is kept in directory, a temporary one if it is None,
+        which is tidied right away.
+        """
+        self._archive = archive
+        self._status_cache = status_cache
+        self._workers = workers
+        self._history = history
+        self._directory = directory or tempfile.mkdtemp(prefix='archivei-stage-jobs-')
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        self._queue = Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._tidied = time.time()
+        self._tidy_job_files()
+
+    def submit(self, filepaths):
+        """Queue the files to be staged and return their job."""
+        job = StageJob(filepaths, self._directory)
+        job.save()
+        with self._lock:
+            self._start_workers()
+            self._jobs[job.job_id] = job
+            self._forget_old_jobs()
+            tidy = time.time() - self._tidied >= JOB_TIDY_INTERVAL
+            if tidy:
+                self._tidied = time.time()
+        for filepath in job.filepaths:
+            self._queue.put((job, filepath))
+        if tidy:
+            self._tidy_job_files()
+        return job
+
+    def job_report(self, job_id):
+        """Return the progress of the job with the id, None if it is unknown.
+
+        Jobs submitted to other worker processes are read from their files.
+        """
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.report()
+        try:
+            with open(os.path.join(self._directory, job_id + JOB_SUFFIX)) as job_file:
+                report = json.load(job_file)
+        except (IOError, ValueError):
+            return None
+        report.pop('owner', None)
+        return report
+
+    def _start_workers(self):
+        """Start the worker threads the first time a job is submitted."""
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._work, name='stage-worker')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _forget_old_jobs(self):
+        """Drop the oldest finished jobs beyond the history limit."""
+        extra = len(self._jobs) - self._history
+        for job_id in list(self._jobs.keys()):
+            if extra <= 0:
+                break
+            if self._jobs[job_id].finished():
+                del self._jobs[job_id]
+                extra -= 1
+
+    def _tidy_job_files(self):
+        """Tidy the job files of every worker.
+
+        Unfinished jobs of workers that have exited are failed and the
+        files of the oldest finished jobs beyond the history limit are
+        removed.
+        """
+        jobs = []
+        for filename in os.listdir(self._directory):
+            if not filename.endswith(JOB_SUFFIX):
+                continue
+            path = os.path.join(self._directory, filename)
+            try:
+                mtime = os.path.getmtime(path)
+                with open(path) as job_file:
+                    report = json.load(job_file)
+                if report['state'] not in (STAGED, ERROR) and not _owner_alive(report.get('owner')):
+                    _write_job_file(path, _fail_unfinished(report))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            jobs.append((mtime, path, report['state'] in (STAGED, ERROR)))
+        extra = len(jobs) - self._history
+        for _, path, finished in sorted(jobs):
+            if extra <= 0:
+                break
+            if finished:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                extra -= 1
+
+    def _work(self):
+        """Stage queued files forever."""
+        while True:
+            job, filepath = self._queue.get()
+            try:
+                self._stage(job, filepath)
+            finally:
+                self._queue.task_done()
+
+    def _stage(self, job, filepath):
+        """Stage one file of a job, recording how it went."""
+        job.update(filepath, STAGING)
+        # pylint: disable=broad-except
+        try:
+            archivefile = self._archive.open(filepath, 'r')
+            try:
+                archivefile.stage()
+            finally:
+                archivefile.close()
+                if self._status_cache:
+                    self._status_cache.invalidate(filepath)
+        except Exception as ex:
+            job.update(filepath, ERROR, str(ex))
+            return
+        # pylint: enable=broad-except
+        job.update(filepath, STAGED)
+
+    def join(self):
+        """Wait for every queued file to be staged."""
+        self._queue.join()
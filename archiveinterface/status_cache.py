@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Status Cache Module.
+
+Module with the cache of file statuses kept in front of the backend.
+Files are written to the archive once, so the status of a file on
+disk changes rarely and is kept for a while. A file only on tape
+may be staged at any time so its status is kept briefly. Writing or
+staging a file through the interface forgets its cached status.
+
+Each process has its own cache and only forgets the statuses of files
+written or staged through it, so another worker may send a status up
+to the TTL old. GET requests look the status up again as it sets the
+length of the response.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+DEFAULT_STATUS_CACHE_SIZE = 10000
+DEFAULT_STATUS_CACHE_DISK_TTL = 60
+DEFAULT_STATUS_CACHE_TAPE_TTL = 5
+
+
+def _cache_key(filepath):
+    """Return the key of the file, with or without a leading slash."""
+    return filepath.lstrip('/')
+
+
+class StatusCache(object):
+    """Bounded least recently used cache of file statuses."""
+
+    def __init__(self, size=DEFAULT_STATUS_CACHE_SIZE, disk_ttl=DEFAULT_STATUS_CACHE_DISK_TTL,
+                 tape_ttl=DEFAULT_STATUS_CACHE_TAPE_TTL):
+        """Create a cache of at most size statuses, zero disables it.
+
+        Statuses of files on disk expire after disk_ttl seconds, all
+        others after tape_ttl seconds.
+        """
+        self._size = size
+        self._disk_ttl = disk_ttl
+        self._tape_ttl = tape_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidate so lookups racing a write aren't cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, size, disk_ttl, tape_ttl):
+        """Change the size and TTLs, evicting statuses that no longer fit."""
+        with self._lock:
+            self._size = size
+            self._disk_ttl = disk_ttl
+            self._tape_ttl = tape_ttl
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def get(self, filepath):
+        """Return the cached status of the file, None if there is none."""
+        key = _cache_key(filepath)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def generation(self):
+        """Return the generation to pass to put for a status about to be looked up."""
+        with self._lock:
+            return self._generation
+
+    def put(self, filepath, status, generation=None):
+        """Cache the status of the file, statuses of missing files aren't.
+
+        If the generation the status was looked up in is given and a
+        status has been invalidated since, the status may be from
+        before a write and isn't cached.
+        """
+        if not self._size or status is None:
+            return
+        key = _cache_key(filepath)
+        ttl = self._disk_ttl if status.file_storage_media == 'disk' else self._tape_ttl
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, status)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, filepath):
+        """Forget the cached status of the file."""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(_cache_key(filepath), None)
+
+    def stat(self, archive, filepath):
+        """Return the status of the file, asking the backend on a miss."""
+        status = self.get(filepath)
+        if status is None:
+            status = self.refresh(archive, filepath)
+        return status
+
+    def refresh(self, archive, filepath):
+        """Return the status of the file from the backend, caching it."""
+        generation = self.generation()
+        status = archive.stat(filepath)
+        self.put(filepath, status, generation)
+        return status
+
+    def status_many(self, archive, filepaths):
+        """Yield (filepath, status) for the files like the backend does.
+
+        Only the files that missed are looked up, in one call to the
+        backend, and the results are yielded in the order asked.
+        """
+        cached = [(filepath, self.get(filepath)) for filepath in filepaths]
+        generation = self.generation()
+        looked_up = archive.status_many([filepath for filepath, status in cached if status is None])
+        for filepath, status in cached:
+            if status is None:
+                filepath, status = next(looked_up)
+                if not isinstance(status, Exception):
+                    self.put(filepath, status, generation)
+            yield filepath, status
+
+    def stats(self):
+        """Return the hit and miss counts and the number of cached statuses."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
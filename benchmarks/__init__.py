@@ -0,0 +1,7 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks of the archive interface.
+
+Drives the WSGI app in process, without a server, against the posix
+backend and an in memory backend that does no I/O.
+"""
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Memory Backend Module.
+
+Module with a backend archive that keeps only the size and mtime of
+each file and reads back zeros. It does no I/O so benchmarks run
+against it measure the cost of the interface itself.
+"""
+import time
+import threading
+from archiveinterface.archive_interface_error import ArchiveInterfaceError
+from archiveinterface.archive_utils import un_abs_path
+from archiveinterface.archivebackends.abstract.abstract_backend_archive import (
+    AbstractBackendArchive)
+from archiveinterface.archivebackends.posix.posix_status import PosixStatus
+
+# largest block handed back by a read, shared by every read
+ZEROS = '\0' * (1 << 20)
+
+
+class MemoryBackendArchive(AbstractBackendArchive):
+    """Backend archive remembering files without storing their data."""
+
+    def __init__(self, prefix):
+        """Create an empty archive, the prefix is ignored."""
+        super(MemoryBackendArchive, self).__init__(prefix)
+        self._files = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._filepath = None
+        self._position = 0
+        self._init_handle_pool('memory')
+
+    def open(self, filepath, mode):
+        """Open a memory file and return a new handle for it."""
+        handle = self._new_handle()
+        path = un_abs_path(filepath)
+        with self._lock:
+            if 'w' in mode:
+                self._files[path] = {'size': 0, 'mtime': time.time(), 'digests': {}}
+            entry = self._files.get(path)
+        if entry is None:
+            # pylint: disable=protected-access
+            handle._release_handle()
+            # pylint: enable=protected-access
+            raise ArchiveInterfaceError("Can't open memory file with error: no such file " + path)
+        # pylint: disable=protected-access
+        handle._filepath = path
+        handle._file = entry
+        handle._position = 0
+        # pylint: enable=protected-access
+        return handle
+
+    def close(self):
+        """Close a memory file, its status can still be set."""
+        self._release_handle()
+
+    def read(self, blocksize):
+        """Read zeros up to the size of the file."""
+        count = min(blocksize, self._file['size'] - self._position, len(ZEROS))
+        self._position += count
+        if count == len(ZEROS):
+            return ZEROS
+        return ZEROS[:count]
+
+    def seek(self, offset):
+        """Move the read position of the file."""
+        self._position = offset
+
+    def write(self, buf):
+        """Count the bytes written to the file."""
+        self._file['size'] += len(buf)
+
+    def stage(self):
+        """Stage a memory file, it is always on disk."""
+        pass
+
+    def status(self):
+        """Return the status of the open file."""
+        return self._make_status(self._filepath, self._file)
+
+    def stat(self, filepath):
+        """Return the status of the file, None if it doesn't exist."""
+        path = un_abs_path(filepath)
+        with self._lock:
+            entry = self._files.get(path)
+        if entry is None:
+            return None
+        return self._make_status(path, entry)
+
+    @staticmethod
+    def _make_status(path, entry):
+        """Build the status of a file from its entry."""
+        status = PosixStatus(entry['mtime'], entry['mtime'], (entry['size'],), entry['size'])
+        status.set_filepath(path)
+        status.set_digests(entry['digests'])
+        return status
+
+    def set_mod_time(self, mod_time):
+        """Set the mod time of the file."""
+        self._file['mtime'] = mod_time
+
+    def set_digests(self, digests):
+        """Remember the digests of the file."""
+        self._file['digests'] = digests
+
+    def discard(self):
+        """Close a memory file and forget it."""
+        with self._lock:
+            self._files.pop(self._filepath, None)
+        self.close()
+
+    def set_file_permissions(self):
+        """Set the permissions of the file, there are none."""
+        pass
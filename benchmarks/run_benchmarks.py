@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Run the benchmarks and write the results as JSON.
+
+Each workload sends synthetic requests straight to the WSGI app and
+times them, so the results have no network or server in them. Running
+the same workloads against the memory backend, which does no I/O, and
+a real backend separates the cost of the interface from the storage.
+
+python -m benchmarks.run_benchmarks --backend memory --backend posix --output results.json
+python -m benchmarks.run_benchmarks --baseline results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+from argparse import ArgumentParser
+from archiveinterface.archive_utils import set_config_name
+from archiveinterface.archive_interface import ArchiveInterfaceGenerator
+from archiveinterface.archivebackends.archive_backend_factory import ArchiveBackendFactory
+from benchmarks.memory_backend import MemoryBackendArchive, ZEROS
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), 'benchmark.cfg')
+BACKENDS = ('memory', 'posix', 'hpss_simulator')
+# the simulated hpss is slow, as hpss is, so it is only run when asked for
+DEFAULT_BACKENDS = ('memory', 'posix')
+WORKLOADS = ('small_put', 'small_get', 'small_head', 'stream_put', 'stream_get')
+DEFAULT_REQUESTS = 1000
+DEFAULT_SMALL_SIZE = 4096
+DEFAULT_STREAM_SIZE = 1 << 30
+DEFAULT_STREAMS = 2
+DEFAULT_TOLERANCE = 0.2
+# the ids of the streamed files start after the small ones
+STREAM_ID_BASE = 1 << 30
+
+
+class _ZeroInput(object):
+    """Request body of zeros that is never held in memory at once."""
+
+    def __init__(self, length):
+        """Send length bytes of zeros."""
+        self._remaining = length
+
+    def read(self, size=-1):
+        """Read up to size bytes."""
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        size = min(size, len(ZEROS))
+        self._remaining -= size
+        if size == len(ZEROS):
+            return ZEROS
+        return ZEROS[:size]
+
+
+def _environ(method, fileid, length=None):
+    """Return the environ of a request for the file."""
+    env = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': '/{}'.format(fileid),
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'benchmark',
+        'SERVER_PORT': '0',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr
+    }
+    if length is not None:
+        env['wsgi.input'] = _ZeroInput(length)
+        env['CONTENT_LENGTH'] = str(length)
+    return env
+
+
+def _call(app, env):
+    """Send the request to the app and return its status code and body length."""
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        """Keep the status code."""
+        status.append(int(status_line[:3]))
+    result = app(env, start_response)
+    length = 0
+    try:
+        for data in result:
+            length += len(data)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return status[-1], length
+
+
+def percentile(values, fraction):
+    """Return the nearest rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def _summary(latencies, errors, elapsed, transferred):
+    """Return the throughput and latency percentiles of a workload."""
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 6),
+        'requests_per_second': round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        'megabytes_per_second': round(transferred / elapsed / (1 << 20), 3) if elapsed else 0.0,
+        'latency_ms': dict(
+            (name, round(percentile(latencies, fraction) * 1000, 3))
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))
+        )
+    }
+
+
+def run_workload(app, workload, requests, small_size, stream_size, streams):
+    """Run a workload against the app and return its summary."""
+    if workload.startswith('stream'):
+        fileids = [STREAM_ID_BASE + index for index in range(streams)]
+        size = stream_size
+    else:
+        fileids = range(requests)
+        size = small_size
+    method = {'put': 'PUT', 'get': 'GET', 'head': 'HEAD'}[workload.split('_')[1]]
+    expected = {'PUT': 201, 'GET': 200, 'HEAD': 204}[method]
+    latencies = []
+    errors = 0
+    transferred = 0
+    start = time.time()
+    for fileid in fileids:
+        env = _environ(method, fileid, size if method == 'PUT' else None)
+        request_start = time.time()
+        code, length = _call(app, env)
+        latencies.append(time.time() - request_start)
+        if code != expected:
+            errors += 1
+        transferred += size if method == 'PUT' else length
+    return _summary(latencies, errors, time.time() - start, transferred)
+
+
+def _make_backend(name, prefix):
+    """Create the backend with the name storing files under prefix."""
+    if name == 'memory':
+        return MemoryBackendArchive(prefix)
+    return ArchiveBackendFactory().get_backend_archive(name, prefix)
+
+
+def run_benchmarks(backend_name, prefix, requests=DEFAULT_REQUESTS, small_size=DEFAULT_SMALL_SIZE,
+                   stream_size=DEFAULT_STREAM_SIZE, streams=DEFAULT_STREAMS, workloads=WORKLOADS):
+    """Run the workloads against a new app in front of the backend."""
+    # the app announces itself on stdout, which may be carrying the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        app = ArchiveInterfaceGenerator(_make_backend(backend_name, prefix)).pacifica_archiveinterface
+    finally:
+        sys.stdout = stdout
+    results = {}
+    for workload in workloads:
+        results[workload] = run_workload(app, workload, requests, small_size, stream_size, streams)
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return the workloads that got slower than the baseline by more than tolerance."""
+    regressions = []
+    for backend_name, workloads in results['results'].items():
+        for workload, summary in workloads.items():
+            base = baseline.get('results', {}).get(backend_name, {}).get(workload)
+            if not base:
+                continue
+            if summary['requests_per_second'] < base['requests_per_second'] * (1 - tolerance):
+                regressions.append('{} {}: {} requests/s, baseline {}'.format(
+                    backend_name, workload, summary['requests_per_second'], base['requests_per_second']))
+            if summary['latency_ms']['p99'] > base['latency_ms']['p99'] * (1 + tolerance):
+                regressions.append('{} {}: p99 {} ms, baseline {} ms'.format(
+                    backend_name, workload, summary['latency_ms']['p99'], base['latency_ms']['p99']))
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line, returning the exit code."""
+    parser = ArgumentParser(description='Benchmark the archive interface in process.')
+    parser.add_argument('--backend', dest='backends', action='append', choices=BACKENDS,
+                        help='backend to run against, may be repeated, default memory and posix')
+    parser.add_argument('--workload', dest='workloads', action='append', choices=WORKLOADS,
+                        help='workload to run, may be repeated, default all')
+    parser.add_argument('--prefix', metavar='PREFIX', default=tempfile.gettempdir(),
+                        help='directory the posix and simulated hpss backends write a scratch directory in')
+    parser.add_argument('--config', metavar='CONFIG', default=DEFAULT_CONFIG,
+                        help='config file for the app and backends')
+    parser.add_argument('--requests', metavar='REQUESTS', type=int, default=DEFAULT_REQUESTS,
+                        help='requests for each small file workload')
+    parser.add_argument('--small-size', metavar='BYTES', type=int, default=DEFAULT_SMALL_SIZE,
+                        help='size of the small files')
+    parser.add_argument('--stream-size', metavar='BYTES', type=int, default=DEFAULT_STREAM_SIZE,
+                        help='size of the streamed files')
+    parser.add_argument('--streams', metavar='STREAMS', type=int, default=DEFAULT_STREAMS,
+                        help='requests for each streaming workload')
+    parser.add_argument('--output', metavar='OUTPUT', default='-',
+                        help='file to write the results to, - for stdout')
+    parser.add_argument('--baseline', metavar='BASELINE',
+                        help='results to compare against, exits 1 on a regression')
+    parser.add_argument('--tolerance', metavar='FRACTION', type=float, default=DEFAULT_TOLERANCE,
+                        help='slowdown allowed against the baseline')
+    args = parser.parse_args(argv)
+
+    set_config_name(args.config)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'requests': args.requests,
+        'small_size': args.small_size,
+        'stream_size': args.stream_size,
+        'streams': args.streams,
+        'results': {}
+    }
+    for backend_name in args.backends or DEFAULT_BACKENDS:
+        scratch = tempfile.mkdtemp(prefix='archivei-benchmark-', dir=args.prefix)
+        try:
+            results['results'][backend_name] = run_benchmarks(
+                backend_name, scratch, args.requests, args.small_size, args.stream_size, args.streams,
+                args.workloads or WORKLOADS)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    text = json.dumps(results, sort_keys=True, indent=4)
+    if args.output == '-':
+        print text
+    else:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write('Regression: {}\n'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
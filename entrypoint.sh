@@ -4,5 +4,6 @@ cd /
 uwsgi \
   --http-socket $PACIFICA_AAPI_ADDRESS:$PACIFICA_AAPI_PORT \
   --master \
+  --enable-threads \
   --die-on-term \
   --wsgi-file /usr/src/app/archiveinterface/wsgi.py "$@"
@@ -9,19 +9,35 @@ pylint \
     archiveinterface.archive_interface \
     archiveinterface.archive_interface_responses \
     archiveinterface.archive_interface_error \
+    archiveinterface.archive_server \
+    archiveinterface.async_server \
+    archiveinterface.stage_executor \
+    archiveinterface.status_cache \
+    archiveinterface.metrics \
+    archiveinterface.access_log \
+    archiveinterface.bundle \
     archiveinterface.archive_utils \
     archiveinterface.id2filename \
     archiveinterface.archivebackends.archive_backend_factory \
+    archiveinterface.archivebackends.handle_pool \
+    archiveinterface.archivebackends.directory_cache \
     archiveinterface.archivebackends.abstract.abstract_backend_archive \
     archiveinterface.archivebackends.abstract.abstract_status \
     archiveinterface.archivebackends.posix.posix_backend_archive \
     archiveinterface.archivebackends.posix.posix_status \
     archiveinterface.archivebackends.posix.extendedfile \
+    archiveinterface.archivebackends.posix.extended_attributes \
+    archiveinterface.archivebackends.posix.durable \
     archiveinterface.archivebackends.hpss.hpss_backend_archive \
     archiveinterface.archivebackends.hpss.hpss_extended \
     archiveinterface.archivebackends.hpss.hpss_status \
+    archiveinterface.archivebackends.hpss.hpss_session \
+    archiveinterface.archivebackends.hpss.hpss_simulator \
     archiveinterface.archivebackends.oracle_hms_sideband.extended_hms_sideband \
     archiveinterface.archivebackends.oracle_hms_sideband.hms_sideband_backend_archive \
     archiveinterface.archivebackends.oracle_hms_sideband.hms_sideband_status \
     archiveinterface.archivebackends.oracle_hms_sideband.hms_sideband_orm \
+    benchmarks \
+    benchmarks.memory_backend \
+    benchmarks.run_benchmarks \
     post_deployment_tests/deployment_test.py